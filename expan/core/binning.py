@@ -5,8 +5,7 @@ import warnings
 from heapq import heapify, heappush, heappop
 
 import numpy as np
-
-from expan.core.util import is_nan
+import pandas as pd
 
 logger = logging.getLogger(__name__)
 
@@ -176,7 +175,7 @@ def create_bins(data, n_bins):
         raise ValueError('Less than one bin makes no sense.')
 
     insufficient_distinct = False
-    n_unique_values = len(np.unique([value for value in data if not is_nan(value)]))
+    n_unique_values = pd.Series(data).nunique(dropna=True)
     if n_unique_values < n_bins:
         insufficient_distinct = True
         warnings.warn("Insufficient unique values for requested number of bins. " +
@@ -198,54 +197,120 @@ def create_bins(data, n_bins):
     return bins
 
 
-#------- private methods for numerical binnings-------#
+def assign_bins(data, feature, bins):
+    """
+    Assigns every row of the data to its bin in one pass, instead of applying the bins one by one.
+    The bins need to be disjoint, as the ones created by create_bins.
+    :param data: pandas data frame
+    :param feature: feature name on which the bins are defined
+    :param bins: a list of Bin objects, either all numerical or all categorical
+    :return: numpy array of the index of each row's bin in bins, or -1 if the row belongs to no bin
+    """
+    bin_types = set(bin.bin_type for bin in bins)
+    if len(bin_types) > 1:
+        raise ValueError("Bins need to be either all numerical or all categorical.")
+
+    column = data[feature]
+    if not bins:
+        return np.full(len(column), -1, dtype=np.int64)
+    if bin_types.pop() == "numerical":
+        return _assign_numerical_bins(np.asarray(column, dtype=float), bins)
+    else:
+        return _assign_categorical_bins(column, bins)
 
-def _create_numerical_bins(data_as_array, n_bins):
-    return _create_next_numerical_bin(data_as_array, n_bins, [])
 
+#------- private methods for numerical binnings-------#
 
-def _create_next_numerical_bin(x, n_bins, result):
+def _assign_numerical_bins(x, bins):
     """
-    Create bins for numerical data
+    Assigns values to numerical bins by a binary search of their lower bounds.
     :param x: array of data
+    :param bins: a list of numerical Bin objects
+    :return: numpy array of bin indices, -1 for values in no bin
+    """
+    codes = np.full(len(x), -1, dtype=np.int64)
+    representations = [bin.representation for bin in bins]
+    is_nan_bin = [np.isnan(rep.lower) or np.isnan(rep.upper) for rep in representations]
+
+    # bins sorted by their lower bound, an open lower bound after a closed one of the same value
+    order = np.array(sorted((i for i in range(len(bins)) if not is_nan_bin[i]),
+                            key=lambda i: (representations[i].lower, not representations[i].lower_closed)),
+                     dtype=np.int64)
+    valid = ~np.isnan(x)
+    if len(order) > 0:
+        lowers = np.array([representations[i].lower for i in order], dtype=float)
+        uppers = np.array([representations[i].upper for i in order], dtype=float)
+        lower_closed = np.array([representations[i].lower_closed for i in order], dtype=bool)
+        upper_closed = np.array([representations[i].upper_closed for i in order], dtype=bool)
+
+        values = x[valid]
+        # the last bin whose lower bound is below the value, or equal to it and closed
+        candidates = np.searchsorted(lowers, values, side='right') - 1
+        at_open_lower = (candidates >= 0) & ~lower_closed[candidates.clip(0)] & \
+                        (values == lowers[candidates.clip(0)])
+        candidates[at_open_lower] -= 1
+
+        found = candidates >= 0
+        candidates = candidates.clip(0)
+        found &= (values < uppers[candidates]) | (upper_closed[candidates] & (values == uppers[candidates]))
+        found &= (values > lowers[candidates]) | (lower_closed[candidates] & (values == lowers[candidates]))
+        codes[np.flatnonzero(valid)[found]] = order[candidates[found]]
+
+    if any(is_nan_bin):
+        codes[~valid] = is_nan_bin.index(True)
+    return codes
+
+
+def _create_numerical_bins(data_as_array, n_bins):
+    """
+    Create bins for numerical data.
+    The data is sorted once, then each bin starts at the smallest remaining value and 
+    ends at the 1/n_bins percentile (interpolation 'higher') of the remaining values,
+    where n_bins is the number of bins still to create.
+    The bin is a closed interval if it contains a single repeated value, and closed-open otherwise.
+    The last bin is a closed interval up to the largest value, and NaNs get a bin of their own.
+    :param data_as_array: array of data
     :param n_bins: number of bins
     :return: a list of bins object
     """
-    # no more data
-    if len(x) == 0:
-        return result
+    x = np.asarray(data_as_array)
+    nans = np.isnan(x)
+    result = []
 
-    # if data has nan
-    if any(np.isnan(x)):
-        cur_bin = Bin("numerical", np.nan, np.nan, True, True)
-        result.append(cur_bin)
-        return _create_next_numerical_bin(x[~np.isnan(x)], n_bins-1, result)
+    if nans.any():
+        result.append(Bin("numerical", np.nan, np.nan, True, True))
+        n_bins -= 1
+    x = np.sort(x[~nans])
 
-    # the last bin is a closed-closed interval
-    if n_bins == 1:
-        cur_bin = Bin("numerical", min(x), max(x), True, True)
-        result.append(cur_bin)
-        return result
+    start = 0
+    while start < len(x):
+        if n_bins <= 1:
+            # the last bin is a closed-closed interval
+            result.append(Bin("numerical", x[start], x[-1], True, True))
+            break
 
-    lower, upper, lower_closed, upper_closed = _first_interval(x, n_bins)
-    cur_bin = Bin("numerical", lower, upper, lower_closed, upper_closed)
-    result.append(cur_bin)
+        lower, upper, lower_closed, upper_closed = _first_interval(x, start, n_bins)
+        result.append(Bin("numerical", lower, upper, lower_closed, upper_closed))
 
-    next_data = x[x > upper] if upper_closed else x[x >= upper]
-    return _create_next_numerical_bin(next_data, n_bins-1, result)
+        # the remaining data starts after the upper bound, or at it if the bound is open
+        start = np.searchsorted(x, upper, side='right' if upper_closed else 'left')
+        n_bins -= 1
+
+    return result
 
 
-def _first_interval(x, n_bins):
+def _first_interval(x, start, n_bins):
     """
-    Gets the first interval based on the percentiles, 
+    Gets the first interval of the sorted values x[start:] based on the percentiles, 
     either a closed interval containing the same value multiple times
     or a closed-open interval with a different lower and upper bound.
     """
-    # calculate the percentiles
-    percentiles = np.linspace(0., 100., n_bins + 1)
-    bounds = np.percentile(x, q=percentiles, interpolation='higher')
-    lower = bounds[0]
-    upper = bounds[1]
+    # index of the first percentile of n_bins + 1 equally spaced ones, 
+    # computed as np.percentile(x[start:], q, interpolation='higher')
+    percentile = np.linspace(0., 100., n_bins + 1)[1]
+    index = int(np.ceil(percentile / 100.0 * (len(x) - start - 1)))
+    lower = x[start]
+    upper = x[start + index]
 
     if lower == upper:
         return lower, upper, True, True
@@ -255,6 +320,25 @@ def _first_interval(x, n_bins):
 
 #------- private methods for categorical binnings-------#
 
+def _assign_categorical_bins(column, bins):
+    """
+    Assigns values to categorical bins by a lookup of their categories.
+    :param column: pandas series of data
+    :param bins: a list of categorical Bin objects
+    :return: numpy array of bin indices, -1 for values in no bin
+    """
+    codes_of_categories = {}
+    for code, bin in reversed(list(enumerate(bins))):
+        for category in bin.representation.categories:
+            codes_of_categories[category] = code
+    if str(column.dtype) == 'category':
+        # look up each category once and index the result by the category codes of the rows
+        codes = pd.Series(column.cat.categories).map(codes_of_categories).fillna(-1).values.astype(np.int64)
+        row_codes = np.asarray(column.cat.codes)
+        return np.where(row_codes >= 0, codes[row_codes], -1)
+    return column.map(codes_of_categories).fillna(-1).values.astype(np.int64)
+
+
 def _create_categorical_bins(data_as_array, n_bins):
     """ 
     Performs greedy (non-optimal) binning
@@ -262,15 +346,10 @@ def _create_categorical_bins(data_as_array, n_bins):
     :return: a list of Bin object
     """
     # count items
-    weights = {}
-    for item in data_as_array:
-        if not item in weights:
-            weights[item] = 1
-        else:
-            weights[item] += 1
+    weights = pd.Series(data_as_array).value_counts(sort=False, dropna=False)
 
     # we need items sorted in decreasing order
-    pairs = sorted([(weight, [item]) for (item, weight) in weights.items()], reverse=True)
+    pairs = sorted([(int(weight), [item]) for (item, weight) in weights.items()], reverse=True)
     bins = pairs[:min(n_bins, len(pairs))]
 
     # too little data, just return what we have so far
@@ -283,8 +362,9 @@ def _create_categorical_bins(data_as_array, n_bins):
     for (pair_weight, pair_labels) in pairs[n_bins:]:
         # take the lightest bin
         bin_weight, bin_labels = heappop(bins)
-        # add the heaviest item to it
-        heappush(bins, (bin_weight + pair_weight, bin_labels + pair_labels))
+        # add the heaviest item to it, extending the popped list in place instead of copying it
+        bin_labels.extend(pair_labels)
+        heappush(bins, (bin_weight + pair_weight, bin_labels))
 
     return toBinObject(bins)
 
@@ -1,24 +1,120 @@
 import os
+import hashlib
 import logging
 import pickle
+import platform
 import sys
+import sysconfig
 import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from os.path import dirname, join, realpath
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where the cache is used without locking
+    fcntl = None
+
 import pandas as pd
 import numpy as np
+import pystan
 from pystan import StanModel
-from scipy.stats import gaussian_kde, norm, cauchy
+from scipy.special import gamma as gamma_function
+from scipy.stats import norm, cauchy
 
 import expan.core.statistics as statx
 from expan.core.util import drop_nan
-from expan.core.results import BaseTestStatistics, SampleStatistics, EarlyStoppingTestStatistics
+from expan.core.results import BaseTestStatistics, SampleStatistics, EarlyStoppingTestStatistics, \
+    SufficientStatistics
 
 __location__ = realpath(join(os.getcwd(), dirname(__file__)))
 logger = logging.getLogger(__name__)
 
-cache_sampling_results = False
-sampling_results = {}  # memorized sampling results
+
+class PosteriorCache(object):
+    """ Cache of posterior samples, bounded to the max_entries least recently used results in memory,
+    with an optional tier on disk which keeps every result in cache_dir.
+    
+    Keys are content hashes (see _posterior_cache_key), hence files on disk never go stale. 
+    Files are written atomically, so processes can share the directory.
+    """
+    def __init__(self, max_entries=32, cache_dir=None):
+        """
+        :param max_entries: maximum number of results kept in memory
+        :type  max_entries: int
+        :param cache_dir: directory of the results on disk, or None for no disk tier
+        :type  cache_dir: str
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """ Returns the cached result for the key, or None if it is not cached. """
+        if key in self._entries:
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+        if self.cache_dir:
+            file_name = self._file_name(key)
+            if os.path.isfile(file_name):
+                try:
+                    with open(file_name, 'rb') as f:
+                        value = pickle.load(f)
+                except Exception as e:
+                    logger.warning("Cannot load cached posterior {}: {}".format(file_name, e))
+                    return None
+                self._put_in_memory(key, value)
+                return value
+        return None
+
+    def put(self, key, value):
+        """ Caches the result for the key, in memory and on disk if cache_dir is set. """
+        self._put_in_memory(key, value)
+        if self.cache_dir:
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:  # the directory exists, e.g. created by a concurrent worker
+                if not os.path.isdir(self.cache_dir):
+                    raise
+            _atomic_pickle_dump(value, self._file_name(key))
+
+    def clear(self):
+        """ Removes all results from memory. Results on disk are kept. """
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries or bool(self.cache_dir) and os.path.isfile(self._file_name(key))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _put_in_memory(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _file_name(self, key):
+        return join(self.cache_dir, 'expan_posterior_{}.pkl'.format(key))
+
+
+cache_sampling_results = True
+# memorized sampling results, on disk too if the environment variable EXPAN_POSTERIOR_CACHE_DIR is set
+sampling_results = PosteriorCache(cache_dir=os.environ.get('EXPAN_POSTERIOR_CACHE_DIR'))
+
+# step size and target acceptance rate of the MCMC sampler, conservative to avoid divergent transitions
+DEFAULT_SAMPLING_CONTROL = {'stepsize': 0.01, 'adapt_delta': 0.99}
+
+# number of posterior samples drawn by the conjugate inference, enough for the kernel density and the HDI
+CONJUGATE_NUM_SAMPLES = 10000
+
+# shape and rate of the gamma priors of the rates of the conjugate poisson model, as of lambda in the Stan model
+CONJUGATE_POISSON_PRIOR = (2.0, 2.0)
+
+# directory of the compiled Stan models, the temporary directory is used if it is None
+stan_model_cache_dir = os.environ.get('EXPAN_STAN_MODEL_CACHE_DIR')
 
 
 def obrien_fleming(information_fraction, alpha=0.05):
@@ -130,34 +226,179 @@ def group_sequential(x, y, spending_function='obrien_fleming', estimated_sample_
                                        float(mu_x - mu_y), interval, p_value, statistical_power, stop)
 
 
+def make_group_sequential_from_sufficient_statistics(spending_function='obrien_fleming', estimated_sample_size=None,
+                                                     alpha=0.05, cap=8):
+    """ A closure to the group_sequential_from_sufficient_statistics function. """
+    def go(x, y):
+        return group_sequential_from_sufficient_statistics(x, y, spending_function, estimated_sample_size, alpha, cap)
+    return go
+
+
+def group_sequential_from_sufficient_statistics(x, y, spending_function='obrien_fleming', estimated_sample_size=None,
+                                                alpha=0.05, cap=8):
+    """ Group sequential method to determine whether to stop early, computed from the moments of the samples only.
+    The result is the same as the one of group_sequential on the samples.
+
+    :param x: moments of the treatment sample, with unit denominators
+    :type  x: SufficientStatistics
+    :param y: moments of the control sample, with unit denominators
+    :type  y: SufficientStatistics
+    :param spending_function: name of the alpha spending function, currently supports only 'obrien_fleming'.
+    :type  spending_function: str
+    :param estimated_sample_size: sample size to be achieved towards the end of experiment
+    :type  estimated_sample_size: int
+    :param alpha: type-I error rate
+    :type  alpha: float
+    :param cap: upper bound of the adapted z-score
+    :type  cap: int
+
+    :return: results of type EarlyStoppingTestStatistics
+    :rtype:  EarlyStoppingTestStatistics
+    """
+    if not isinstance(x, SufficientStatistics) or not isinstance(y, SufficientStatistics):
+        raise TypeError('Please provide moments of type SufficientStatistics.')
+
+    n_x = x.sample_size
+    n_y = y.sample_size
+
+    if not estimated_sample_size:
+        information_fraction = 1.0
+    else:
+        information_fraction = min(1.0, (n_x + n_y) / estimated_sample_size)
+
+    # alpha spending function
+    if spending_function in ('obrien_fleming'):
+        func = eval(spending_function)
+    else:
+        raise NotImplementedError
+    alpha_new = func(information_fraction, alpha=alpha)
+
+    # calculate the z-score bound
+    bound = norm.ppf(1 - alpha_new / 2)
+    # replace potential inf with an upper bound
+    if bound == np.inf:
+        bound = cap
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mu_x = x.mean_numerators
+        mu_y = y.mean_numerators
+        var_x = x.squared_deviations_numerators / n_x
+        var_y = y.squared_deviations_numerators / n_y
+        sigma_x = np.sqrt(var_x)
+        sigma_y = np.sqrt(var_y)
+        z = (mu_x - mu_y) / np.sqrt(var_x / n_x + var_y / n_y)
+
+    if z > bound or z < -bound:
+        stop = True
+    else:
+        stop = False
+
+    interval = statx.normal_difference(mu_x, sigma_x, n_x, mu_y, sigma_y, n_y,
+                                       [alpha_new * 100 / 2, 100 - alpha_new * 100 / 2])
+
+    treatment_statistics = SampleStatistics(int(n_x), float(mu_x), float(var_x))
+    control_statistics   = SampleStatistics(int(n_y), float(mu_y), float(var_y))
+    p_value              = statx.compute_p_value(mu_x, sigma_x, n_x, mu_y, sigma_y, n_y)
+    statistical_power    = statx.compute_statistical_power(mu_x, sigma_x, n_x, mu_y, sigma_y, n_y,
+                                                           norm.ppf(1 - alpha / 2.))
+
+    return EarlyStoppingTestStatistics(control_statistics, treatment_statistics,
+                                       float(mu_x - mu_y), interval, p_value, statistical_power, stop)
+
+
 def HDI_from_MCMC(posterior_samples, credible_mass=0.95):
     """ Computes highest density interval from a sample of representative values, 
     estimated as the shortest credible interval.
     Takes Arguments posterior_samples (samples from posterior) and credible mass (normally .95).
     http://stackoverflow.com/questions/22284502/highest-posterior-density-region-and-central-credible-region
     
-    :param posterior_samples: sample of data points from posterior distribution of some parameter
+    The samples are sorted once for all credible masses. A 2-D array is a batch of samples, one per row, 
+    whose intervals are computed at once.
+    
+    :param posterior_samples: sample of data points from posterior distribution of some parameter, 
+                              or 2-D array of such samples
     :type  posterior_samples: array-like
     :param credible_mass: the range of credible interval. 0.95 means 95% represents credible interval.
-    :type  credible_mass: float
+                          A list of credible masses gives a list of intervals.
+    :type  credible_mass: float or list[float]
 
-    :return: corresponding lower and upper bound for the credible interval
-    :rtype:  tuple[float]
+    :return: corresponding lower and upper bound for the credible interval (arrays of bounds for a 2-D batch),
+             or a list of them for a list of credible masses
+    :rtype:  tuple[float] or list[tuple[float]]
     """
+    sorted_points = np.sort(np.asarray(posterior_samples, dtype=float), axis=-1)
+    intervals = [_HDI_of_sorted_samples(sorted_points, mass) for mass in np.atleast_1d(credible_mass)]
+    if np.ndim(credible_mass) == 0:
+        return intervals[0]
+    return intervals
+
+
+def _HDI_of_sorted_samples(sorted_points, credible_mass):
+    """ Highest density interval of sorted samples (see HDI_from_MCMC) as the interval between the points 
+    ciIdxInc apart with the smallest difference. """
+    ciIdxInc = int(np.ceil(credible_mass * sorted_points.shape[-1]))
+    nCIs = sorted_points.shape[-1] - ciIdxInc
+    if nCIs <= 0:
+        raise ValueError("Too few posterior samples for a credible interval of mass {}.".format(credible_mass))
+
+    ciWidth = sorted_points[..., ciIdxInc:] - sorted_points[..., :nCIs]
+    HDIminIdx = np.argmin(ciWidth, axis=-1)
+    if sorted_points.ndim == 1:
+        return (sorted_points[HDIminIdx], sorted_points[HDIminIdx + ciIdxInc])
+    rows = np.arange(sorted_points.shape[0])
+    return (sorted_points[rows, HDIminIdx], sorted_points[rows, HDIminIdx + ciIdxInc])
+
+
+def kernel_density(posterior_samples, points=0.0):
+    """ Gaussian kernel density estimate of posterior samples, evaluated at a few points 
+    (e.g. the null value of the Savage-Dickey Bayes factor).
+    
+    The bandwidth is chosen by Scott's rule as in scipy.stats.gaussian_kde: the standard deviation of the 
+    samples times n^(-1/5). The density is the closed form mean of the kernels, computed in O(n) per point 
+    without building a gaussian_kde; it agrees with gaussian_kde(posterior_samples).evaluate(points) 
+    up to a relative tolerance of 1e-10.
 
-    sorted_points = sorted(posterior_samples)
-    ciIdxInc = np.ceil(credible_mass * len(sorted_points)).astype('int')
-    nCIs = len(sorted_points) - ciIdxInc
-    ciWidth = [0] * nCIs
-    for i in range(0, nCIs):
-        ciWidth[i] = sorted_points[i + ciIdxInc] - sorted_points[i]
+    :param posterior_samples: sample of data points from posterior distribution of some parameter
+    :type  posterior_samples: array-like
+    :param points: point or points at which the density is evaluated
+    :type  points: float or array-like
+
+    :return: density at the points
+    :rtype:  float or np.ndarray
+    """
+    samples = np.asarray(posterior_samples, dtype=float).ravel()
+    n = len(samples)
+    if n < 2:
+        raise ValueError("Please provide at least two posterior samples.")
+    bandwidth = np.std(samples, ddof=1) * n ** (-1. / 5)
+    normalization = n * bandwidth * np.sqrt(2 * np.pi)
 
-    HDImin = sorted_points[ciWidth.index(min(ciWidth))]
-    HDImax = sorted_points[ciWidth.index(min(ciWidth)) + ciIdxInc]
-    return (HDImin, HDImax)
+    density = np.array([np.sum(np.exp(-0.5 * ((point - samples) / bandwidth) ** 2)) / normalization
+                        for point in np.atleast_1d(points)])
+    if np.ndim(points) == 0:
+        return float(density[0])
+    return density
 
 
-def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sampling"):
+def _credible_interval_percentiles(posterior_samples, credible_mass):
+    """ Highest density intervals of posterior samples, for one or several credible masses.
+
+    :return: the percentiles of the bounds of the intervals and their values
+    :rtype:  dict
+    """
+    credible_masses = list(np.atleast_1d(credible_mass))
+    credible_intervals = {}
+    for mass, interval in zip(credible_masses, HDI_from_MCMC(posterior_samples, credible_masses)):
+        left_out = 1.0 - mass
+        p1       = round(left_out/2.0, 5)
+        p2       = round(1.0 - left_out/2.0, 5)
+        credible_intervals[p1*100] = interval[0]
+        credible_intervals[p2*100] = interval[1]
+    return credible_intervals
+
+
+def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sampling",
+                    chains=4, n_jobs=1, warmup=None, control=None):
     """ Helper function for bayesian sampling.
 
     :param x: sample of a treatment group
@@ -168,8 +409,17 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
     :type  distribution: str
     :param num_iters: number of iterations of sampling
     :type  num_iters: int
-    :param inference: 'sampling' for MCMC sampling method or 'variational' for variational inference
+    :param inference: 'sampling' for MCMC sampling method, 'variational' for variational inference
+                      or 'conjugate' for sampling the closed form posterior of conjugate priors
     :type  inference: str
+    :param chains: number of MCMC chains
+    :type  chains: int
+    :param n_jobs: number of processes running the chains, -1 for all CPUs
+    :type  n_jobs: int
+    :param warmup: number of warmup iterations per chain, by default half of num_iters
+    :type  warmup: int
+    :param control: settings of the sampler, DEFAULT_SAMPLING_CONTROL by default
+    :type  control: dict
 
     :return: the posterior samples, sample size of x, sample size of y, absolute mean of x, absolute mean of y
     :rtype:  tuple[array-like, array-like, array-like, float, float]
@@ -181,6 +431,8 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
         raise TypeError('Please provide samples of type Series or list.')
     if type(x) != type(y):
         raise TypeError('Please provide samples of the same type.')
+    if inference not in ('sampling', 'variational', 'conjugate'):
+        raise ValueError("Inference method " + inference + " is not implemented.")
 
     logger.info("Started running bayesian inference with {} procedure, treatment group of size {}, "
                 "control group of size {}, {} distribution.".format(inference, len(x), len(y), distribution, inference))
@@ -191,16 +443,38 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
     _x = drop_nan(_x)
     _y = drop_nan(_y)
 
-    key = (str(_x), str(_y), num_iters, inference)
+    if control is None:
+        control = DEFAULT_SAMPLING_CONTROL
+    if inference == "sampling":
+        key = _posterior_cache_key(_x, _y, distribution, inference=inference, num_iters=num_iters,
+                                   chains=chains, warmup=warmup, control=sorted(control.items()))
+    elif inference == "conjugate":
+        prior = CONJUGATE_POISSON_PRIOR if distribution == 'poisson' else 'normal(0, 1)'
+        key = _posterior_cache_key(_x, _y, distribution, inference=inference, num_samples=CONJUGATE_NUM_SAMPLES,
+                                   prior=prior)
+    else:
+        key = _posterior_cache_key(_x, _y, distribution, inference=inference, num_iters=num_iters)
 
-    if cache_sampling_results and key in sampling_results:
-        return sampling_results[key]
+    if cache_sampling_results:
+        cached_results = sampling_results.get(key)
+        if cached_results is not None:
+            logger.info("Loaded the cached results of bayesian inference with {} procedure.".format(inference))
+            traces, n_x, n_y, mu_x, mu_y = cached_results
+            return _copy_traces(traces), n_x, n_y, mu_x, mu_y
 
     mu_x = np.nanmean(_x)
     mu_y = np.nanmean(_y)
     n_x = statx.sample_size(_x)
     n_y = statx.sample_size(_y)
 
+    start_time = time.time()
+    if inference == "conjugate":
+        traces = _conjugate_posterior_samples(_x, _y, distribution, CONJUGATE_NUM_SAMPLES)
+        if cache_sampling_results:
+            sampling_results.put(key, (_copy_traces(traces), n_x, n_y, mu_x, mu_y))
+        _log_sampling_timing(inference, distribution, traces, 0.0, time.time() - start_time)
+        return traces, n_x, n_y, mu_x, mu_y
+
     if distribution == 'normal':
         fit_data = {'Nc': n_y,
                     'Nt': n_x,
@@ -209,22 +483,22 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
     elif distribution == 'poisson':
         fit_data = {'Nc': n_y,
                     'Nt': n_x,
-                    'x': _x.astype(int),
-                    'y': _y.astype(int)}
+                    'x': _count_data(_x),
+                    'y': _count_data(_y)}
     else:
         raise NotImplementedError
 
-    model_file = __location__ + '/../models/' + distribution + '_kpi.stan'
-
-    sm = get_or_compile_stan_model(model_file, distribution)
+    sm = get_or_compile_stan_model(_stan_model_file(distribution), distribution)
+    model_time = time.time() - start_time
 
     if inference == "sampling":
-        fit = sm.sampling(data=fit_data, iter=num_iters, chains=4, n_jobs=1, seed=1,
-                          control={'stepsize': 0.01, 'adapt_delta': 0.99})
+        sampling_args = {} if warmup is None else {'warmup': warmup}
+        fit = sm.sampling(data=fit_data, iter=num_iters, chains=chains, n_jobs=n_jobs, seed=1,
+                          control=control, **sampling_args)
         traces = fit.extract()
 
     elif inference == "variational":
-        results_dict = sm.vb(data=fit_data, iter=10000)
+        results_dict = sm.vb(data=fit_data, iter=10000, seed=1)
         traces = {}
         for i in range(len(results_dict['sampler_param_names'])):
             para_name = results_dict['sampler_param_names'][i]
@@ -232,23 +506,189 @@ def _bayes_sampling(x, y, distribution='normal', num_iters=25000, inference="sam
             traces[para_name] = para_values
 
     if cache_sampling_results:
-        sampling_results[key] = (traces, n_x, n_y, mu_x, mu_y)
+        sampling_results.put(key, (_copy_traces(traces), n_x, n_y, mu_x, mu_y))
+    _log_sampling_timing(inference, distribution, traces, model_time, time.time() - start_time - model_time,
+                         chains=chains, n_jobs=n_jobs, num_iters=num_iters, warmup=warmup)
 
     logger.info("Finished running bayesian inference with {} procedure, treatment group of size {}, "
                 "control group of size {}, {} distribution.".format(inference, len(x), len(y), distribution))
     return traces, n_x, n_y, mu_x, mu_y
 
 
-def make_bayes_factor(distribution='normal', num_iters=25000, inference='sampling'):
+def _copy_traces(traces):
+    """ Copies the traces of a posterior, so that callers changing them do not change the cached posterior. """
+    return dict((name, np.array(values)) for name, values in traces.items())
+
+
+def _posterior_cache_key(x, y, distribution, **settings):
+    """ Content hash of the samples, the distribution and the settings of a bayesian inference.
+
+    :param x: sample of a treatment group without nans
+    :type  x: np.ndarray
+    :param y: sample of a control group without nans
+    :type  y: np.ndarray
+    :param distribution: name of the KPI distribution model
+    :type  distribution: str
+    :param settings: settings of the inference, with values having a deterministic repr
+
+    :return: hexadecimal sha256 digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for sample in (x, y):
+        sample = np.ascontiguousarray(sample, dtype=np.float64)
+        # the length separates the bytes of the two samples
+        digest.update('{};'.format(len(sample)).encode('utf-8'))
+        digest.update(sample.tobytes())
+    digest.update(repr((distribution, sorted(settings.items()))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _log_sampling_timing(inference, distribution, traces, model_time, inference_time, **settings):
+    """ Logs how long loading the model and the inference took, and how many posterior samples were drawn per second.
+
+    :param inference: inference method
+    :type  inference: str
+    :param distribution: name of the KPI distribution model
+    :type  distribution: str
+    :param traces: posterior samples
+    :type  traces: dict
+    :param model_time: seconds for loading or compiling the Stan model
+    :type  model_time: float
+    :param inference_time: seconds for the inference
+    :type  inference_time: float
+    :param settings: settings of the sampler to include in the summary
+    """
+    num_samples = len(traces['delta'])
+    logger.info("Timing of {} inference for {} distribution: model {:.3f}s, inference {:.3f}s, "
+                "{} posterior samples ({:.0f} per second){}".format(
+                    inference, distribution, model_time, inference_time, num_samples,
+                    num_samples / inference_time if inference_time > 0 else float('inf'),
+                    ''.join(', {} {}'.format(name, settings[name]) for name in sorted(settings))))
+
+
+def _conjugate_posterior_samples(x, y, distribution, num_samples):
+    """ Draws samples of the posterior of the parameters of the KPI distribution model, 
+    computed in closed form from the sufficient statistics of the samples.
+    
+    For the normal model, x ~ normal(mu+delta, sigma) and y ~ normal(mu, sigma) with flat priors of mu and log(sigma)
+    and the normal(0, 1) prior of the normalized effect size alpha = delta / sigma, 
+    the conjugate counterpart of the cauchy(0, 1) prior of the Stan model:
+    sigma^2 follows a scaled inverse chi-square distribution with n_x+n_y-1 degrees of freedom, 
+    and given sigma delta is normal around the shrunk difference of means.
+    For the poisson model, x ~ poisson(lambda+delta) and y ~ poisson(lambda), 
+    the rates of both groups have independent gamma(2, 2) priors as lambda in the Stan model.
+    The prior densities of the normalized effect size at zero are given by _conjugate_prior_density_at_zero.
+
+    :param x: sample of a treatment group without nans
+    :type  x: np.ndarray
+    :param y: sample of a control group without nans
+    :type  y: np.ndarray
+    :param distribution: name of the KPI distribution model, 'normal' or 'poisson'
+    :type  distribution: str
+    :param num_samples: number of posterior samples
+    :type  num_samples: int
+
+    :return: posterior samples of the parameters of the model, with the same names as in the Stan model
+    :rtype:  dict
+    """
+    random_state = np.random.RandomState(1)
+
+    if distribution == 'normal':
+        n_x, n_y = len(x), len(y)
+        degrees_of_freedom = n_x + n_y - 1
+        if n_x < 1 or n_y < 1 or degrees_of_freedom < 2:
+            raise ValueError('Please provide samples with more than two entities in total.')
+
+        mean_x, mean_y = np.mean(x), np.mean(y)
+        difference = mean_x - mean_y
+        # variance of the difference of means in units of sigma^2
+        scale = 1.0 / n_x + 1.0 / n_y
+        squared_deviations = np.sum((x - mean_x) ** 2) + np.sum((y - mean_y) ** 2) + difference ** 2 / (1.0 + scale)
+
+        sigma = np.sqrt(squared_deviations / random_state.chisquare(degrees_of_freedom, num_samples))
+        delta = random_state.normal(difference / (1.0 + scale), sigma * np.sqrt(scale / (1.0 + scale)))
+        mu = random_state.normal((n_x * (mean_x - delta) + n_y * mean_y) / (n_x + n_y), sigma / np.sqrt(n_x + n_y))
+        return {'mu': mu, 'sigma': sigma, 'alpha': delta / sigma, 'delta': delta}
+
+    elif distribution == 'poisson':
+        shape, rate = CONJUGATE_POISSON_PRIOR
+        # the gamma update only needs the sums, so scaled counts of derived KPIs are used as they are
+        lambda_x = random_state.gamma(shape + np.sum(_non_negative_data(x)), 1.0 / (rate + len(x)), num_samples)
+        lambda_y = random_state.gamma(shape + np.sum(_non_negative_data(y)), 1.0 / (rate + len(y)), num_samples)
+        return {'lambda': lambda_y, 'delta': lambda_x - lambda_y}
+
+    else:
+        raise NotImplementedError
+
+
+def _conjugate_prior_density_at_zero(distribution, traces):
+    """ Prior density at zero of the normalized effect size of the conjugate model (see _conjugate_posterior_samples),
+    which is the denominator of the Savage-Dickey ratio of the Bayes factor.
+
+    For the normal model alpha has a normal(0, 1) prior. For the poisson model delta, the difference of 
+    two independent gamma(shape, rate) rates, has the density rate * gamma(2*shape-1) / (gamma(shape)^2 * 2^(2*shape-1))
+    at zero, which is scaled as delta in get_trace_normalized_effect_size.
+
+    :param distribution: name of the KPI distribution model, 'normal' or 'poisson'
+    :type  distribution: str
+    :param traces: posterior samples of the conjugate model
+    :type  traces: dict
+
+    :return: prior density at zero
+    :rtype:  float
+    """
+    if distribution == 'normal':
+        return norm.pdf(0, loc=0, scale=1)
+    elif distribution == 'poisson':
+        shape, rate = CONJUGATE_POISSON_PRIOR
+        density_of_delta = rate * gamma_function(2 * shape - 1) / (gamma_function(shape) ** 2 * 2 ** (2 * shape - 1))
+        return density_of_delta * np.sqrt(np.absolute(np.nanmean(np.array(traces['delta']))))
+    else:
+        raise NotImplementedError
+
+
+def _non_negative_data(x):
+    """ Checks that a sample of the poisson model has no negative values.
+
+    :param x: sample without nans
+    :type  x: np.ndarray
+
+    :return: the sample
+    :rtype:  np.ndarray
+    """
+    if np.any(x < 0):
+        raise ValueError('Please provide samples of non-negative values for the poisson distribution.')
+    return x
+
+
+def _count_data(x):
+    """ Counts of a sample of the poisson model as integers, as required by the Stan model.
+    Non-integer values, e.g. the counts of a derived KPI divided by the mean denominator, are truncated.
+
+    :param x: sample without nans
+    :type  x: np.ndarray
+
+    :return: the sample as integers
+    :rtype:  np.ndarray
+    """
+    if np.any(_non_negative_data(x) != np.floor(x)):
+        logger.warning("Truncating the non-integer values of the sample for the poisson model.")
+    return x.astype(int)
+
+
+def make_bayes_factor(distribution='normal', num_iters=25000, inference='sampling',
+                      chains=4, n_jobs=1, warmup=None, control=None, credible_mass=0.95):
     """ Closure method for the bayes_factor"""
     def f(x, y, x_denominators = 1, y_denominators = 1):
         x = x / np.nanmean(x_denominators)
         y = y / np.nanmean(y_denominators)
-        return bayes_factor(x, y, distribution, num_iters, inference)
+        return bayes_factor(x, y, distribution, num_iters, inference, chains, n_jobs, warmup, control, credible_mass)
     return f
 
 
-def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampling'):
+def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampling',
+                 chains=4, n_jobs=1, warmup=None, control=None, credible_mass=0.95):
     """ Bayes factor computation.
 
     :param x: sample of a treatment group
@@ -259,8 +699,19 @@ def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampli
     :type  distribution: str
     :param num_iters: number of iterations of bayes sampling
     :type  num_iters: int
-    :param inference: sampling or variational inference method for approximation the posterior
+    :param inference: sampling or variational inference method for approximation the posterior, 
+                      or 'conjugate' for the closed form posterior of conjugate priors
     :type  inference: str
+    :param chains: number of MCMC chains
+    :type  chains: int
+    :param n_jobs: number of processes running the chains, -1 for all CPUs
+    :type  n_jobs: int
+    :param warmup: number of warmup iterations per chain, by default half of num_iters
+    :type  warmup: int
+    :param control: settings of the sampler (e.g. adapt_delta, stepsize), DEFAULT_SAMPLING_CONTROL by default
+    :type  control: dict
+    :param credible_mass: credible mass of the credible interval, or a list of credible masses of several intervals
+    :type  credible_mass: float or list[float]
 
     :return: results of type EarlyStoppingTestStatistics (without p-value and stat. power)
     :rtype:  EarlyStoppingTestStatistics
@@ -270,21 +721,20 @@ def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampli
                 "control group of size {}, {} distribution.".format(len(x), len(y), distribution, inference))
 
     traces, n_x, n_y, mu_x, mu_y = _bayes_sampling(x, y, distribution=distribution, num_iters=num_iters,
-                                                   inference=inference)
+                                                   inference=inference, chains=chains, n_jobs=n_jobs,
+                                                   warmup=warmup, control=control)
     trace_normalized_effect_size = get_trace_normalized_effect_size(distribution, traces)
     trace_absolute_effect_size = traces['delta']
 
-    kde = gaussian_kde(trace_normalized_effect_size)
-    prior = cauchy.pdf(0, loc=0, scale=1)
+    if inference == 'conjugate':
+        prior = _conjugate_prior_density_at_zero(distribution, traces)
+    else:
+        prior = cauchy.pdf(0, loc=0, scale=1)
     # BF_01
-    bf = kde.evaluate(0)[0] / prior
+    bf = kernel_density(trace_normalized_effect_size, 0) / prior
     stop = bf > 3 or bf < 1 / 3.
 
-    credible_mass = 0.95
-    left_out      = 1.0 - credible_mass
-    p1            = round(left_out/2.0, 5)
-    p2            = round(1.0 - left_out/2.0, 5)
-    credible_interval = HDI_from_MCMC(trace_absolute_effect_size, credible_mass)
+    credible_intervals = _credible_interval_percentiles(trace_absolute_effect_size, credible_mass)
 
     treatment_statistics = SampleStatistics(int(n_x), float(mu_x), float(np.nanvar(x)))
     control_statistics   = SampleStatistics(int(n_y), float(mu_y), float(np.nanvar(y)))
@@ -296,20 +746,23 @@ def bayes_factor(x, y, distribution='normal', num_iters=25000, inference='sampli
     return EarlyStoppingTestStatistics(variant_statistics.control_statistics,
                                        variant_statistics.treatment_statistics,
                                        float(mu_x - mu_y),
-                                       dict([(p*100, v) for p, v in zip([p1, p2], credible_interval)]),
+                                       credible_intervals,
                                        None, None, stop)
 
 
-def make_bayes_precision(distribution='normal', posterior_width=0.08, num_iters=25000, inference='sampling'):
+def make_bayes_precision(distribution='normal', posterior_width=0.08, num_iters=25000, inference='sampling',
+                         chains=4, n_jobs=1, warmup=None, control=None, credible_mass=0.95):
     """ Closure method for the bayes_precision"""
     def f(x, y, x_denominators = 1, y_denominators = 1):
         x = x / np.nanmean(x_denominators)
         y = y / np.nanmean(y_denominators)
-        return bayes_precision(x, y, distribution, posterior_width, num_iters, inference)
+        return bayes_precision(x, y, distribution, posterior_width, num_iters, inference,
+                               chains, n_jobs, warmup, control, credible_mass)
     return f
 
 
-def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters=25000, inference='sampling'):
+def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters=25000, inference='sampling',
+                    chains=4, n_jobs=1, warmup=None, control=None, credible_mass=0.95):
     """ Bayes precision computation.
 
     :param x: sample of a treatment group
@@ -322,8 +775,20 @@ def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters
     :type  posterior_width: float
     :param num_iters: number of iterations of bayes sampling
     :type  num_iters: int
-    :param inference: sampling or variational inference method for approximation the posterior
+    :param inference: sampling or variational inference method for approximation the posterior, 
+                      or 'conjugate' for the closed form posterior of conjugate priors
     :type  inference: str
+    :param chains: number of MCMC chains
+    :type  chains: int
+    :param n_jobs: number of processes running the chains, -1 for all CPUs
+    :type  n_jobs: int
+    :param warmup: number of warmup iterations per chain, by default half of num_iters
+    :type  warmup: int
+    :param control: settings of the sampler (e.g. adapt_delta, stepsize), DEFAULT_SAMPLING_CONTROL by default
+    :type  control: dict
+    :param credible_mass: credible mass of the credible interval, or a list of credible masses of several intervals.
+                          The stopping criterion uses the interval of the first credible mass.
+    :type  credible_mass: float or list[float]
 
     :return: results of type EarlyStoppingTestStatistics (without p-value and stat. power)
     :rtype:  EarlyStoppingTestStatistics
@@ -333,17 +798,14 @@ def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters
                 "control group of size {}, {} distribution.".format(len(x), len(y), distribution, inference))
 
     traces, n_x, n_y, mu_x, mu_y = _bayes_sampling(x, y, distribution=distribution,
-                                                   num_iters=num_iters, inference=inference)
+                                                   num_iters=num_iters, inference=inference, chains=chains,
+                                                   n_jobs=n_jobs, warmup=warmup, control=control)
     trace_normalized_effect_size = get_trace_normalized_effect_size(distribution, traces)
     trace_absolute_effect_size = traces['delta']
 
-    credible_mass = 0.95
-    left_out      = 1.0 - credible_mass
-    p1            = round(left_out/2.0, 5)
-    p2            = round(1.0 - left_out/2.0, 5)
-
-    credible_interval_delta            = HDI_from_MCMC(trace_absolute_effect_size, credible_mass)
-    credible_interval_delta_normalized = HDI_from_MCMC(trace_normalized_effect_size, credible_mass)
+    credible_intervals_delta           = _credible_interval_percentiles(trace_absolute_effect_size, credible_mass)
+    credible_interval_delta_normalized = HDI_from_MCMC(trace_normalized_effect_size,
+                                                       np.atleast_1d(credible_mass)[0])
 
     stop = credible_interval_delta_normalized[1] - credible_interval_delta_normalized[0] < posterior_width
 
@@ -357,7 +819,7 @@ def bayes_precision(x, y, distribution='normal', posterior_width=0.08, num_iters
     return EarlyStoppingTestStatistics(variant_statistics.control_statistics,
                                        variant_statistics.treatment_statistics,
                                        float(mu_x - mu_y),
-                                       dict([(p * 100, v) for p, v in zip([p1, p2], credible_interval_delta)]),
+                                       credible_intervals_delta,
                                        None, None, stop)
 
 
@@ -385,25 +847,23 @@ def get_trace_normalized_effect_size(distribution, traces):
         raise ValueError("Model " + distribution + " is not implemented.")
 
 
-def get_or_compile_stan_model(model_file, distribution):
-    """ Creates Stan model. Compiles a Stan model and saves it to .pkl file to the folder selected by tempfile module if
-    file doesn't exist yet and load precompiled model if there is a model file in temporary dir.
+def get_or_compile_stan_model(model_file, distribution, cache_dir=None):
+    """ Creates Stan model. Loads the compiled model from the model cache, or compiles the model 
+    and saves it to the cache if it is not there yet.
     
-    Note: compiled_model_file is the hardcoded file path which may cause some issues in future.
-    There are 2 alternative implementations for Stan models handling:
-
-    1. Using global variables
-    2. Pre-compiling stan models and adding them as a part of ExpAn project
-
-    Using temporary files with tempfile module is not currently possible,
-    since it generates a unique file name which is difficult to track.
-    However, compiled modules are saved in temporary directory using tempfile module 
-    which vary based on the current platform and settings. Cleaning up a temp dir is done on boot.
+    The cached model is a .pkl file in cache_dir, the module variable stan_model_cache_dir 
+    (set from the environment variable EXPAN_STAN_MODEL_CACHE_DIR) or the temporary directory, in this order.
+    The file is named by a hash of the model source and of the pystan, python and compiler versions, 
+    so that a changed .stan file or an upgraded toolchain never loads a stale model.
+    A model is compiled by one process at a time under a file lock, 
+    and written to a temporary file which is then renamed, so that concurrent workers never read a partial file.
 
     :param model_file: model file location
     :type  model_file: str
     :param distribution: name of the KPI distribution model, which assumes a Stan model file with the same name exists
     :type  distribution: str
+    :param cache_dir: directory of the compiled models
+    :type  cache_dir: str
 
     :return: compiled Stan model for the selected distribution or normal distribution as a default option
     :rtype:  Class representing a compiled Stan model
@@ -411,17 +871,102 @@ def get_or_compile_stan_model(model_file, distribution):
 
     logger.info("Started loading and compiling Stan model for {} distribution".format(distribution))
 
-    if distribution is not 'normal' and distribution is not 'poisson':
+    if distribution != 'normal' and distribution != 'poisson':
         raise ValueError("Model " + distribution + " is not implemented.")
 
-    python_version = '{0[0]}.{0[1]}'.format(sys.version_info)
-    compiled_model_file = tempfile.gettempdir() + '/expan_early_stop_compiled_stan_model_' \
-                                                + distribution + '_' + python_version + '.pkl'
-
-    if os.path.isfile(compiled_model_file):
-        sm = pickle.load(open(compiled_model_file, 'rb'))
-    else:
-        sm = StanModel(file=model_file)
-        with open(compiled_model_file, 'wb') as f:
-            pickle.dump(sm, f)
+    with open(model_file) as f:
+        model_code = f.read()
+    cache_dir = cache_dir or stan_model_cache_dir or tempfile.gettempdir()
+    try:
+        os.makedirs(cache_dir)
+    except OSError:  # the directory exists, e.g. created by a concurrent worker
+        if not os.path.isdir(cache_dir):
+            raise
+    compiled_model_file = join(cache_dir, 'expan_early_stop_compiled_stan_model_{}_{}.pkl'.format(
+        distribution, _stan_model_hash(model_code)))
+
+    sm = _load_stan_model(compiled_model_file)
+    if sm is not None:
+        return sm
+
+    with _exclusive_lock(compiled_model_file + '.lock'):
+        # another process may have compiled the model while we were waiting for the lock
+        sm = _load_stan_model(compiled_model_file)
+        if sm is None:
+            logger.info("Compiling Stan model for {} distribution to {}".format(distribution, compiled_model_file))
+            sm = StanModel(model_code=model_code, model_name=distribution + '_kpi')
+            _atomic_pickle_dump(sm, compiled_model_file)
     return sm
+
+
+def compile_stan_models(distributions=('normal', 'poisson'), cache_dir=None):
+    """ Compiles the Stan models of the given distributions into the model cache, e.g. when building an image:
+    
+        python -c "import expan.core.early_stopping as es; es.compile_stan_models()"
+
+    :param distributions: names of the KPI distribution models
+    :type  distributions: list[str]
+    :param cache_dir: directory of the compiled models (see get_or_compile_stan_model)
+    :type  cache_dir: str
+    """
+    for distribution in distributions:
+        get_or_compile_stan_model(_stan_model_file(distribution), distribution, cache_dir)
+
+
+def _stan_model_file(distribution):
+    """ Location of the Stan model file of a KPI distribution. """
+    return __location__ + '/../models/' + distribution + '_kpi.stan'
+
+
+def _stan_model_hash(model_code):
+    """ Hash of a Stan model source and of the versions of the tools compiling it.
+
+    :param model_code: source of the Stan model
+    :type  model_code: str
+
+    :return: hexadecimal sha256 digest
+    :rtype: str
+    """
+    toolchain = [getattr(pystan, '__version__', ''),
+                 '{0[0]}.{0[1]}'.format(sys.version_info),
+                 platform.python_compiler(),
+                 os.environ.get('CC') or sysconfig.get_config_var('CC') or '']
+    content = '\n'.join([model_code] + toolchain)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _load_stan_model(compiled_model_file):
+    """ Loads a compiled Stan model, or returns None if the file does not exist or cannot be read. """
+    if not os.path.isfile(compiled_model_file):
+        return None
+    try:
+        with open(compiled_model_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        logger.warning("Cannot load compiled Stan model {}: {}".format(compiled_model_file, e))
+        return None
+
+
+def _atomic_pickle_dump(obj, file_name):
+    """ Pickles an object to a temporary file in the target directory and renames it to file_name. """
+    handle, temporary_file = tempfile.mkstemp(dir=dirname(file_name), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(obj, f)
+        getattr(os, 'replace', os.rename)(temporary_file, file_name)
+    except Exception:
+        os.remove(temporary_file)
+        raise
+
+
+@contextmanager
+def _exclusive_lock(lock_file):
+    """ Holds an exclusive lock of the given file, if file locking is supported. """
+    with open(lock_file, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -4,12 +4,20 @@ import warnings
 import numpy as np
 import pandas as pd
 import copy
+from collections import OrderedDict
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import expan.core.early_stopping as es
 import expan.core.statistics as statx
 import expan.core.correction as correction
+import expan.core.binning as binning
 from expan.core.statistical_test import *
-from expan.core.results import StatisticalTestResult, MultipleTestSuiteResult, CombinedTestStatistics
+from expan.core.results import StatisticalTestResult, MultipleTestSuiteResult, CombinedTestStatistics, \
+    OutlierFilterReport, BootstrapStatistics
+from expan.core.moments import ExperimentMoments
+from expan.core.quantile_sketch import QuantileSketch
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 logger = logging.getLogger(__name__)
@@ -32,6 +40,21 @@ class Experiment(object):
             'bayes_factor': es.make_bayes_factor,
             'bayes_precision': es.make_bayes_precision
         }
+        # test methods which can be computed from sufficient statistics of the variants
+        self.sufficient_statistics_worker_table = {
+            'fixed_horizon': statx.make_delta_from_sufficient_statistics,
+            'group_sequential': es.make_group_sequential_from_sufficient_statistics
+        }
+        # kind of pool analyzing the tests of a suite in parallel: threads for the numpy based methods,
+        # processes for the sampling based methods holding the global interpreter lock
+        self.pool_table = {
+            'fixed_horizon': ThreadPool,
+            'group_sequential': ThreadPool,
+            'bayes_factor': Pool,
+            'bayes_precision': Pool
+        }
+        # report of the last outlier filtering
+        self.outlier_filter_report = None
 
     def __str__(self):
         return 'Performing "{:s}" experiment.'.format(self.metadata['experiment'])
@@ -52,26 +75,25 @@ class Experiment(object):
         :return: statistical result of the test
         :rtype: StatisticalTestResult
         """
-        if not isinstance(test, StatisticalTest):
-            raise TypeError("Statistical test should be of type StatisticalTest.")
+        test_result, _ = self._analyze_statistical_test(test, test_method, **worker_args)
 
-        if 'entity' not in test.data.columns:
-            raise KeyError("There is no 'entity' column in the data.")
-        if test.variants.variant_column_name not in test.data.columns:
-            raise KeyError("There is no '{}' column in the data.".format(test.variants.variant_column_name))
+        # remove data from the result test metadata
+        if not include_data:
+            del test.data
+        return test_result
 
-        for feature in test.features:
-            if feature.column_name not in test.data.columns:
-                raise KeyError("Feature name '{}' does not exist in the data.".format(feature.column_name))
 
-        if type(test.kpi) is KPI and (test.kpi.name not in test.data.columns):
-            raise KeyError("There is no column of name '{}' in the data.".format(test.kpi.name))
-        if type(test.kpi) is DerivedKPI:
-            if type(test.kpi.numerator) is not str or test.kpi.numerator not in test.data.columns:
-                raise KeyError("Numerator '{}' of the derived KPI does not exist in the data.".format(test.kpi.numerator))
-            if type(test.kpi.denominator) is not str or test.kpi.denominator not in test.data.columns:
-                raise KeyError("Denominator '{}' of the derived KPI does not exist in the data.".format(test.kpi.denominator))
-            test.kpi.make_derived_kpi(test.data)
+    def _analyze_statistical_test(self, test, test_method, **worker_args):
+        """ Runs delta analysis on one statistical test and returns statistical results together with the
+        samples the analysis method was run on, so that the analysis can be repeated without filtering the data again.
+        For the bootstrap ('fixed_horizon' with assume_normal=False) the statistics of the bootstrap are returned
+        instead of the samples, so that it can be repeated without resampling.
+
+        :return: statistical result of the test and the arguments of the worker or the BootstrapStatistics,
+                 or None instead of them if the data is not valid for the analysis
+        :rtype: tuple[StatisticalTestResult, dict or BootstrapStatistics]
+        """
+        self._prepare_test(test)
 
         logger.info("One analysis with kpi '{}', control variant '{}', treatment variant '{}' and features [{}] "
                     "has just started".format(test.kpi, test.variants.control_name,
@@ -94,7 +116,7 @@ class Experiment(object):
             # non-NaN and non=Inf datapoints. See below for a check
             # of that:
             logger.warning("Data is not valid for the analysis!")
-            return test_result
+            return test_result, None
         if data_for_analysis.entity.duplicated().any():
             raise ValueError('Entities in data should be unique.')
 
@@ -112,26 +134,51 @@ class Experiment(object):
         number_of_finite_controls   = np.sum(np.isfinite( control_numerators   / control_denominators   ))
         number_of_finite_treatments = np.sum(np.isfinite( treatment_numerators / treatment_denominators ))
 
-        if number_of_finite_controls < 2 or number_of_finite_treatments < 2: return test_result
+        if number_of_finite_controls < 2 or number_of_finite_treatments < 2: return test_result, None
 
         # run the test method
-        test_statistics = worker(x=treatment_numerators, y=control_numerators, x_denominators = treatment_denominators, y_denominators = control_denominators)
+        worker_inputs = dict(x=treatment_numerators, y=control_numerators,
+                             x_denominators=treatment_denominators, y_denominators=control_denominators)
+        if test_method == 'fixed_horizon' and not worker_args.get('assume_normal', True):
+            # the bootstrap distribution does not depend on alpha and is returned instead of the samples,
+            # so that the analysis can be repeated for another alpha without resampling
+            bootstrap_statistics = statx.make_bootstrap_statistics(**worker_args)(**worker_inputs)
+            test_result.result = statx.make_delta_from_bootstrap_statistics(**worker_args)(bootstrap_statistics)
+            return test_result, bootstrap_statistics
+        test_statistics = worker(**worker_inputs)
         test_result.result = test_statistics
-
-        # remove data from the result test metadata
-        if not include_data:
-            del test.data
-        return test_result
+        return test_result, worker_inputs
 
 
-    def analyze_statistical_test_suite(self, test_suite, test_method='fixed_horizon', **worker_args):
+    def analyze_statistical_test_suite(self, test_suite, test_method='fixed_horizon', engine='per_test', n_workers=1,
+                                       **worker_args):
         """ Runs delta analysis on a set of tests and returns statistical results for each statistical test in the suite.
         
+        With engine='per_test' every test is analyzed on its own by analyze_statistical_test.
+        With engine='groupby' every data frame is grouped once by the feature columns and the variant column
+        of its tests, and the sufficient statistics of all KPIs are computed for all groups in one pass.
+        The groupby engine supports 'fixed_horizon' only.
+        
+        If a correction for multiple testing is needed, the corrected statistics are computed from the 
+        sufficient statistics of each test, or from the distribution of its bootstrap with assume_normal=False, 
+        instead of analyzing the data a second time.
+        
+        With n_workers > 1 the tests of the per_test engine are analyzed in parallel, in a pool of threads for 
+        'fixed_horizon' and 'group_sequential' and in a pool of processes for the bayes methods. 
+        Worker processes inherit the tests and their data frames when they are forked, 
+        the data is not shipped to them per test. Worker processes cannot start processes themselves, 
+        and forking from worker threads can deadlock, hence the Stan chains of the bayes methods and the bootstrap 
+        run in one process (n_jobs=1) then.
+        
         :param test_suite: a suite of statistical test to run
         :type  test_suite: StatisticalTestSuite
         :param test_method: analysis method to perform. 
                            It can be 'fixed_horizon', 'group_sequential', 'bayes_factor' or 'bayes_precision'.
         :type  test_method: str
+        :param engine: 'per_test' or 'groupby'
+        :type  engine: str
+        :param n_workers: number of threads or processes analyzing the tests of the per_test engine
+        :type  n_workers: int
         :param worker_args: additional arguments for the analysis method (see signatures of corresponding methods)
 
         :return: statistical result of the test suite
@@ -139,49 +186,41 @@ class Experiment(object):
         """
         if not isinstance(test_suite, StatisticalTestSuite):
             raise TypeError("Test suite should be of type StatisticalTestSuite.")
+        if engine not in ('per_test', 'groupby'):
+            raise ValueError("Engine needs to be either 'per_test' or 'groupby'.")
+        if n_workers < 1:
+            raise ValueError("Number of workers needs to be at least 1.")
+        if engine == 'groupby':
+            if test_method not in ['fixed_horizon']:
+                raise NotImplementedError("Test method '{}' is not supported by the groupby engine.".format(test_method))
+            worker = self.sufficient_statistics_worker_table[test_method](**worker_args)
 
         if test_method not in ['fixed_horizon', 'group_sequential']:
             test_suite.correction_method = CorrectionMethod.NONE
         requires_correction = test_suite.correction_method is not CorrectionMethod.NONE
 
-        # look up table for correction method
-        correction_table = {
-            CorrectionMethod.BONFERRONI: correction.bonferroni,
-            CorrectionMethod.BH: correction.benjamini_hochberg
-        }
-
         logger.info("Statistical test suite analysis with {} tests, testmethod {}, correction method {} "
                     "has just started".format(len(test_suite.tests), test_method, test_suite.correction_method))
 
-        # test_suite_result hold statistical results from all statistical tests
-        test_suite_result = MultipleTestSuiteResult([], test_suite.correction_method)
-        for test in test_suite.tests:
-            original_analysis = self.analyze_statistical_test(test, test_method, True, **worker_args)
-            # If the statistical power is -1 *or* if the results are None, then we don't include the analysis
-            if original_analysis.result is not None and original_analysis.result.statistical_power != -1:
-                combined_result = CombinedTestStatistics(original_analysis.result, original_analysis.result)
-                original_analysis.result = combined_result
-                test_suite_result.results.append(original_analysis)
-            else:
-                logger.warning("Analysis results are excluded from the result file because they contain Null values.")
-
-        # if correction is needed, get p values, do correction on alpha, and run the same analysis for new alpha
-        if requires_correction:
-            original_alpha    = worker_args.get('alpha', 0.05)
-            original_p_values = [item.result.original_test_statistics.p for item in test_suite_result.results
-                                 if item.result.original_test_statistics is not None]
-            corrected_alpha   = correction_table[test_suite.correction_method](original_alpha, original_p_values)
-            new_worker_args   = copy.deepcopy(worker_args)
-            new_worker_args['alpha'] = corrected_alpha
+        # intermediate statistics of each test from which the corrected statistics are computed
+        intermediate_statistics = {}
+        if engine == 'groupby':
+            sufficient_statistics = self._get_sufficient_statistics(test_suite.tests)
+            analyses = [StatisticalTestResult(test, None if moments is None else worker(*moments))
+                        for test, moments in zip(test_suite.tests, sufficient_statistics)]
+            if requires_correction:
+                intermediate_statistics = dict((id(test), moments) for test, moments
+                                               in zip(test_suite.tests, sufficient_statistics))
+        else:
+            results = self._analyze_tests(test_suite.tests, test_method, requires_correction, n_workers, worker_args)
+            analyses = []
+            for test, (result, intermediate) in zip(test_suite.tests, results):
+                analyses.append(StatisticalTestResult(test, result))
+                if intermediate is not None:
+                    intermediate_statistics[id(test)] = intermediate
 
-            for test_index, test_item in enumerate(test_suite_result.results):
-                if test_item.result.original_test_statistics:  # result can be None if not enough entities
-                    original_analysis = test_suite_result.results[test_index]
-                    corrected_analysis = self.analyze_statistical_test(test_item.test, test_method,
-                                                                       True, **new_worker_args)
-                    combined_result = CombinedTestStatistics(original_analysis.result.original_test_statistics,
-                                                             corrected_analysis.result)
-                    original_analysis.result = combined_result
+        test_suite_result = self._combine_and_correct(test_suite, analyses, intermediate_statistics, test_method,
+                                                      worker_args)
 
         logger.info("Statistical test suite analysis with {} tests, testmethod {}, correction method {} "
                     "has finished".format(len(test_suite.tests), test_method, test_suite.correction_method))
@@ -192,7 +231,136 @@ class Experiment(object):
         return test_suite_result
 
 
-    def outlier_filter(self, data, kpis, thresholds=None):
+    def analyze_feature_bins(self, data, kpis, variants, feature, n_bins, test_method='fixed_horizon',
+                             correction_method=CorrectionMethod.BH, **worker_args):
+        """ Analyzes KPIs in every bin of a feature, correcting for multiple testing across the bins.
+        The bins are created by binning.create_bins and every entity is assigned to its bin once.
+        The tests of the bins filter on the bin of every entity, which is held in the column '<feature>_bin'
+        of a copy of the data; the given data is not changed.
+        With 'fixed_horizon' all bins and KPIs are analyzed in one grouped pass (the groupby engine).
+
+        :param data: data of the experiment
+        :type  data: pd.DataFrame
+        :param kpis: KPIs to analyze
+        :type  kpis: list[KPI]
+        :param variants: variants to compare
+        :type  variants: Variants
+        :param feature: name of the feature column to bin
+        :type  feature: str
+        :param n_bins: number of bins
+        :type  n_bins: int
+        :param test_method: analysis method to perform (see analyze_statistical_test_suite)
+        :type  test_method: str
+        :param correction_method: method used for multiple testing correction
+        :type  correction_method: CorrectionMethod
+        :param worker_args: additional arguments for the analysis method (see signatures of corresponding methods)
+
+        :return: statistical results of all bins and KPIs
+        :rtype: MultipleTestSuiteResult
+        """
+        if feature not in data.columns:
+            raise KeyError("Feature name '{}' does not exist in the data.".format(feature))
+
+        bins = binning.create_bins(data[feature].values, n_bins)
+        codes = binning.assign_bins(data, feature, bins)
+        labels = [str(bin.representation) for bin in bins]
+        # rows in no bin (code -1) get the missing label None
+        bin_column = '{}_bin'.format(feature)
+        data = data.assign(**{bin_column: np.array(labels + [None], dtype=object)[codes]})
+
+        tests = [StatisticalTest(data, kpi, [FeatureFilter(bin_column, label)], variants)
+                 for kpi in kpis for label in labels]
+        engine = 'groupby' if test_method == 'fixed_horizon' else 'per_test'
+        logger.info("Analyzing {} KPIs in {} bins of feature '{}'.".format(len(kpis), len(bins), feature))
+        return self.analyze_statistical_test_suite(StatisticalTestSuite(tests, correction_method),
+                                                   test_method=test_method, engine=engine, **worker_args)
+
+
+    def analyze_moments(self, moments, test_suite, test_method='fixed_horizon', **worker_args):
+        """ Analyzes a suite of statistical tests from the moments of the KPIs in the segments of the variants,
+        without the data of the experiment, e.g. after moments.update with the entities of a new day.
+        The data of the tests is not used; every test needs a KPI and features of which moments are kept.
+        The results are the same as the ones of analyze_statistical_test_suite on the data the moments were
+        computed from, up to floating point rounding.
+
+        :param moments: moments of the KPIs of the tests
+        :type  moments: ExperimentMoments
+        :param test_suite: a suite of statistical test to run
+        :type  test_suite: StatisticalTestSuite
+        :param test_method: analysis method to perform. It can be 'fixed_horizon' or 'group_sequential'.
+        :type  test_method: str
+        :param worker_args: additional arguments for the analysis method (see signatures of corresponding methods)
+
+        :return: statistical result of the test suite
+        :rtype: MultipleTestSuiteResult
+        """
+        if not isinstance(moments, ExperimentMoments):
+            raise TypeError("Moments should be of type ExperimentMoments.")
+        if not isinstance(test_suite, StatisticalTestSuite):
+            raise TypeError("Test suite should be of type StatisticalTestSuite.")
+        if test_method not in self.sufficient_statistics_worker_table:
+            raise NotImplementedError("Test method '{}' cannot be analyzed from moments.".format(test_method))
+        worker = self.sufficient_statistics_worker_table[test_method](**worker_args)
+
+        logger.info("Analysis of {} tests from the moments of {} rows, testmethod {}, correction method {} "
+                    "has just started".format(len(test_suite.tests), moments.rows, test_method,
+                                              test_suite.correction_method))
+        sufficient_statistics = [moments.get_sufficient_statistics(test, test_method) for test in test_suite.tests]
+        analyses = [StatisticalTestResult(test, None if test_moments is None else worker(*test_moments))
+                    for test, test_moments in zip(test_suite.tests, sufficient_statistics)]
+        intermediate_statistics = dict((id(test), test_moments) for test, test_moments
+                                       in zip(test_suite.tests, sufficient_statistics))
+        test_suite_result = self._combine_and_correct(test_suite, analyses, intermediate_statistics, test_method,
+                                                      worker_args)
+
+        # remove data from the results
+        for test_result in test_suite_result.results:
+            del test_result.test.data
+        return test_suite_result
+
+
+    def analyze_chunks(self, chunks, test_suite, test_method='fixed_horizon', **worker_args):
+        """ Analyzes a suite of statistical tests on data given in chunks, e.g. by pandas.read_csv(..., chunksize=...)
+        or the get_data_chunks functions of the data fetchers, for data which does not fit into memory.
+        The chunks are read once; only the moments of the KPIs in the segments of the variants (see ExperimentMoments)
+        are kept, for all KPIs and feature columns of the tests. The data of the tests is not used.
+        The results are the same as the ones of analyze_statistical_test_suite on the whole data,
+        up to floating point rounding.
+        Every entity has to be in one chunk only: duplicated entities in different chunks cannot be detected.
+
+        :param chunks: chunks of the data
+        :type  chunks: iterable of pd.DataFrame
+        :param test_suite: a suite of statistical test to run
+        :type  test_suite: StatisticalTestSuite
+        :param test_method: analysis method to perform. It can be 'fixed_horizon' or 'group_sequential'.
+        :type  test_method: str
+        :param worker_args: additional arguments for the analysis method (see signatures of corresponding methods)
+
+        :return: statistical result of the test suite
+        :rtype: MultipleTestSuiteResult
+        """
+        if not isinstance(test_suite, StatisticalTestSuite):
+            raise TypeError("Test suite should be of type StatisticalTestSuite.")
+        if test_method not in self.sufficient_statistics_worker_table:
+            raise NotImplementedError("Test method '{}' cannot be analyzed from chunks.".format(test_method))
+
+        kpis, features = OrderedDict(), OrderedDict()
+        for test in test_suite.tests:
+            kpis.setdefault(test.kpi.name, test.kpi)
+            for feature in test.features:
+                features[feature.column_name] = True
+        variant_column_name = test_suite.tests[0].variants.variant_column_name if test_suite.tests else 'variant'
+        moments = ExperimentMoments(list(kpis.values()), variant_column_name, list(features.keys()))
+
+        for index, chunk in enumerate(chunks):
+            if 'entity' in chunk.columns and chunk.entity.duplicated().any():
+                raise ValueError('Entities in data should be unique.')
+            moments.add(chunk)
+            logger.info("Added chunk {} with {} rows to the moments of {} KPIs.".format(index, len(chunk), len(kpis)))
+        return self.analyze_moments(moments, test_suite, test_method, **worker_args)
+
+
+    def outlier_filter(self, data, kpis, thresholds=None, return_mask=False, sketches=None):
         """ Method that filters out entities whose KPIs exceed the value at a given percentile.
         If any of the KPIs exceeds its threshold the entity is filtered out. 
         If kpis contains derived kpi, this method will first create these columns,
@@ -202,8 +370,15 @@ class Experiment(object):
         :type  kpis: list[KPI]
         :param thresholds: dict of thresholds mapping KPI names to (type, percentile) tuples
         :type  thresholds: dict
-
-        :return: Will return data with filtered outliers.
+        :param return_mask: True to return a boolean mask of the entities to keep instead of the filtered data
+        :type  return_mask: bool
+        :param sketches: dict mapping KPI names to quantile sketches of the whole data (see quantile_sketch.sketch_kpis),
+                         to filter a chunk of the data with the thresholds of the whole data
+        :type  sketches: dict
+
+        :return: Will return data with filtered outliers, or the mask selecting them if return_mask is True.
+                 The thresholds and numbers of filtered entities are kept in the OutlierFilterReport 
+                 self.outlier_filter_report.
         """
         # check if provided KPIs are present in the data
         for kpi in kpis:
@@ -234,25 +409,292 @@ class Experiment(object):
                 raise ValueError("Percentile value needs to be between 0.0 and 100.0!")
 
         # run quantile filtering
-        flags = self._quantile_filtering(data=data,
-                                         kpis=[kpi.name for kpi in kpis],
-                                         thresholds=thresholds)
-        # log which columns were filtered and how many entities were filtered out
-        self.metadata['filtered_columns'] = [kpi.name for kpi in kpis]
-        self.metadata['filtered_entities_number'] = len(flags[flags == True])
-
-        filtered = [item[1] for item in list(zip(flags, data['variant'])) if item[0] == True]
-        self.metadata['filtered_entities_per_variant'] = dict((val, filtered.count(val)) for val in set(filtered))
-
+        threshold_values = self._quantile_thresholds(data=data,
+                                                     kpis=[kpi.name for kpi in kpis],
+                                                     thresholds=thresholds,
+                                                     sketches=sketches)
+        flags = self._flag_outliers(data, threshold_values)
+
+        # report which columns were filtered, with which thresholds, and how many entities were filtered out
+        filtered_per_variant = data['variant'][flags.values].value_counts()
+        self.outlier_filter_report = OutlierFilterReport(
+            filtered_columns=[kpi.name for kpi in kpis],
+            thresholds=dict((kpi, {'kind': kind, 'percentile': percentile, 'lower': lower, 'upper': upper})
+                            for kpi, (kind, percentile, lower, upper) in threshold_values.items()),
+            entities_number=len(data),
+            filtered_entities_number=int(flags.sum()),
+            filtered_entities_per_variant=dict((variant, int(number))
+                                               for variant, number in filtered_per_variant.items() if number > 0))
+        logger.info("Outlier filtering removed {} of {} entities.".format(
+            self.outlier_filter_report.filtered_entities_number, self.outlier_filter_report.entities_number))
+
+        self.metadata['filtered_columns'] = self.outlier_filter_report.filtered_columns
+        self.metadata['filtered_entities_number'] = self.outlier_filter_report.filtered_entities_number
+        self.metadata['filtered_entities_per_variant'] = self.outlier_filter_report.filtered_entities_per_variant
         self.metadata['filtered_threshold_kind'] = 'various'
         # throw warning if too many entities have been filtered out
-        if (len(flags[flags == True]) / float(len(data))) > 0.02:
+        if self.outlier_filter_report.filtered_fraction > 0.02:
             warnings.warn('More than 2% of entities have been filtered out, consider adjusting the percentile value.')
             logger.warning('More than 2% of entities have been filtered out, consider adjusting the percentile value.')
-        return data[flags == False]
+        if return_mask:
+            return ~flags
+        return data[~flags]
 
 
     # ----- below are helper methods ----- #
+    def _prepare_test(self, test):
+        """ Checks that the data of a statistical test contains all needed columns and creates 
+        the column of a derived KPI.
+        
+        :param test: a statistical test to check
+        :type  test: StatisticalTest
+        """
+        if not isinstance(test, StatisticalTest):
+            raise TypeError("Statistical test should be of type StatisticalTest.")
+
+        if 'entity' not in test.data.columns:
+            raise KeyError("There is no 'entity' column in the data.")
+        if test.variants.variant_column_name not in test.data.columns:
+            raise KeyError("There is no '{}' column in the data.".format(test.variants.variant_column_name))
+
+        for feature in test.features:
+            if feature.column_name not in test.data.columns:
+                raise KeyError("Feature name '{}' does not exist in the data.".format(feature.column_name))
+
+        if type(test.kpi) is KPI and (test.kpi.name not in test.data.columns):
+            raise KeyError("There is no column of name '{}' in the data.".format(test.kpi.name))
+        if type(test.kpi) is DerivedKPI:
+            if type(test.kpi.numerator) is not str or test.kpi.numerator not in test.data.columns:
+                raise KeyError("Numerator '{}' of the derived KPI does not exist in the data.".format(test.kpi.numerator))
+            if type(test.kpi.denominator) is not str or test.kpi.denominator not in test.data.columns:
+                raise KeyError("Denominator '{}' of the derived KPI does not exist in the data.".format(test.kpi.denominator))
+            test.kpi.make_derived_kpi(test.data)
+
+
+    def _combine_and_correct(self, test_suite, analyses, intermediate_statistics, test_method, worker_args):
+        """ Collects the results of the tests of a suite and corrects them for multiple testing.
+        
+        :param test_suite: the analyzed suite of statistical tests
+        :type  test_suite: StatisticalTestSuite
+        :param analyses: result of every test
+        :type  analyses: list[StatisticalTestResult]
+        :param intermediate_statistics: intermediate statistics (see _get_intermediate_statistics) by id of the test
+        :type  intermediate_statistics: dict
+        
+        :return: statistical result of the test suite
+        :rtype: MultipleTestSuiteResult
+        """
+        requires_correction = test_suite.correction_method is not CorrectionMethod.NONE
+
+        # look up table for correction method
+        correction_table = {
+            CorrectionMethod.BONFERRONI: correction.bonferroni,
+            CorrectionMethod.BH: correction.benjamini_hochberg
+        }
+
+        # test_suite_result hold statistical results from all statistical tests
+        test_suite_result = MultipleTestSuiteResult([], test_suite.correction_method)
+        for original_analysis in analyses:
+            # If the statistical power is -1 *or* if the results are None, then we don't include the analysis
+            if original_analysis.result is not None and original_analysis.result.statistical_power != -1:
+                combined_result = CombinedTestStatistics(original_analysis.result, original_analysis.result)
+                original_analysis.result = combined_result
+                test_suite_result.results.append(original_analysis)
+            else:
+                logger.warning("Analysis results are excluded from the result file because they contain Null values.")
+
+        # if correction is needed, get p values, do correction on alpha, and compute the statistics for new alpha
+        if requires_correction:
+            original_alpha    = worker_args.get('alpha', 0.05)
+            original_p_values = [item.result.original_test_statistics.p for item in test_suite_result.results
+                                 if item.result.original_test_statistics is not None]
+            corrected_alpha   = correction_table[test_suite.correction_method](original_alpha, original_p_values)
+            new_worker_args   = copy.deepcopy(worker_args)
+            new_worker_args['alpha'] = corrected_alpha
+
+            for test_index, test_item in enumerate(test_suite_result.results):
+                if test_item.result.original_test_statistics:  # result can be None if not enough entities
+                    original_analysis = test_suite_result.results[test_index]
+                    intermediate = intermediate_statistics[id(test_item.test)]
+                    if isinstance(intermediate, BootstrapStatistics):
+                        corrected_worker = statx.make_delta_from_bootstrap_statistics(**new_worker_args)
+                        corrected_result = corrected_worker(intermediate)
+                    else:
+                        corrected_worker = self.sufficient_statistics_worker_table[test_method](**new_worker_args)
+                        corrected_result = corrected_worker(*intermediate)
+                    combined_result = CombinedTestStatistics(original_analysis.result.original_test_statistics,
+                                                             corrected_result)
+                    original_analysis.result = combined_result
+        return test_suite_result
+
+
+    def _analyze_tests(self, tests, test_method, requires_correction, n_workers, worker_args):
+        """ Analyzes several statistical tests, in parallel if n_workers > 1.
+        
+        :return: for every test its statistical result and, if requires_correction, 
+                 its intermediate statistics (see _get_intermediate_statistics)
+        :rtype: list[tuple]
+        """
+        if n_workers == 1 or len(tests) <= 1:
+            return [_analyze_test(self, test, test_method, requires_correction, worker_args) for test in tests]
+
+        if test_method not in self.pool_table:
+            raise NotImplementedError("Test method '{}' is not implemented.".format(test_method))
+        # derived KPI columns are created before the tests share their data frames
+        for test in tests:
+            self._prepare_test(test)
+
+        logger.info("Analyzing {} tests in {} workers.".format(len(tests), n_workers))
+        pool_type = self.pool_table[test_method]
+        # forking the processes of Stan chains or of the bootstrap from worker threads can deadlock,
+        # and worker processes are daemonic and cannot start processes at all
+        if worker_args.get('n_jobs', 1) != 1:
+            logger.warning("Running the analysis of every test with n_jobs=1 in the workers.")
+            worker_args = dict(worker_args, n_jobs=1)
+        if pool_type is ThreadPool:
+            pool = ThreadPool(processes=min(n_workers, len(tests)))
+            analyze = partial(_analyze_test, self, test_method=test_method, requires_correction=requires_correction,
+                              worker_args=worker_args)
+            arguments = tests
+        else:
+            pool = pool_type(processes=min(n_workers, len(tests)), initializer=_init_suite_worker,
+                             initargs=(self, tests, test_method, requires_correction, worker_args))
+            analyze = _analyze_test_in_suite_worker
+            arguments = range(len(tests))
+        try:
+            return pool.map(analyze, arguments)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def _get_intermediate_statistics(self, test_method, worker_inputs, worker_args):
+        """ Statistics of a test from which its analysis can be repeated for another alpha.
+        These are the sufficient statistics of treatment and control, if the test method can be computed 
+        from them, or else the statistics of the bootstrap.
+        
+        :param test_method: analysis method
+        :type  test_method: str
+        :param worker_inputs: arguments the worker of the analysis method was called with, 
+                              or the statistics of the bootstrap (see _analyze_statistical_test)
+        :type  worker_inputs: dict or BootstrapStatistics
+        :param worker_args: arguments of the analysis method
+        :type  worker_args: dict
+        
+        :return: treatment and control SufficientStatistics or the BootstrapStatistics
+        :rtype: tuple or BootstrapStatistics
+        """
+        if isinstance(worker_inputs, BootstrapStatistics):
+            return worker_inputs
+
+        x, x_denominators = worker_inputs['x'], worker_inputs['x_denominators']
+        y, y_denominators = worker_inputs['y'], worker_inputs['y_denominators']
+        if test_method == 'group_sequential':
+            # the samples are scaled in the same way as in make_group_sequential
+            return (statx.compute_sufficient_statistics(x / np.nanmean(x_denominators)),
+                    statx.compute_sufficient_statistics(y / np.nanmean(y_denominators)))
+        return (statx.compute_sufficient_statistics(x, x_denominators),
+                statx.compute_sufficient_statistics(y, y_denominators))
+
+
+    def _get_sufficient_statistics(self, tests):
+        """ Computes the sufficient statistics of treatment and control of several statistical tests.
+        Tests sharing a data frame and their feature columns are computed together:
+        the data frame is grouped once by the feature columns and the variant column,
+        and the moments of every KPI are computed for all groups in one pass.
+        The same checks as in analyze_statistical_test are applied to every test.
+        
+        :param tests: statistical tests
+        :type  tests: list[StatisticalTest]
+        
+        :return: for every test a tuple of the treatment and control SufficientStatistics, 
+                 or None if the data is not valid for the analysis
+        :rtype: list[tuple]
+        """
+        for test in tests:
+            self._prepare_test(test)
+
+        # tests which can share one grouping of the data
+        tests_of_grouping = OrderedDict()
+        for index, test in enumerate(tests):
+            feature_columns = tuple(OrderedDict.fromkeys(feature.column_name for feature in test.features))
+            grouping = (id(test.data), feature_columns, test.variants.variant_column_name)
+            tests_of_grouping.setdefault(grouping, []).append(index)
+
+        result = [None] * len(tests)
+        for (_, feature_columns, variant_column), indices in tests_of_grouping.items():
+            data = tests[indices[0]].data
+            keys, codes = statx.group_codes(data, list(feature_columns) + [variant_column])
+            index_of_key = dict((key if isinstance(key, tuple) else (key,), index) for index, key in enumerate(keys))
+            group_sizes = np.bincount(codes[codes >= 0], minlength=len(keys))
+
+            # subgroups (rows with the same feature values) containing duplicated entities
+            if feature_columns:
+                subgroup_keys, subgroup_codes = statx.group_codes(data, list(feature_columns))
+                duplicated = np.array(data.duplicated(subset=list(feature_columns) + ['entity']), dtype=float)
+                in_subgroup = subgroup_codes >= 0
+                has_duplicates = np.bincount(subgroup_codes[in_subgroup], weights=duplicated[in_subgroup],
+                                             minlength=len(subgroup_keys)) > 0
+                subgroups_with_duplicates = set(key if isinstance(key, tuple) else (key,) for key, duplicates
+                                                in zip(subgroup_keys, has_duplicates) if duplicates)
+            else:
+                subgroups_with_duplicates = set([()]) if data.entity.duplicated().any() else set()
+
+            moments_of_kpi = {}
+            for index in indices:
+                test = tests[index]
+                subgroup_key = self._get_subgroup_key(test, feature_columns)
+                if subgroup_key is None:
+                    logger.warning("Data is not valid for the analysis!")
+                    continue
+                control_index   = index_of_key.get(subgroup_key + (test.variants.control_name,))
+                treatment_index = index_of_key.get(subgroup_key + (test.variants.treatment_name,))
+
+                count_controls   = 0 if control_index is None else group_sizes[control_index]
+                count_treatments = 0 if treatment_index is None else group_sizes[treatment_index]
+                if count_controls <= 1 or count_treatments <= 1:
+                    logger.warning("Data is not valid for the analysis!")
+                    continue
+                if subgroup_key in subgroups_with_duplicates:
+                    raise ValueError('Entities in data should be unique.')
+
+                kpi_key = (test.kpi.name, test.kpi.denominator if type(test.kpi) is DerivedKPI else None)
+                if kpi_key not in moments_of_kpi:
+                    moments_of_kpi[kpi_key] = self._get_sufficient_statistics_by_codes(data, test, codes, len(keys))
+                moments, number_of_finite = moments_of_kpi[kpi_key]
+
+                if number_of_finite[control_index] < 2 or number_of_finite[treatment_index] < 2:
+                    continue
+                result[index] = (moments[treatment_index], moments[control_index])
+        return result
+
+
+    def _get_subgroup_key(self, test, feature_columns):
+        """ Values of the feature columns selected by the features of a test, or None if they contradict. """
+        values = {}
+        for feature in test.features:
+            if feature.column_name in values and values[feature.column_name] != feature.column_value:
+                return None
+            values[feature.column_name] = feature.column_value
+        return tuple(values[column] for column in feature_columns)
+
+
+    def _get_sufficient_statistics_by_codes(self, data, test, codes, n_groups):
+        """ Sufficient statistics and numbers of finite values of the KPI of a test for all groups.
+        Numerators and denominators are formed in the same way as in analyze_statistical_test. """
+        if type(test.kpi) is DerivedKPI:
+            denominators = np.array(data[test.kpi.denominator], dtype=np.float64)
+        else:
+            denominators = np.ones(len(data))
+        numerators = np.array(data[test.kpi.name], dtype=np.float64) * denominators
+
+        in_group = codes >= 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            finite = np.isfinite(numerators / denominators)[in_group]
+        number_of_finite = np.bincount(codes[in_group], weights=finite, minlength=n_groups)
+        moments = statx.compute_sufficient_statistics_by_codes(numerators, codes, n_groups, denominators)
+        return moments, number_of_finite
+
     def _is_valid_for_analysis(self, data, test):
         """ Check whether the quality of data is good enough to perform analysis. Invalid cases can be:
         1. there is no data
@@ -285,76 +727,114 @@ class Experiment(object):
         return np.array(x, dtype=np.float64)
 
 
-    def _quantile_filtering(self, data, kpis, thresholds):
-        # initialize 'flags' to a boolean Series (false) with the correct index.
-        # By using the correct index, we remove the annoying warnings.
-        flags = data.index.to_series() != data.index.to_series()
-
-        from sys import float_info
-
+    def _quantile_filtering(self, data, kpis, thresholds, sketches=None):
         """ Make the filtering based on the given quantile level. 
         Filtering is performed for each kpi independently.
+        The rows are flagged by vectorized comparisons with the threshold values of _quantile_thresholds.
         
         :param kpis: the kpis to perform filtering
         :type  kpis: list[str]
         :param thresholds: dict of thresholds mapping KPI names to (type, percentile) tuples
         :type  thresholds: dict
+        :param sketches: dict of quantile sketches mapping KPI names to KPIQuantileSketch instances
+        :type  sketches: dict
 
         :return: boolean values indicating whether the row should be filtered
         :rtype: pd.Series
         """
+        threshold_values = self._quantile_thresholds(data, kpis, thresholds, sketches)
+        return self._flag_outliers(data, threshold_values)
 
-        def find_smallest(data, quantile):
-            """ Return boolean vector of data points smaller than given quantile."""
-            threshold = data.quantile(quantile)
-            return data.apply(lambda x: x < threshold)
-
-        def find_largest(data, quantile):
-            """ Return boolean vector of data points larger than given quantile."""
-            threshold = data.quantile(quantile)
-            return data.apply(lambda x: x > threshold)
-
-        def find_smallest_and_largest(data, quantile):
-            """ Return boolean vector of data points outside of the given quantile."""
-            rest = 1.0 - quantile
-            quantiles = [rest/2.0, 1.0 - rest/2.0]
-            thresholds = list(data.quantile(quantiles))
-            return data.apply(lambda x: x < thresholds[0] or x > thresholds[1])
-
-        def find_smallest_and_largest_asym(data, quantile):
-            """ Return boolen vector of data to remove such that quantile/2
-                is kept in both non-negative and non-positive subsets
-                of data."""
-            rest = 1.0 - quantile
+    def _flag_outliers(self, data, threshold_values):
+        """ Flags the rows exceeding threshold values (see _quantile_thresholds).
 
-            neg_threshold = data[data <  0.0].quantile(rest/2.0)
-            pos_threshold = data[data >= 0.0].quantile(1.0 - rest/2.0)
+        :return: boolean values indicating whether the row should be filtered
+        :rtype: pd.Series
+        """
+        flags = pd.Series(False, index=data.index)
+        for col, (threshold_type, percentile, lower, upper) in threshold_values.items():
+            if lower is not None:
+                flags |= data[col] < lower
+            if upper is not None:
+                flags |= data[col] > upper
+        return flags
 
-            return data.apply(lambda x: x < neg_threshold or x > pos_threshold)
+    def _quantile_thresholds(self, data, kpis, thresholds, sketches=None):
+        """ Computes the values below and above which the kpis are filtered, given the quantile levels.
+        The quantiles of all kpis are computed in one DataFrame.quantile call.
+        The quantiles of kpis with a sketch are taken from the sketch instead of the data.
 
-        method_table = {'upper': find_largest,
-                        'lower': find_smallest,
-                        'two-sided': find_smallest_and_largest,
-                        'two-sided-asym': find_smallest_and_largest_asym}
+        :param kpis: the kpis to perform filtering
+        :type  kpis: list[str]
+        :param thresholds: dict of thresholds mapping KPI names to (type, percentile) tuples
+        :type  thresholds: dict
+        :param sketches: dict of quantile sketches mapping KPI names to KPIQuantileSketch instances
+        :type  sketches: dict
 
+        :return: (type, percentile, lower value, upper value) tuples by kpi, where a missing bound is None
+        :rtype: OrderedDict
+        """
+        # quantile levels below and above which data points are filtered, per threshold type and quantile:
+        # 'upper' and 'lower' filter above or below the quantile, 'two-sided' outside of the given quantile,
+        # and 'two-sided-asym' keeps quantile/2 in both non-negative and non-positive subsets of data
+        level_table = {'upper': lambda quantile: (None, quantile),
+                       'lower': lambda quantile: (quantile, None),
+                       'two-sided': lambda quantile: ((1.0 - quantile)/2.0, 1.0 - (1.0 - quantile)/2.0),
+                       'two-sided-asym': lambda quantile: ((1.0 - quantile)/2.0, 1.0 - (1.0 - quantile)/2.0)}
+
+        sketches = sketches or {}
+        # the samples (columns or sketches) whose quantiles are needed, and which of them give the thresholds of each kpi
+        samples = []
+        filters = []
+        levels = set()
         for col in data[kpis].columns:
-            column = data[col].copy()
-            column.replace([np.inf, -np.inf], np.nan)
+            # Note: infinite values are kept. For compatibility this does not change the former 
+            # column.replace([np.inf, -np.inf], np.nan), which never assigned its result.
+            column = data[col]
 
             if col in thresholds:
                 threshold_type, percentile = thresholds[col]
                 quantile = percentile/100.0
             else:
                 quantile = DEFAULT_OUTLIER_QUANTILE
-                threshold_type = _choose_threshold_type(column)
+                percentile = quantile*100.0
+                threshold_type = _choose_threshold_type(column if col not in sketches else
+                                                        [sketches[col].min, sketches[col].max])
 
-            if threshold_type not in method_table:
+            if threshold_type not in level_table:
                 raise ValueError("Unknown outlier filtering method '%s'."%(threshold_type,))
+            lower_level, upper_level = level_table[threshold_type](quantile)
+
+            if threshold_type == 'two-sided-asym':
+                lower_sample, upper_sample = len(samples), len(samples) + 1
+                if col in sketches:
+                    samples += [sketches[col].negative, sketches[col].non_negative]
+                else:
+                    samples += [column.where(column < 0.0), column.where(column >= 0.0)]
             else:
-                method = method_table[threshold_type]
-                flags = flags | method(column, quantile)
-
-        return flags
+                lower_sample = upper_sample = len(samples)
+                samples.append(sketches[col].all if col in sketches else column)
+            filters.append((col, threshold_type, percentile, lower_sample, lower_level, upper_sample, upper_level))
+            levels.update(level for level in (lower_level, upper_level) if level is not None)
+
+        threshold_values = OrderedDict()
+        if not filters:
+            return threshold_values
+
+        levels = sorted(levels)
+        columns = dict((i, sample) for i, sample in enumerate(samples) if isinstance(sample, pd.Series))
+        if columns:
+            quantiles = pd.DataFrame(columns, index=data.index).quantile(levels)
+        else:
+            quantiles = pd.DataFrame(index=levels)
+        for i, sample in enumerate(samples):
+            if isinstance(sample, QuantileSketch):
+                quantiles[i] = sample.quantile(levels)
+        for col, threshold_type, percentile, lower_sample, lower_level, upper_sample, upper_level in filters:
+            lower = None if lower_level is None else float(quantiles.at[lower_level, lower_sample])
+            upper = None if upper_level is None else float(quantiles.at[upper_level, upper_sample])
+            threshold_values[col] = (threshold_type, percentile, lower, upper)
+        return threshold_values
 
     def run_goodness_of_fit_test(self, observed_freqs, expected_freqs, alpha=0.01, min_counts=5):
         """ Checks the validity of observed and expected counts and runs chi-square test for goodness of fit.
@@ -390,6 +870,35 @@ class Experiment(object):
                              "are less than 2.")
         return split_is_unbiased, p_value
 
+def _analyze_test(experiment, test, test_method, requires_correction, worker_args):
+    """ Analyzes one test of a suite.
+    
+    :return: statistical result of the test and, if requires_correction, its intermediate statistics
+    :rtype: tuple
+    """
+    analysis, worker_inputs = experiment._analyze_statistical_test(test, test_method, **worker_args)
+    intermediate = None
+    if requires_correction and worker_inputs is not None:
+        intermediate = experiment._get_intermediate_statistics(test_method, worker_inputs, worker_args)
+    return analysis.result, intermediate
+
+
+# experiment, tests and settings of the suite analyzed by the current (worker) process
+_suite_worker_arguments = None
+
+
+def _init_suite_worker(experiment, tests, test_method, requires_correction, worker_args):
+    """ Stores the tests of a suite once per process so that they are not shipped with every test. """
+    global _suite_worker_arguments
+    _suite_worker_arguments = (experiment, tests, test_method, requires_correction, worker_args)
+
+
+def _analyze_test_in_suite_worker(index):
+    """ Analyzes the test of the suite with the given index in a worker process. """
+    experiment, tests, test_method, requires_correction, worker_args = _suite_worker_arguments
+    return _analyze_test(experiment, tests[index], test_method, requires_correction, worker_args)
+
+
 def _choose_threshold_type(data):
     """ Heuristics used to decide what filtering method to use."""
     assert len(data), 'data should be non-empty'
@@ -0,0 +1,261 @@
+import logging
+
+import numpy as np
+
+import expan.core.statistics as statx
+from expan.core.results import SufficientStatistics
+from expan.core.statistical_test import DerivedKPI
+from expan.core.util import JsonSerializable
+
+logger = logging.getLogger(__name__)
+
+# test methods which can be computed from the moments
+MOMENTS_TEST_METHODS = ['fixed_horizon', 'group_sequential']
+
+
+class GroupMoments(JsonSerializable):
+    """ This class holds the moments of a KPI in a group of entities, e.g. of a segment of a variant,
+    from which 'fixed_horizon' and 'group_sequential' can be computed.
+
+    :param finite: number of entities with a finite KPI value
+    :type  finite: int
+    :param ratios: moments of the numerators and denominators of the KPI, as used by 'fixed_horizon'
+    :type  ratios: SufficientStatistics
+    :param numerators: moments of the numerators with unit denominators, as used by 'group_sequential'
+    :type  numerators: SufficientStatistics
+    :param denominators: moments of the denominators with unit denominators,
+                         whose mean scales the numerators of 'group_sequential'
+    :type  denominators: SufficientStatistics
+    """
+    def __init__(self, finite, ratios, numerators, denominators):
+        self.finite       = finite
+        self.ratios       = ratios
+        self.numerators   = numerators
+        self.denominators = denominators
+
+    def merge_with(self, group_moments):
+        """ Merges the moments of two disjoint groups of entities, e.g. of two chunks of data.
+        :param group_moments: moments of the other group
+        :type  group_moments: GroupMoments
+
+        :return merged moments
+        :rtype  GroupMoments
+        """
+        if not group_moments:
+            return GroupMoments(**self.__dict__)
+        return GroupMoments(self.finite + group_moments.finite,
+                            self.ratios.merge_with(group_moments.ratios),
+                            self.numerators.merge_with(group_moments.numerators),
+                            self.denominators.merge_with(group_moments.denominators))
+
+    def subtract(self, group_moments):
+        """ Removes the moments of a part of the group, e.g. of entities whose data was updated.
+        :param group_moments: moments of the part of the group
+        :type  group_moments: GroupMoments
+
+        :return moments of the rest of the group
+        :rtype  GroupMoments
+        """
+        if not group_moments:
+            return GroupMoments(**self.__dict__)
+        return GroupMoments(self.finite - group_moments.finite,
+                            self.ratios.subtract(group_moments.ratios),
+                            self.numerators.subtract(group_moments.numerators),
+                            self.denominators.subtract(group_moments.denominators))
+
+    def get_sufficient_statistics(self, test_method):
+        """ Moments of the group for the worker of the test method in Experiment.sufficient_statistics_worker_table.
+
+        :param test_method: 'fixed_horizon' or 'group_sequential'
+        :type  test_method: str
+
+        :return: moments of the group
+        :rtype: SufficientStatistics
+        """
+        if test_method == 'fixed_horizon':
+            return self.ratios
+        if test_method == 'group_sequential':
+            # the numerators are scaled in the same way as in make_group_sequential,
+            # i.e. by the mean of all non-NaN denominators
+            scale = self.denominators.mean_numerators
+            return SufficientStatistics(self.numerators.sample_size,
+                                        self.numerators.mean_numerators / scale,
+                                        self.numerators.mean_denominators,
+                                        self.numerators.squared_deviations_numerators / scale ** 2,
+                                        self.numerators.squared_deviations_denominators,
+                                        self.numerators.co_deviations / scale)
+        raise NotImplementedError("Test method '{}' cannot be computed from moments.".format(test_method))
+
+
+class ExperimentMoments(object):
+    """ Moments of KPIs in every segment of every variant of an experiment.
+    The moments are additive: they are updated with the rows of new or updated entities only,
+    without the rows of the other entities, and moments of parts of the data can be merged.
+    A segment is given by the values of the feature columns;
+    rows with missing feature values form segments of their own.
+    Statistical tests with FeatureFilters on any of the feature columns are analyzed
+    from the moments by Experiment.analyze_moments.
+
+    Every entity has to be added once: the moments cannot detect duplicated entities.
+    When the data of an entity changes, its previous row has to be removed (see update).
+    """
+    def __init__(self, kpis, variant_column_name='variant', features=None):
+        """
+        :param kpis: KPIs of which moments are kept
+        :type  kpis: list[KPI]
+        :param variant_column_name: name of the variant column
+        :type  variant_column_name: str
+        :param features: names of the feature columns defining the segments
+        :type  features: list[str]
+        """
+        self.kpis                = list(kpis)
+        self.variant_column_name = variant_column_name
+        self.features            = list(features or [])
+        self.rows                = 0
+        # maps the values of the feature columns and of the variant column to the moments of every KPI
+        self.moments             = {}
+
+    def add(self, data):
+        """ Adds the rows of new entities, e.g. a chunk of the data or the entities of a new day.
+
+        :param data: rows of the entities
+        :type  data: pd.DataFrame
+        """
+        self._accumulate(data, GroupMoments.merge_with)
+        self.rows += len(data)
+
+    def remove(self, data):
+        """ Removes the rows of entities which were added before.
+
+        :param data: rows of the entities, as they were added
+        :type  data: pd.DataFrame
+        """
+        self._accumulate(data, GroupMoments.subtract)
+        self.rows -= len(data)
+
+    def update(self, data, previous_data=None):
+        """ Replaces the previous rows of updated entities and adds the rows of new entities.
+
+        :param data: current rows of the new and updated entities
+        :type  data: pd.DataFrame
+        :param previous_data: previous rows of the updated entities, or None if all entities are new
+        :type  previous_data: pd.DataFrame
+        """
+        if previous_data is not None and len(previous_data) > 0:
+            self.remove(previous_data)
+        self.add(data)
+
+    def merge(self, other):
+        """ Adds the moments of other entities, e.g. moments computed by another worker.
+
+        :param other: moments of other entities of the same KPIs, variants and segments
+        :type  other: ExperimentMoments
+        """
+        if not isinstance(other, ExperimentMoments):
+            raise TypeError("Only experiment moments can be merged.")
+        if [kpi.name for kpi in other.kpis] != [kpi.name for kpi in self.kpis] or \
+                other.variant_column_name != self.variant_column_name or other.features != self.features:
+            raise ValueError("Only moments of the same KPIs, variant column and features can be merged.")
+        for key, moments_of_kpi in other.moments.items():
+            key_moments = self.moments.setdefault(key, {})
+            for name, moments in moments_of_kpi.items():
+                key_moments[name] = moments.merge_with(key_moments.get(name))
+        self.rows += other.rows
+
+    def get_group_moments(self, kpi_name, variant, features=None):
+        """ Moments of a KPI in a variant, restricted to the entities matching all features.
+
+        :param kpi_name: name of the KPI
+        :type  kpi_name: str
+        :param variant: value of the variant column
+        :type  variant: str
+        :param features: filters on the feature columns
+        :type  features: list[FeatureFilter]
+
+        :return: moments, or None if there are no such entities
+        :rtype: GroupMoments
+        """
+        if kpi_name not in [kpi.name for kpi in self.kpis]:
+            raise KeyError("There are no moments of the KPI '{}'.".format(kpi_name))
+        values = {}
+        for feature in features or []:
+            if feature.column_name not in self.features:
+                raise KeyError("There are no moments of segments of the feature '{}'.".format(feature.column_name))
+            if feature.column_name in values and values[feature.column_name] != feature.column_value:
+                return None
+            values[feature.column_name] = feature.column_value
+        positions = [(self.features.index(column), value) for column, value in values.items()]
+
+        result = None
+        for key, moments_of_kpi in self.moments.items():
+            if key[-1] == variant and all(key[position] == value for position, value in positions):
+                result = moments_of_kpi[kpi_name].merge_with(result)
+        return result
+
+    def get_sufficient_statistics(self, test, test_method):
+        """ Moments of treatment and control of a statistical test, for the worker of the test method.
+        The data of the test is not used. The same checks of the number of finite KPI values
+        as in Experiment.analyze_statistical_test are applied.
+
+        :param test: a statistical test
+        :type  test: StatisticalTest
+        :param test_method: 'fixed_horizon' or 'group_sequential'
+        :type  test_method: str
+
+        :return: treatment and control SufficientStatistics, or None if there are not enough entities
+        :rtype: tuple
+        """
+        if test.variants.variant_column_name != self.variant_column_name:
+            raise KeyError("There are no moments of the variant column '{}'.".format(test.variants.variant_column_name))
+        treatment = self.get_group_moments(test.kpi.name, test.variants.treatment_name, test.features)
+        control   = self.get_group_moments(test.kpi.name, test.variants.control_name, test.features)
+        if treatment is None or control is None or treatment.finite < 2 or control.finite < 2:
+            logger.warning("Data is not valid for the analysis!")
+            return None
+        return treatment.get_sufficient_statistics(test_method), control.get_sufficient_statistics(test_method)
+
+    def _accumulate(self, data, combine):
+        """ Combines the moments with the moments of the rows of the data. """
+        columns = self.features + [self.variant_column_name]
+        for kpi in self.kpis:
+            columns += [kpi.numerator, kpi.denominator] if type(kpi) is DerivedKPI else [kpi.name]
+        missing = [column for column in columns if column not in data.columns]
+        if missing:
+            raise KeyError("Columns {} do not exist in the data.".format(missing))
+
+        keys, codes = statx.group_codes(data, self.features + [self.variant_column_name], keep_missing=True)
+        empty = _empty_group_moments()
+        for kpi in self.kpis:
+            for key, moments in zip(keys, _get_group_moments_by_codes(data, kpi, codes, len(keys))):
+                key_moments = self.moments.setdefault(key, {})
+                key_moments[kpi.name] = combine(key_moments.get(kpi.name, empty), moments)
+
+
+def _get_group_moments_by_codes(data, kpi, codes, n_groups):
+    """ Moments of a KPI for all groups, given the group index of every row.
+    Numerators and denominators are formed in the same way as in Experiment.analyze_statistical_test. """
+    if type(kpi) is DerivedKPI:
+        denominators = np.array(data[kpi.denominator], dtype=np.float64)
+        if kpi.name in data.columns:
+            values = np.array(data[kpi.name], dtype=np.float64)
+        else:
+            values = np.array((data[kpi.numerator] / data[kpi.denominator]).astype("float64"))
+    else:
+        denominators = np.ones(len(data))
+        values = np.array(data[kpi.name], dtype=np.float64)
+    numerators = values * denominators
+
+    in_group = codes >= 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        finite = np.isfinite(numerators / denominators)[in_group]
+    number_of_finite = np.bincount(codes[in_group], weights=finite, minlength=n_groups)
+    ratios = statx.compute_sufficient_statistics_by_codes(numerators, codes, n_groups, denominators)
+    unit_numerators = statx.compute_sufficient_statistics_by_codes(numerators, codes, n_groups)
+    unit_denominators = statx.compute_sufficient_statistics_by_codes(denominators, codes, n_groups)
+    return [GroupMoments(int(number_of_finite[index]), ratios[index], unit_numerators[index], unit_denominators[index])
+            for index in range(n_groups)]
+
+
+def _empty_group_moments():
+    empty = SufficientStatistics(0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    return GroupMoments(0, empty, empty, empty)
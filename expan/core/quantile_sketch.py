@@ -0,0 +1,202 @@
+import numpy as np
+
+from expan.core.statistical_test import DerivedKPI
+
+DEFAULT_SKETCH_SIZE = 2000
+
+
+class QuantileSketch(object):
+    """ Streaming quantile sketch (KLL) of a sample which does not fit into memory.
+
+    Values are kept in compactors, one per level; a value at level h stands for 2^h values of the sample.
+    When a compactor exceeds its capacity, its sorted values are halved and every other value
+    is promoted to the next level, hence the sketch keeps about 3*k values for any size of the sample.
+    The rank error of quantiles is of the order of 1/k of the sample size;
+    the quantiles are exact as long as no compaction was needed, i.e. for less than about k values.
+    Sketches of parts of a sample can be merged, e.g. sketches computed by different workers.
+    NaNs are ignored, as by pandas.Series.quantile.
+    """
+    def __init__(self, k=DEFAULT_SKETCH_SIZE, seed=None):
+        """
+        :param k: size of the largest compactor, which controls the accuracy
+        :type  k: int
+        :param seed: seed of the random choice of values promoted by the compactions
+        :type  seed: int
+        """
+        if k < 2:
+            raise ValueError("Size of the sketch needs to be at least 2.")
+        self.k = k
+        self.count = 0
+        self.min = np.nan
+        self.max = np.nan
+        self._compactors = [np.empty(0)]
+        self._random_state = np.random.RandomState(seed)
+
+    def update(self, values):
+        """ Adds values, e.g. a column of a chunk of data, to the sketch.
+
+        :param values: values of the sample
+        :type  values: array-like
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = np.nanmin([self.min, values.min()])
+        self.max = np.nanmax([self.max, values.max()])
+        self._compactors[0] = np.concatenate([self._compactors[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """ Adds the values of another sketch to this sketch.
+
+        :param other: sketch of another part of the sample
+        :type  other: QuantileSketch
+        """
+        if not isinstance(other, QuantileSketch):
+            raise TypeError("Only quantile sketches can be merged.")
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.min = np.nanmin([self.min, other.min])
+        self.max = np.nanmax([self.max, other.max])
+        while len(self._compactors) < len(other._compactors):
+            self._compactors.append(np.empty(0))
+        for level, values in enumerate(other._compactors):
+            self._compactors[level] = np.concatenate([self._compactors[level], values])
+        self._compress()
+
+    def quantile(self, q):
+        """ Quantile of the sample, with linear interpolation as in pandas.Series.quantile.
+
+        :param q: quantile level or levels between 0 and 1
+        :type  q: float or array-like
+
+        :return: quantile, or NaN if the sketch is empty
+        :rtype: float or np.ndarray
+        """
+        levels = np.atleast_1d(np.asarray(q, dtype=float))
+        if self.count == 0:
+            result = np.empty(len(levels)) * np.nan
+        else:
+            values, weights = self._weighted_values()
+            cumulative_weights = np.cumsum(weights)
+            total = cumulative_weights[-1]
+
+            ranks = levels * (total - 1)
+            lower_ranks = np.floor(ranks)
+            fractions = ranks - lower_ranks
+            lower = values[np.searchsorted(cumulative_weights, lower_ranks, side='right')]
+            upper = values[np.searchsorted(cumulative_weights, np.minimum(lower_ranks + 1, total - 1), side='right')]
+            with np.errstate(invalid='ignore'):
+                result = np.where(fractions > 0, lower + fractions * (upper - lower), lower)
+            result = np.clip(result, self.min, self.max)
+            result[levels == 0.0] = self.min
+            result[levels == 1.0] = self.max
+
+        if np.ndim(q) == 0:
+            return float(result[0])
+        return result
+
+    def _weighted_values(self):
+        """ Sorted values of the sketch with the number of values of the sample they stand for. """
+        values = np.concatenate(self._compactors)
+        weights = np.concatenate([np.ones(len(compactor)) * 2 ** level
+                                  for level, compactor in enumerate(self._compactors)])
+        order = np.argsort(values, kind='mergesort')
+        return values[order], weights[order]
+
+    def _capacity(self, level):
+        """ Capacity of the compactor at the given level; lower levels hold fewer values. """
+        depth = len(self._compactors) - 1 - level
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def _compress(self):
+        """ Compacts every compactor exceeding its capacity. """
+        level = 0
+        while level < len(self._compactors):
+            values = self._compactors[level]
+            if len(values) > self._capacity(level):
+                values = np.sort(values)
+                # with an odd number of values, the largest one stays at this level
+                kept = values[len(values) - len(values) % 2:]
+                offset = self._random_state.randint(2)
+                promoted = values[offset:len(values) - len(values) % 2:2]
+                self._compactors[level] = kept
+                if level + 1 == len(self._compactors):
+                    self._compactors.append(np.empty(0))
+                self._compactors[level + 1] = np.concatenate([self._compactors[level + 1], promoted])
+            level += 1
+
+
+class KPIQuantileSketch(object):
+    """ Quantile sketches of a KPI for outlier filtering: one of all values, and, for the threshold type
+    'two-sided-asym', one of the negative and one of the non-negative values. """
+    def __init__(self, k=DEFAULT_SKETCH_SIZE, seed=None):
+        """
+        :param k: size of the largest compactor of the sketches (see QuantileSketch)
+        :type  k: int
+        :param seed: seed of the sketches
+        :type  seed: int
+        """
+        self.all = QuantileSketch(k, seed)
+        self.negative = QuantileSketch(k, None if seed is None else seed + 1)
+        self.non_negative = QuantileSketch(k, None if seed is None else seed + 2)
+
+    @property
+    def min(self):
+        return self.all.min
+
+    @property
+    def max(self):
+        return self.all.max
+
+    def update(self, values):
+        """ Adds values of the KPI to the sketches.
+
+        :param values: values of the KPI
+        :type  values: array-like
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        self.all.update(values)
+        self.negative.update(values[values < 0.0])
+        self.non_negative.update(values[values >= 0.0])
+
+    def merge(self, other):
+        """ Adds the values of another sketch of the KPI to this sketch.
+
+        :param other: sketch of other values of the KPI
+        :type  other: KPIQuantileSketch
+        """
+        if not isinstance(other, KPIQuantileSketch):
+            raise TypeError("Only KPI quantile sketches can be merged.")
+        self.all.merge(other.all)
+        self.negative.merge(other.negative)
+        self.non_negative.merge(other.non_negative)
+
+
+def sketch_kpis(chunks, kpis, k=DEFAULT_SKETCH_SIZE, seed=None):
+    """ Computes quantile sketches of KPIs from data given in chunks, e.g. by pandas.read_csv(..., chunksize=...).
+    The sketches can be passed to Experiment.outlier_filter to filter outliers with thresholds of the whole data.
+    Derived KPI columns are created in every chunk.
+
+    :param chunks: chunks of the data
+    :type  chunks: iterable of pd.DataFrame
+    :param kpis: KPIs to sketch
+    :type  kpis: list[KPI]
+    :param k: size of the largest compactor of the sketches (see QuantileSketch)
+    :type  k: int
+    :param seed: seed of the sketches
+    :type  seed: int
+
+    :return: sketches of the KPIs by KPI name
+    :rtype: dict
+    """
+    sketches = dict((kpi.name, KPIQuantileSketch(k, seed)) for kpi in kpis)
+    for chunk in chunks:
+        for kpi in kpis:
+            if type(kpi) is DerivedKPI:
+                kpi.make_derived_kpi(chunk)
+            sketches[kpi.name].update(chunk[kpi.name])
+    return sketches
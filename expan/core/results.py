@@ -32,6 +32,149 @@ class SampleStatistics(JsonSerializable):
         self.variance    = variance
 
 
+class SufficientStatistics(JsonSerializable):
+    """ This class holds the moments of a sample of numerators and denominators, 
+    which suffice to compute the difference of means assuming normality.
+    Non-derived KPIs have denominators of exactly 1. 
+    Only entities where both the numerator and the ratio are valid (not NaN) are included.
+    The sums of squares are taken around the means rather than around zero, 
+    so that they do not cancel out for samples with a large mean.
+    
+    :param sample_size: number of included entities
+    :type  sample_size: int
+    :param mean_numerators: mean of the numerators
+    :type  mean_numerators: float
+    :param mean_denominators: mean of the denominators
+    :type  mean_denominators: float
+    :param squared_deviations_numerators: sum of the squared deviations of the numerators from their mean
+    :type  squared_deviations_numerators: float
+    :param squared_deviations_denominators: sum of the squared deviations of the denominators from their mean
+    :type  squared_deviations_denominators: float
+    :param co_deviations: sum of the products of the deviations of numerator and denominator from their means
+    :type  co_deviations: float
+    """
+    def __init__(self, sample_size, mean_numerators, mean_denominators,
+                 squared_deviations_numerators, squared_deviations_denominators, co_deviations):
+        self.sample_size                     = sample_size
+        self.mean_numerators                 = mean_numerators
+        self.mean_denominators               = mean_denominators
+        self.squared_deviations_numerators   = squared_deviations_numerators
+        self.squared_deviations_denominators = squared_deviations_denominators
+        self.co_deviations                   = co_deviations
+
+    def merge_with(self, sufficient_statistics):
+        """ Merges the moments of two disjoint samples, e.g. of two chunks of data.
+        The means and sums of squared deviations are combined pairwise (Chan et al.).
+        :param sufficient_statistics: moments of the other sample
+        :type  sufficient_statistics: SufficientStatistics
+        
+        :return merged sufficient statistics
+        :rtype  SufficientStatistics
+        """
+        if not sufficient_statistics or sufficient_statistics.sample_size == 0:
+            return SufficientStatistics(**self.__dict__)
+        if self.sample_size == 0:
+            return SufficientStatistics(**sufficient_statistics.__dict__)
+        other = sufficient_statistics
+        n = self.sample_size + other.sample_size
+        weight = float(other.sample_size) / n
+        delta_numerators   = other.mean_numerators - self.mean_numerators
+        delta_denominators = other.mean_denominators - self.mean_denominators
+        correction = float(self.sample_size) * other.sample_size / n
+        return SufficientStatistics(n,
+                                    self.mean_numerators + delta_numerators * weight,
+                                    self.mean_denominators + delta_denominators * weight,
+                                    self.squared_deviations_numerators + other.squared_deviations_numerators +
+                                    delta_numerators ** 2 * correction,
+                                    self.squared_deviations_denominators + other.squared_deviations_denominators +
+                                    delta_denominators ** 2 * correction,
+                                    self.co_deviations + other.co_deviations +
+                                    delta_numerators * delta_denominators * correction)
+
+    def subtract(self, sufficient_statistics):
+        """ Removes the moments of a part of the sample, e.g. of entities whose data was updated.
+        This inverts merge_with.
+        :param sufficient_statistics: moments of the part of the sample
+        :type  sufficient_statistics: SufficientStatistics
+
+        :return sufficient statistics of the rest of the sample
+        :rtype  SufficientStatistics
+        """
+        if not sufficient_statistics or sufficient_statistics.sample_size == 0:
+            return SufficientStatistics(**self.__dict__)
+        part = sufficient_statistics
+        n = self.sample_size - part.sample_size
+        if n < 0:
+            raise ValueError("Cannot remove more entities than the sample holds.")
+        if n == 0:
+            return SufficientStatistics(0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        weight = float(part.sample_size) / n
+        mean_numerators   = self.mean_numerators + (self.mean_numerators - part.mean_numerators) * weight
+        mean_denominators = self.mean_denominators + (self.mean_denominators - part.mean_denominators) * weight
+        delta_numerators   = part.mean_numerators - mean_numerators
+        delta_denominators = part.mean_denominators - mean_denominators
+        correction = float(n) * part.sample_size / self.sample_size
+        return SufficientStatistics(n, mean_numerators, mean_denominators,
+                                    max(self.squared_deviations_numerators - part.squared_deviations_numerators -
+                                        delta_numerators ** 2 * correction, 0.0),
+                                    max(self.squared_deviations_denominators - part.squared_deviations_denominators -
+                                        delta_denominators ** 2 * correction, 0.0),
+                                    self.co_deviations - part.co_deviations -
+                                    delta_numerators * delta_denominators * correction)
+
+
+class PoissonBootstrapSums(JsonSerializable):
+    """ This class holds the weighted sums and the total weights of a sample for every run of a Poisson bootstrap,
+    in which every entity enters each run with a Poisson(1) distributed weight.
+    The weighted mean of a run is its sum divided by its weight.
+
+    :param sums: weighted sum of the sample per run
+    :type  sums: np.ndarray
+    :param weights: total weight of the valid (not NaN) entities per run
+    :type  weights: np.ndarray
+    """
+    def __init__(self, sums, weights):
+        self.sums    = sums
+        self.weights = weights
+
+    def merge_with(self, poisson_bootstrap_sums):
+        """ Merges the sums of two disjoint samples with the same number of runs, e.g. of two chunks of data.
+        :param poisson_bootstrap_sums: sums of the other sample
+        :type  poisson_bootstrap_sums: PoissonBootstrapSums
+
+        :return merged sums
+        :rtype  PoissonBootstrapSums
+        """
+        if len(poisson_bootstrap_sums.sums) != len(self.sums):
+            raise ValueError("Poisson bootstrap sums of {} and {} runs cannot be merged."
+                             .format(len(self.sums), len(poisson_bootstrap_sums.sums)))
+        return PoissonBootstrapSums(self.sums + poisson_bootstrap_sums.sums,
+                                    self.weights + poisson_bootstrap_sums.weights)
+
+
+class BootstrapStatistics(BaseTestStatistics):
+    """ Additionally to BaseTestStatistics, holds the statistics of a bootstrap of the difference of means
+    which do not depend on the significance level, so that the result can be computed for another alpha
+    without resampling.
+
+    :param control_statistics: sample size, mean, variance for the control group
+    :type  control_statistics: SampleStatistics
+    :param treatment_statistics: sample size, mean, variance for the treatment group
+    :type  treatment_statistics: SampleStatistics
+    :param delta: difference of means of treatment and control
+    :type  delta: float
+    :param p: p value
+    :type  p: float
+    :param bootstraps: difference of means of every bootstrap run, or None if the samples were too small
+    :type  bootstraps: np.ndarray
+    """
+    def __init__(self, control_statistics, treatment_statistics, delta, p, bootstraps):
+        super(BootstrapStatistics, self).__init__(control_statistics, treatment_statistics)
+        self.delta      = delta
+        self.p          = p
+        self.bootstraps = bootstraps
+
+
 class SimpleTestStatistics(BaseTestStatistics):
     """ Additionally to BaseTestStatistics, holds delta, confidence interval, statistical power, and p value.
     
@@ -132,3 +275,55 @@ class MultipleTestSuiteResult(JsonSerializable):
         if not multiple_test_suite_result:
             return MultipleTestSuiteResult(self.results, self.correction_method)
         return MultipleTestSuiteResult(multiple_test_suite_result.results + self.results, self.correction_method)
+
+
+# --------- Below are the data structure of outlier filtering --------- #
+class OutlierFilterReport(JsonSerializable):
+    """ This class holds what an outlier filtering did: the thresholds used for each KPI 
+    and how many entities were filtered out, in total and per variant.
+    
+    :param filtered_columns: names of the KPIs the data was filtered on
+    :type  filtered_columns: list[str]
+    :param thresholds: dict mapping KPI names to dicts with the threshold 'kind', 'percentile', 
+                       and the 'lower' and 'upper' values, where a missing bound is None
+    :type  thresholds: dict
+    :param entities_number: number of entities before filtering
+    :type  entities_number: int
+    :param filtered_entities_number: number of filtered entities
+    :type  filtered_entities_number: int
+    :param filtered_entities_per_variant: dict mapping variants to their number of filtered entities
+    :type  filtered_entities_per_variant: dict
+    """
+    def __init__(self, filtered_columns, thresholds, entities_number,
+                 filtered_entities_number, filtered_entities_per_variant):
+        self.filtered_columns              = filtered_columns
+        self.thresholds                    = thresholds
+        self.entities_number               = entities_number
+        self.filtered_entities_number      = filtered_entities_number
+        self.filtered_entities_per_variant = filtered_entities_per_variant
+
+    @property
+    def filtered_fraction(self):
+        """ Fraction of the entities that were filtered out. """
+        if self.entities_number == 0:
+            return 0.0
+        return self.filtered_entities_number / float(self.entities_number)
+
+    def merge_with(self, outlier_filter_report):
+        """ Merges the reports of filtering two disjoint chunks of data with the same thresholds, 
+        e.g. obtained from quantile sketches.
+        :param outlier_filter_report: report of filtering the other chunk
+        :type  outlier_filter_report: OutlierFilterReport
+        
+        :return merged outlier filter report
+        :rtype  OutlierFilterReport
+        """
+        if not outlier_filter_report:
+            return OutlierFilterReport(**self.__dict__)
+        per_variant = dict(self.filtered_entities_per_variant)
+        for variant, number in outlier_filter_report.filtered_entities_per_variant.items():
+            per_variant[variant] = per_variant.get(variant, 0) + number
+        return OutlierFilterReport(self.filtered_columns, self.thresholds,
+                                   self.entities_number + outlier_filter_report.entities_number,
+                                   self.filtered_entities_number + outlier_filter_report.filtered_entities_number,
+                                   per_variant)
@@ -2,28 +2,36 @@ from __future__ import division # so that, under Python 2.*, integer division re
 
 import warnings
 import logging
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
 import scipy
-from expan.core.results import BaseTestStatistics, SampleStatistics, SimpleTestStatistics
+from expan.core.results import BaseTestStatistics, BootstrapStatistics, PoissonBootstrapSums, SampleStatistics, \
+    SimpleTestStatistics, SufficientStatistics
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BOOTSTRAP_MEMORY_BUDGET = 2 ** 24  # bytes of resampled data held in memory at once by bootstrap
+BOOTSTRAP_RUNS_PER_SEED = 250              # bootstrap runs drawn from one spawned seed in seeded bootstraps
+
 
 def _delta_mean(x, y):
     """ Calculate the delta of the two groups. Implemented as function to allow being called from bootstrap. """
     return np.nanmean(x) - np.nanmean(y)
 
 
-def make_delta(assume_normal=True, alpha=0.05, min_observations=20, nruns=10000, relative=False):
+def make_delta(assume_normal=True, alpha=0.05, min_observations=20, nruns=10000, relative=False,
+               method='multinomial', n_jobs=1, seed=None):
     """ A closure to the delta function. """
     def go(x, y, x_denominators=1, y_denominators=1):
-        return delta(x, y, x_denominators, y_denominators, assume_normal, alpha, min_observations, nruns, relative)
+        return delta(x, y, x_denominators, y_denominators, assume_normal, alpha, min_observations, nruns, relative,
+                     method, n_jobs, seed)
     return go
 
 
-def delta(x, y, x_denominators=1, y_denominators=1, assume_normal=True, alpha=0.05, min_observations=20, nruns=10000, relative=False):
+def delta(x, y, x_denominators=1, y_denominators=1, assume_normal=True, alpha=0.05, min_observations=20, nruns=10000,
+          relative=False, method='multinomial', n_jobs=1, seed=None):
     """ Calculates the difference of means between the samples in a statistical sense.
     Computation is done in form of treatment minus control, i.e. x-y.
     Note that NaNs are treated as if they do not exist in the data. 
@@ -50,10 +58,80 @@ def delta(x, y, x_denominators=1, y_denominators=1, assume_normal=True, alpha=0.
             mean+ret_val[1]. This is more useful in many situations because it
             corresponds with the sem() and std() functions.
     :type: relative: boolean
+    :param method: bootstrap resampling method, 'multinomial' or 'poisson'. Only used if assume normal is false
+    :type  method: str
+    :param n_jobs: number of processes running the bootstrap. Only used if assume normal is false
+    :type  n_jobs: int
+    :param seed: seed of the bootstrap for reproducible results. Only used if assume normal is false
+    :type  seed: int
     
     :return: results of type SimpleTestStatistics
     :rtype: SimpleTestStatistics
     """
+    _x, _y, _x_denominators, _y_denominators = _prepare_samples(x, y, x_denominators, y_denominators)
+    percentiles = [alpha * 100 / 2, 100 - alpha * 100 / 2]
+
+    _x_ratio = _x / _x_denominators
+    _y_ratio = _y / _y_denominators
+    _x_strange = _x / np.nanmean(_x_denominators)
+    _y_strange = _y / np.nanmean(_y_denominators)
+
+    ss_x = sample_size(_x_ratio)
+    ss_y = sample_size(_y_ratio)
+
+    if not assume_normal:
+        bootstrap_statistics = _bootstrap_statistics(_x, _y, _x_strange, _y_strange, ss_x, ss_y, min_observations,
+                                                     nruns, method, n_jobs, seed)
+        return delta_from_bootstrap_statistics(bootstrap_statistics, alpha, relative)
+
+    # Checking if enough observations are left after dropping NaNs
+    partial_simple_test_stats = None
+    if min(ss_x, ss_y) < min_observations:
+        # Set mean to nan
+        mu = np.nan
+        # Create nan dictionary
+        c_i = dict(list(zip(percentiles, np.empty(len(percentiles)) * np.nan)))
+    else:
+        # Computing the mean
+        mu = _delta_mean(_x, _y)
+        # Computing the confidence intervals
+        logger.info("The distribution of two samples is assumed normal. "
+                    "Performing the sample difference distribution calculation.")
+        partial_simple_test_stats = normal_sample_weighted_difference(x_numerators=_x, y_numerators=_y,
+                                                                      x_denominators=_x_denominators,
+                                                                      y_denominators=_y_denominators,
+                                                                      percentiles=percentiles, relative=relative)
+        c_i = partial_simple_test_stats['c_i']
+        mu = partial_simple_test_stats['mean1'] - partial_simple_test_stats['mean2']
+
+    if partial_simple_test_stats is not None: # correct the last few lines!!
+        treatment_statistics = SampleStatistics(ss_x, partial_simple_test_stats['mean1'], partial_simple_test_stats['var1'])
+        control_statistics   = SampleStatistics(ss_y, partial_simple_test_stats['mean2'], partial_simple_test_stats['var2'])
+    else:
+        # actually, this is a bit rubbish, only applies to min_observations:
+        treatment_statistics = SampleStatistics(ss_x, float(np.nanmean(_x_strange)), float(np.nanvar(_x_strange)))
+        control_statistics   = SampleStatistics(ss_y, float(np.nanmean(_y_strange)), float(np.nanvar(_y_strange)))
+
+    variant_statistics = BaseTestStatistics(control_statistics, treatment_statistics)
+    if partial_simple_test_stats is not None:
+        p_value = partial_simple_test_stats['p_value']
+    else:
+        p_value = compute_p_value_from_samples(_x_strange, _y_strange)
+    statistical_power = compute_statistical_power_from_samples(_x_strange, _y_strange, alpha) # TODO: wrong
+
+    logger.info("Delta calculation finished!")
+    return SimpleTestStatistics(variant_statistics.control_statistics,
+                                variant_statistics.treatment_statistics,
+                                float(mu), c_i, p_value, statistical_power)
+
+
+def _prepare_samples(x, y, x_denominators, y_denominators):
+    """ Checks the samples of delta and applies its NaN handling: an entity is NaN in both its numerator and its
+    denominator if either is NaN or the denominator is zero.
+
+    :return: numerators and denominators of treatment and control as arrays of floats
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+    """
     # Check if data was provided and it has correct format
     if x is None or y is None:
         raise ValueError('Please provide two non-None samples.')
@@ -96,69 +174,334 @@ def delta(x, y, x_denominators=1, y_denominators=1, assume_normal=True, alpha=0.
     assert (np.isnan(x) == np.isnan(x_denominators)).all()
     assert (np.isnan(y) == np.isnan(y_denominators)).all()
 
-    percentiles = [alpha * 100 / 2, 100 - alpha * 100 / 2]
+    return x, y, x_denominators, y_denominators
 
-    _x = x
-    _y = y
-    _x_denominators = x_denominators
-    _y_denominators = y_denominators
-    _x_ratio = _x / _x_denominators
-    _y_ratio = _y / _y_denominators
-    _x_strange = _x / np.nanmean(_x_denominators)
-    _y_strange = _y / np.nanmean(_y_denominators)
 
-    # Four variables no longer used in this function, let's delete them for simplicity
-    del x
-    del y
-    del x_denominators
-    del y_denominators
+def compute_sufficient_statistics(x, x_denominators=1):
+    """ Computes the moments of a sample needed by delta_from_sufficient_statistics.
+    NaNs are handled the same way as in delta: an entity is excluded if its numerator or its ratio is NaN.
 
-    ss_x = sample_size(_x_ratio)
-    ss_y = sample_size(_y_ratio)
+    :param x: sample of numerators
+    :type  x: pd.Series or array-like
+    :param x_denominators: sample of denominators, or 1 for a non-derived KPI
+    :type  x_denominators: pd.Series or array-like or float
+
+    :return: moments of the sample
+    :rtype: SufficientStatistics
+    """
+    if x is None:
+        raise ValueError('Please provide a non-None sample.')
+    _x = np.array(x, dtype=float)
+    if hasattr(x_denominators, '__len__'):
+        _x_denominators = np.array(x_denominators, dtype=float)
+    else:
+        _x_denominators = np.ones(len(_x)) * x_denominators
+    assert len(_x) == len(_x_denominators)
+
+    return compute_sufficient_statistics_by_codes(_x, np.zeros(len(_x), dtype=int), 1, _x_denominators)[0]
+
+
+def compute_sufficient_statistics_by_group(data, by, numerators, denominators=None):
+    """ Computes the moments needed by delta_from_sufficient_statistics for several columns and 
+    all groups of a data frame. The data frame is grouped only once.
+
+    :param data: data frame holding the samples
+    :type  data: pd.DataFrame
+    :param by: name of the column (or list of names of columns) to group by, e.g. the variant column
+    :type  by: str or list[str]
+    :param numerators: names of the numerator columns
+    :type  numerators: list[str]
+    :param denominators: maps numerator column names to denominator column names. 
+                         Numerators that are not in the mapping have denominators of 1.
+    :type  denominators: dict
+
+    :return: maps every group key to a dict from numerator column name to its moments
+    :rtype: dict
+    """
+    denominators = denominators or {}
+    keys, codes = group_codes(data, by)
+
+    result = dict((key, {}) for key in keys)
+    for numerator in numerators:
+        x_denominators = data[denominators[numerator]] if numerator in denominators else 1
+        moments = compute_sufficient_statistics_by_codes(data[numerator], codes, len(keys), x_denominators)
+        for key, key_moments in zip(keys, moments):
+            result[key][numerator] = key_moments
+    return result
+
+
+def group_codes(data, by, keep_missing=False):
+    """ Numbers the groups of a data frame.
+    Keys and codes are both derived from the factorized columns, hence only observed groups are numbered,
+    also for categorical columns with unobserved categories.
+
+    :param data: data frame to group
+    :type  data: pd.DataFrame
+    :param by: name of the column (or list of names of columns) to group by
+    :type  by: str or list[str]
+    :param keep_missing: if True, rows with missing values form groups of their own with the value None,
+                         otherwise they are in no group
+    :type  keep_missing: bool
+
+    :return: the group keys (tuples if by is a list), and for every row the index of its group key 
+             (-1 for rows in no group)
+    :rtype: tuple[list, np.ndarray]
+    """
+    columns = list(by) if isinstance(by, (list, tuple)) else [by]
+    if len(data) == 0:
+        return [], np.zeros(0, dtype=int)
+
+    column_codes, column_values = [], []
+    for column in columns:
+        codes, uniques = pd.factorize(data[column], sort=True)
+        if keep_missing:
+            codes = np.where(codes < 0, len(uniques), codes)
+        column_codes.append(np.asarray(codes))
+        column_values.append(list(uniques) + [None])
+
+    in_group = np.all([codes >= 0 for codes in column_codes], axis=0)
+    shape = [len(values) for values in column_values]
+    group_of_row = np.ravel_multi_index([codes[in_group] for codes in column_codes], shape)
+    groups, group_codes_in_group = np.unique(group_of_row, return_inverse=True)
+
+    codes = -np.ones(len(data), dtype=int)
+    codes[in_group] = group_codes_in_group.ravel()
+    keys = [tuple(values[index] for values, index in zip(column_values, indices))
+            for indices in zip(*np.unravel_index(groups, shape))]
+    if not isinstance(by, (list, tuple)):
+        keys = [key[0] for key in keys]
+    return keys, codes
+
+
+def compute_sufficient_statistics_by_codes(x, codes, n_groups, x_denominators=1):
+    """ Computes the moments needed by delta_from_sufficient_statistics for all groups of a sample
+    in a single pass, given the group index of every entity.
+
+    :param x: sample of numerators
+    :type  x: pd.Series or array-like
+    :param codes: index of the group of every entity, negative for entities in no group
+    :type  codes: array-like of int
+    :param n_groups: number of groups
+    :type  n_groups: int
+    :param x_denominators: sample of denominators, or 1 for a non-derived KPI
+    :type  x_denominators: pd.Series or array-like or float
+
+    :return: moments of every group
+    :rtype: list[SufficientStatistics]
+    """
+    codes = np.asarray(codes)
+    in_group = codes >= 0
+    _x = np.array(x, dtype=float)[in_group]
+    if hasattr(x_denominators, '__len__'):
+        _x_denominators = np.array(x_denominators, dtype=float)[in_group]
+    else:
+        _x_denominators = np.ones(len(_x)) * x_denominators
+    codes = codes[in_group]
+
+    valid, _x, _x_denominators = _valid_numerators_and_denominators(_x, _x_denominators, drop=False)
+    # two passes: the means first, then the sums of squares around them, which do not cancel out for large means
+    counts = np.bincount(codes, weights=valid.astype(float), minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = [np.where(counts > 0, np.bincount(codes, weights=values, minlength=n_groups) / counts, 0.0)
+                 for values in [_x, _x_denominators]]
+    deviations = [np.where(valid, values - group_means[codes], 0.0)
+                  for values, group_means in zip([_x, _x_denominators], means)]
+    squares = [np.bincount(codes, weights=weights, minlength=n_groups) for weights in
+               [deviations[0] * deviations[0], deviations[1] * deviations[1], deviations[0] * deviations[1]]]
+    return [SufficientStatistics(int(counts[index]), *[float(moment[index]) for moment in means + squares])
+            for index in range(n_groups)]
+
+
+def _valid_numerators_and_denominators(x, x_denominators, drop=True):
+    """ Applies the NaN handling of delta to numerators and denominators.
+    
+    :param drop: if True invalid entities are removed, otherwise they are set to zero
+    :type  drop: bool
+
+    :return: boolean mask of valid entities, numerators and denominators
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    # a NaN in the numerator for each zero or NaN in the denominator, and vice versa
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = x / x_denominators * x_denominators
+    valid = ~np.isnan(x) & ~np.isnan(x_denominators)
+    if drop:
+        return valid, x[valid], x_denominators[valid]
+    return valid, np.where(valid, x, 0.0), np.where(valid, x_denominators, 0.0)
+
+
+def make_delta_from_sufficient_statistics(assume_normal=True, alpha=0.05, min_observations=20, nruns=10000,
+                                          relative=False, method='multinomial', n_jobs=1, seed=None):
+    """ A closure to the delta_from_sufficient_statistics function. It accepts the arguments of make_delta,
+    but only supports assume_normal=True; the bootstrap arguments are ignored. """
+    if not assume_normal:
+        raise ValueError("Delta can only be computed from sufficient statistics when assuming normality.")
+
+    def go(x, y):
+        return delta_from_sufficient_statistics(x, y, alpha, min_observations, relative)
+    return go
+
+
+def delta_from_sufficient_statistics(x, y, alpha=0.05, min_observations=20, relative=False):
+    """ Calculates the difference of means between the samples in a statistical sense, assuming normality,
+    from the moments of the samples only. The result is the same as the one of delta with assume_normal=True.
+    Computation is done in form of treatment minus control, i.e. x-y.
+
+    :param x: moments of the treatment group
+    :type  x: SufficientStatistics
+    :param y: moments of the control group
+    :type  y: SufficientStatistics
+    :param alpha: significance level (alpha)
+    :type  alpha: float
+    :param min_observations: minimum number of observations needed
+    :type  min_observations: int
+    :param relative: if relative==True, then the values will be returned
+            as distances below and above the mean, respectively, rather than the
+            absolute values. In this case, the interval is mean-ret_val[0] to mean+ret_val[1].
+    :type  relative: boolean
+
+    :return: results of type SimpleTestStatistics
+    :rtype: SimpleTestStatistics
+    """
+    if not isinstance(x, SufficientStatistics) or not isinstance(y, SufficientStatistics):
+        raise TypeError('Please provide moments of type SufficientStatistics.')
+
+    percentiles = [alpha * 100 / 2, 100 - alpha * 100 / 2]
+    ss_x, ss_y = x.sample_size, y.sample_size
+    mean_x, variance_x, scaled_variance_x = _moments_of_ratio(x)
+    mean_y, variance_y, scaled_variance_y = _moments_of_ratio(y)
 
-    # Checking if enough observations are left after dropping NaNs
-    partial_simple_test_stats = None
     if min(ss_x, ss_y) < min_observations:
-        # Set mean to nan
         mu = np.nan
-        # Create nan dictionary
         c_i = dict(list(zip(percentiles, np.empty(len(percentiles)) * np.nan)))
+        treatment_statistics = SampleStatistics(ss_x, float(mean_x), float(scaled_variance_x))
+        control_statistics   = SampleStatistics(ss_y, float(mean_y), float(scaled_variance_y))
+        p_value = compute_p_value(mean_x, np.sqrt(scaled_variance_x), ss_x,
+                                  mean_y, np.sqrt(scaled_variance_y), ss_y)
     else:
-        # Computing the mean
-        mu = _delta_mean(_x, _y)
-        # Computing the confidence intervals
-        if assume_normal:
-            logger.info("The distribution of two samples is assumed normal. "
-                        "Performing the sample difference distribution calculation.")
-            partial_simple_test_stats = normal_sample_weighted_difference(x_numerators=_x, y_numerators=_y,
-                                                                          x_denominators=_x_denominators,
-                                                                          y_denominators=_y_denominators,
-                                                                          percentiles=percentiles, relative=relative)
-            c_i = partial_simple_test_stats['c_i']
-            mu = partial_simple_test_stats['mean1'] - partial_simple_test_stats['mean2']
-        else:
-            logger.info("The distribution of two samples is not normal. Performing the bootstrap.")
-            c_i, _ = bootstrap(x=_x_strange, y=_y_strange, percentiles=percentiles, nruns=nruns, relative=relative)
+        mu = mean_x - mean_y
+        c_i = normal_difference(mean1=mean_x, std1=np.sqrt(variance_x), n1=ss_x,
+                                mean2=mean_y, std2=np.sqrt(variance_y), n2=ss_y,
+                                percentiles=percentiles, relative=relative)
+        treatment_statistics = SampleStatistics(ss_x, mean_x, variance_x)
+        control_statistics   = SampleStatistics(ss_y, mean_y, variance_y)
+        p_value = compute_p_value(mean_x, np.sqrt(variance_x), ss_x, mean_y, np.sqrt(variance_y), ss_y)
 
-    if partial_simple_test_stats is not None: # correct the last few lines!!
-        treatment_statistics = SampleStatistics(ss_x, partial_simple_test_stats['mean1'], partial_simple_test_stats['var1'])
-        control_statistics   = SampleStatistics(ss_y, partial_simple_test_stats['mean2'], partial_simple_test_stats['var2'])
-    else:
-        # actually, this is a bit rubbish, only applies to bootstrap and min_observations:
-        treatment_statistics = SampleStatistics(ss_x, float(np.nanmean(_x_strange)), float(np.nanvar(_x_strange)))
-        control_statistics   = SampleStatistics(ss_y, float(np.nanmean(_y_strange)), float(np.nanvar(_y_strange)))
+    z_1_minus_alpha = scipy.stats.norm.ppf(1 - alpha/2.)
+    statistical_power = compute_statistical_power(mean_x, np.sqrt(scaled_variance_x), ss_x,
+                                                  mean_y, np.sqrt(scaled_variance_y), ss_y, z_1_minus_alpha)
 
-    variant_statistics = BaseTestStatistics(control_statistics, treatment_statistics)
-    if partial_simple_test_stats is not None:
-        p_value = partial_simple_test_stats['p_value']
-    else:
-        p_value = compute_p_value_from_samples(_x_strange, _y_strange)
-    statistical_power = compute_statistical_power_from_samples(_x_strange, _y_strange, alpha) # TODO: wrong
+    return SimpleTestStatistics(control_statistics, treatment_statistics, float(mu), c_i, p_value, statistical_power)
+
+
+def _moments_of_ratio(x):
+    """ Mean and variances of a sample given by its moments.
+
+    :param x: moments of the sample
+    :type  x: SufficientStatistics
 
+    :return: mean of the ratio (sum of numerators over sum of denominators),
+             sample variance (ddof=1) of the errors of the numerators, scaled by the mean denominator,
+             and population variance (ddof=0) of the numerators scaled by the mean denominator
+    :rtype: tuple[float, float, float]
+    """
+    n = x.sample_size
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = x.mean_numerators / x.mean_denominators
+        # the errors of the numerators around mean * denominator have zero mean
+        squared_errors = x.squared_deviations_numerators - 2 * mean * x.co_deviations + \
+                         mean ** 2 * x.squared_deviations_denominators
+        variance = max(squared_errors, 0.0) / (n - 1) / x.mean_denominators ** 2 if n > 1 else np.nan
+        scaled_variance = x.squared_deviations_numerators / n / x.mean_denominators ** 2 if n > 0 else np.nan
+    return mean, variance, scaled_variance
+
+
+def make_bootstrap_statistics(assume_normal=False, alpha=0.05, min_observations=20, nruns=10000, relative=False,
+                              method='multinomial', n_jobs=1, seed=None):
+    """ A closure to the compute_bootstrap_statistics function. It accepts the arguments of make_delta;
+    alpha and relative are ignored, since the bootstrap distribution does not depend on them. """
+    def go(x, y, x_denominators=1, y_denominators=1):
+        return compute_bootstrap_statistics(x, y, x_denominators, y_denominators, min_observations, nruns, method,
+                                            n_jobs, seed)
+    return go
+
+
+def compute_bootstrap_statistics(x, y, x_denominators=1, y_denominators=1, min_observations=20, nruns=10000,
+                                 method='multinomial', n_jobs=1, seed=None):
+    """ Runs the bootstrap of delta with assume_normal=False and keeps its distribution,
+    from which delta_from_bootstrap_statistics computes the result for any alpha without resampling.
+    The arguments are the ones of delta.
+
+    :return: statistics of the bootstrap
+    :rtype: BootstrapStatistics
+    """
+    _x, _y, _x_denominators, _y_denominators = _prepare_samples(x, y, x_denominators, y_denominators)
+    _x_strange = _x / np.nanmean(_x_denominators)
+    _y_strange = _y / np.nanmean(_y_denominators)
+    return _bootstrap_statistics(_x, _y, _x_strange, _y_strange, sample_size(_x / _x_denominators),
+                                 sample_size(_y / _y_denominators), min_observations, nruns, method, n_jobs, seed)
+
+
+def _bootstrap_statistics(x, y, x_strange, y_strange, ss_x, ss_y, min_observations, nruns, method, n_jobs, seed):
+    """ Statistics of the bootstrap of delta, given the prepared samples and their sample sizes. """
+    treatment_statistics = SampleStatistics(ss_x, float(np.nanmean(x_strange)), float(np.nanvar(x_strange)))
+    control_statistics   = SampleStatistics(ss_y, float(np.nanmean(y_strange)), float(np.nanvar(y_strange)))
+    p_value = compute_p_value_from_samples(x_strange, y_strange)
+    if min(ss_x, ss_y) < min_observations:
+        return BootstrapStatistics(control_statistics, treatment_statistics, np.nan, p_value, None)
+
+    logger.info("The distribution of two samples is not normal. Performing the bootstrap.")
+    _, bootstraps = bootstrap(x=x_strange, y=y_strange, nruns=nruns, return_bootstraps=True,
+                              method=method, n_jobs=n_jobs, seed=seed)
+    return BootstrapStatistics(control_statistics, treatment_statistics, float(_delta_mean(x, y)), p_value,
+                               bootstraps)
+
+
+def make_delta_from_bootstrap_statistics(assume_normal=False, alpha=0.05, min_observations=20, nruns=10000,
+                                         relative=False, method='multinomial', n_jobs=1, seed=None):
+    """ A closure to the delta_from_bootstrap_statistics function. It accepts the arguments of make_delta. """
+    def go(bootstrap_statistics):
+        return delta_from_bootstrap_statistics(bootstrap_statistics, alpha, relative)
+    return go
+
+
+def delta_from_bootstrap_statistics(bootstrap_statistics, alpha=0.05, relative=False):
+    """ Calculates the result of delta with assume_normal=False for a significance level
+    from the statistics of its bootstrap. Only the percentiles of the bootstrap distribution
+    and the statistical power depend on alpha.
+
+    :param bootstrap_statistics: statistics of the bootstrap
+    :type  bootstrap_statistics: BootstrapStatistics
+    :param alpha: significance level (alpha)
+    :type  alpha: float
+    :param relative: if relative==True, then the values will be returned
+            as distances below and above the mean, respectively, rather than the
+            absolute values. In this case, the interval is mean-ret_val[0] to mean+ret_val[1].
+    :type  relative: boolean
+
+    :return: results of type SimpleTestStatistics
+    :rtype: SimpleTestStatistics
+    """
+    if not isinstance(bootstrap_statistics, BootstrapStatistics):
+        raise TypeError('Please provide statistics of type BootstrapStatistics.')
+
+    percentiles = [alpha * 100 / 2, 100 - alpha * 100 / 2]
+    bootstraps = bootstrap_statistics.bootstraps
+    if bootstraps is None:
+        c_i = dict(list(zip(percentiles, np.empty(len(percentiles)) * np.nan)))
+    else:
+        if relative:
+            bootstraps = bootstraps - np.nanmean(bootstraps)
+        c_i = dict(list(zip(percentiles, np.percentile(bootstraps, q=percentiles))))
+
+    treatment = bootstrap_statistics.treatment_statistics
+    control   = bootstrap_statistics.control_statistics
+    statistical_power = compute_statistical_power(treatment.mean, np.sqrt(treatment.variance), treatment.sample_size,
+                                                  control.mean, np.sqrt(control.variance), control.sample_size,
+                                                  scipy.stats.norm.ppf(1 - alpha / 2.))
     logger.info("Delta calculation finished!")
-    return SimpleTestStatistics(variant_statistics.control_statistics,
-                                variant_statistics.treatment_statistics,
-                                float(mu), c_i, p_value, statistical_power)
+    return SimpleTestStatistics(control, treatment, bootstrap_statistics.delta, c_i, bootstrap_statistics.p,
+                                statistical_power)
 
 
 def sample_size(x):
@@ -217,10 +560,25 @@ def estimate_sample_size(x, mde, r, alpha=0.05, beta=0.2):
 
 
 def bootstrap(x, y, func=_delta_mean, nruns=10000, percentiles=[2.5, 97.5],
-              min_observations=20, return_bootstraps=False, relative=False):
+              min_observations=20, return_bootstraps=False, relative=False,
+              memory_budget=DEFAULT_BOOTSTRAP_MEMORY_BUDGET, method='multinomial', n_jobs=1, seed=None):
     """ Bootstraps the Confidence Intervals for a particular function comparing two samples. 
     NaNs are ignored (discarded before calculation).
 
+    For the default difference of means the resamples are drawn in blocks: each block is a 2-D matrix of
+    resample indices (one row per run) whose size is bounded by memory_budget, and the statistic is evaluated
+    for the whole block with NumPy reductions. Any other func is applied run by run.
+
+    With method='poisson' every entity enters each run with a Poisson(1) distributed weight instead of being
+    drawn with replacement. The weighted means are accumulated in a single pass over chunks of entities,
+    so no resample is ever materialized. This is only supported for the difference of means.
+    Samples which do not fit into memory can be bootstrapped chunk by chunk with compute_poisson_bootstrap_sums.
+
+    By default the global NumPy random state is used. If a seed is given or n_jobs > 1, the runs are split into
+    batches of BOOTSTRAP_RUNS_PER_SEED runs, each drawn from its own generator spawned from
+    np.random.SeedSequence(seed). The batches are distributed over a pool of n_jobs processes, so for a given
+    seed the result is identical for any number of processes. With n_jobs > 1 func needs to be picklable.
+
     :param x: sample of the treatment group
     :type  x: pd.Series or list (array-like)
     :param y: sample of the control group
@@ -244,6 +602,14 @@ def bootstrap(x, y, func=_delta_mean, nruns=10000, percentiles=[2.5, 97.5],
                      In this case, the interval is mean-ret_val[0] to mean+ret_val[1]. 
                      This is more useful in many situations because it corresponds with the sem() and std() functions.
     :type  relative: bool
+    :param memory_budget: approximate number of bytes a single block of resamples may occupy
+    :type  memory_budget: int
+    :param method: 'multinomial' for resampling with replacement or 'poisson' for Poisson weights
+    :type  method: str
+    :param n_jobs: number of processes running the bootstrap
+    :type  n_jobs: int
+    :param seed: seed for reproducible results; None draws fresh entropy if n_jobs > 1
+    :type  seed: int
     
     :return (c_val, bootstraps): c_val is a dict which contains percentile levels (index) and values
                                  bootstraps is a np.array containing the bootstrapping results per run
@@ -252,6 +618,12 @@ def bootstrap(x, y, func=_delta_mean, nruns=10000, percentiles=[2.5, 97.5],
     # Checking if data was provided
     if x is None or y is None:
         raise ValueError('Please provide two non-None samples.')
+    if method not in ('multinomial', 'poisson'):
+        raise ValueError("Bootstrap method needs to be either 'multinomial' or 'poisson'.")
+    if method == 'poisson' and func is not _delta_mean:
+        raise ValueError("Poisson bootstrap only supports the difference of means.")
+    if n_jobs < 1:
+        raise ValueError("Number of jobs needs to be at least 1.")
 
     # Transform data to appropriate format
     _x = np.array(x, dtype=float)
@@ -265,14 +637,10 @@ def bootstrap(x, y, func=_delta_mean, nruns=10000, percentiles=[2.5, 97.5],
         c_val = dict(list(zip(percentiles, np.empty(len(percentiles)) * np.nan)))
         return (c_val, None)
     else:
-        # Initializing bootstraps array and random sampling for each run
-        bootstraps = np.ones(nruns) * np.nan
-        for run in range(nruns):
-            # Randomly choose values from _x and _y with replacement
-            xp = _x[np.random.randint(0, len(_x), size=(len(_x),))]
-            yp = _y[np.random.randint(0, len(_y), size=(len(_y),))]
-            # Application of the given function to the bootstraps
-            bootstraps[run] = func(xp, yp)
+        if seed is None and n_jobs == 1:
+            bootstraps = _bootstrap_runs(_x, _y, func, nruns, method, memory_budget)
+        else:
+            bootstraps = _seeded_bootstrap_runs(_x, _y, func, nruns, method, memory_budget, n_jobs, seed)
         # If relative is set subtract mean from bootstraps
         if relative:
             bootstraps -= np.nanmean(bootstraps)
@@ -281,6 +649,265 @@ def bootstrap(x, y, func=_delta_mean, nruns=10000, percentiles=[2.5, 97.5],
         return (c_val, None) if not return_bootstraps else (c_val, bootstraps)
 
 
+def compute_poisson_bootstrap_sums(x, nruns=10000, memory_budget=DEFAULT_BOOTSTRAP_MEMORY_BUDGET, seed=None):
+    """ Computes the weighted sums and total weights of a sample for every run of a Poisson bootstrap,
+    e.g. of one chunk of a sample that does not fit into memory. The sums of the chunks of a sample are merged
+    by PoissonBootstrapSums.merge_with, and bootstrap_from_poisson_bootstrap_sums computes the bootstrap of
+    the difference of means from the merged sums of two samples.
+    The weights of different chunks need to be independent, hence every chunk needs its own seed,
+    e.g. spawned from one np.random.SeedSequence. Without a seed the global NumPy random state is used.
+
+    :param x: sample (may contain NaNs, which get no weight)
+    :type  x: pd.Series or list (array-like)
+    :param nruns: number of bootstrap runs to perform
+    :type  nruns: int
+    :param memory_budget: approximate number of bytes the draws of a single chunk of entities may occupy
+    :type  memory_budget: int
+    :param seed: seed of the weights, an int or a np.random.SeedSequence
+    :type  seed: int
+
+    :return: weighted sums and total weights per run
+    :rtype: PoissonBootstrapSums
+    """
+    if x is None:
+        raise ValueError('Please provide a non-None sample.')
+    random_state = np.random
+    if seed is not None:
+        if not hasattr(np.random, 'SeedSequence'):
+            raise RuntimeError("Seeded Poisson bootstrap sums require numpy >= 1.17.")
+        random_state = np.random.RandomState(np.random.MT19937(seed))
+    sums, weights = _poisson_bootstrap_sums(np.array(x, dtype=float), nruns, memory_budget, random_state)
+    return PoissonBootstrapSums(sums, weights)
+
+
+def bootstrap_from_poisson_bootstrap_sums(x, y, percentiles=[2.5, 97.5], return_bootstraps=False, relative=False):
+    """ Bootstraps the confidence interval of the difference of means from the Poisson bootstrap sums
+    of two samples, as bootstrap with method='poisson' does from the samples.
+
+    :param x: sums of the treatment group
+    :type  x: PoissonBootstrapSums
+    :param y: sums of the control group, with the same number of runs
+    :type  y: PoissonBootstrapSums
+    :param percentiles: The values corresponding to the given percentiles are returned.
+    :type  percentiles: list
+    :param return_bootstraps: If this variable is set the bootstrap sets are returned,
+                              otherwise the second return value is None.
+    :type  return_bootstraps: bool
+    :param relative: if relative==True, then the values will be returned as distances below and above the mean
+    :type  relative: bool
+
+    :return (c_val, bootstraps): c_val is a dict which contains percentile levels (index) and values
+                                 bootstraps is a np.array containing the difference of means per run
+    :rtype: tuple
+    """
+    if len(x.sums) != len(y.sums):
+        raise ValueError("Poisson bootstrap sums of {} and {} runs cannot be compared.".format(len(x.sums), len(y.sums)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bootstraps = x.sums / x.weights - y.sums / y.weights
+    if relative:
+        bootstraps -= np.nanmean(bootstraps)
+    c_val = dict(list(zip(percentiles, np.percentile(bootstraps, q=percentiles))))
+    return (c_val, None) if not return_bootstraps else (c_val, bootstraps)
+
+
+def _bootstrap_runs(x, y, func, nruns, method, memory_budget, random_state=np.random):
+    """ Computes func for nruns bootstrap runs of x and y.
+
+    :param random_state: source of the random draws, either the np.random module or a np.random.RandomState
+    :type  random_state: module or np.random.RandomState
+
+    :return: result of func for every bootstrap run
+    :rtype: np.ndarray
+    """
+    if method == 'poisson':
+        return _poisson_bootstrap_delta_mean(x, y, nruns, memory_budget, random_state)
+    if func is _delta_mean:
+        return _bootstrap_delta_mean_in_blocks(x, y, nruns, memory_budget, random_state)
+
+    # Initializing bootstraps array and random sampling for each run
+    bootstraps = np.ones(nruns) * np.nan
+    for run in range(nruns):
+        # Randomly choose values from x and y with replacement
+        xp = x[random_state.randint(0, len(x), size=(len(x),))]
+        yp = y[random_state.randint(0, len(y), size=(len(y),))]
+        # Application of the given function to the bootstraps
+        bootstraps[run] = func(xp, yp)
+    return bootstraps
+
+
+def _seeded_bootstrap_runs(x, y, func, nruns, method, memory_budget, n_jobs, seed):
+    """ Computes func for nruns bootstrap runs of x and y in batches with independent, spawned random states.
+
+    The split into batches and their seeds only depend on nruns and seed, hence the result does not
+    depend on the number of processes.
+
+    :return: result of func for every bootstrap run
+    :rtype: np.ndarray
+    """
+    if not hasattr(np.random, 'SeedSequence'):
+        raise RuntimeError("Seeded and multi-process bootstrap requires numpy >= 1.17.")
+
+    batch_sizes = [min(BOOTSTRAP_RUNS_PER_SEED, nruns - start) for start in range(0, nruns, BOOTSTRAP_RUNS_PER_SEED)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    batches = list(zip(batch_sizes, seeds))
+
+    if n_jobs == 1 or len(batches) == 1:
+        # the samples are passed explicitly: the module global is shared by all threads of this process
+        arguments = (x, y, func, method, memory_budget)
+        results = [_bootstrap_batch(batch, arguments) for batch in batches]
+    else:
+        logger.info("Running {} bootstrap runs in {} processes.".format(nruns, n_jobs))
+        pool = Pool(processes=min(n_jobs, len(batches)), initializer=_init_bootstrap_worker,
+                    initargs=(x, y, func, method, memory_budget))
+        try:
+            results = pool.map(_bootstrap_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    return np.concatenate(results)
+
+
+# samples and settings of the bootstrap executed by a worker process of the pool; set by the pool initializer only
+_bootstrap_worker_arguments = None
+
+
+def _init_bootstrap_worker(x, y, func, method, memory_budget):
+    """ Stores the bootstrap samples once per worker process so that batches do not need to ship them. """
+    global _bootstrap_worker_arguments
+    _bootstrap_worker_arguments = (x, y, func, method, memory_budget)
+
+
+def _bootstrap_batch(batch, arguments=None):
+    """ Runs one batch of a seeded bootstrap, given as a tuple of its number of runs and its SeedSequence.
+    The samples and settings are given as arguments, or else were stored by _init_bootstrap_worker. """
+    nruns, seed_sequence = batch
+    x, y, func, method, memory_budget = arguments if arguments is not None else _bootstrap_worker_arguments
+    random_state = np.random.RandomState(np.random.MT19937(seed_sequence))
+    return _bootstrap_runs(x, y, func, nruns, method, memory_budget, random_state)
+
+
+def _bootstrap_block_size(n_x, n_y, nruns, memory_budget):
+    """ Number of bootstrap runs that fit into one block of the given memory budget.
+
+    Every resampled entity of a run costs one index and one value (8 bytes each).
+    At least one run is always drawn per block.
+    """
+    bytes_per_run = 16 * (n_x + n_y)
+    return int(max(1, min(nruns, memory_budget // max(1, bytes_per_run))))
+
+
+def _bootstrap_delta_mean_in_blocks(x, y, nruns, memory_budget, random_state=np.random):
+    """ Bootstrap distribution of the difference of means, evaluated block-wise.
+    NaNs are replaced by zeros once and the number of valid values per resample is counted separately,
+    which gives the same result as applying np.nanmean to every resample.
+
+    :param x: sample of the treatment group (may contain NaNs)
+    :type  x: np.ndarray
+    :param y: sample of the control group (may contain NaNs)
+    :type  y: np.ndarray
+    :param nruns: number of bootstrap runs to perform
+    :type  nruns: int
+    :param memory_budget: approximate number of bytes a single block of resamples may occupy
+    :type  memory_budget: int
+    :param random_state: source of the random draws, either the np.random module or a np.random.RandomState
+    :type  random_state: module or np.random.RandomState
+
+    :return: difference of means for every bootstrap run
+    :rtype: np.ndarray
+    """
+    x_filled, x_valid = _fill_nan_with_zero(x)
+    y_filled, y_valid = _fill_nan_with_zero(y)
+
+    bootstraps = np.empty(nruns)
+    block_size = _bootstrap_block_size(len(x), len(y), nruns, memory_budget)
+    for start in range(0, nruns, block_size):
+        size = min(block_size, nruns - start)
+        x_indices = random_state.randint(0, len(x), size=(size, len(x)))
+        y_indices = random_state.randint(0, len(y), size=(size, len(y)))
+        bootstraps[start:start + size] = _resampled_means(x_filled, x_valid, x_indices) - \
+                                         _resampled_means(y_filled, y_valid, y_indices)
+    return bootstraps
+
+
+def _poisson_bootstrap_delta_mean(x, y, nruns, memory_budget, random_state=np.random):
+    """ Poisson bootstrap distribution of the difference of means.
+
+    :param x: sample of the treatment group (may contain NaNs)
+    :type  x: np.ndarray
+    :param y: sample of the control group (may contain NaNs)
+    :type  y: np.ndarray
+    :param nruns: number of bootstrap runs to perform
+    :type  nruns: int
+    :param memory_budget: approximate number of bytes the weights of a single chunk may occupy
+    :type  memory_budget: int
+    :param random_state: source of the random draws, either the np.random module or a np.random.RandomState
+    :type  random_state: module or np.random.RandomState
+
+    :return: difference of means for every bootstrap run
+    :rtype: np.ndarray
+    """
+    x_sums, x_weights = _poisson_bootstrap_sums(x, nruns, memory_budget, random_state)
+    y_sums, y_weights = _poisson_bootstrap_sums(y, nruns, memory_budget, random_state)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x_sums / x_weights - y_sums / y_weights
+
+
+def _poisson_bootstrap_sums(x, nruns, memory_budget, random_state=np.random):
+    """ Weighted sums and total weights of a sample for every Poisson bootstrap run.
+
+    The sample is processed in chunks of entities. Within a chunk of c entities each run draws a total
+    count from Poisson(c) and distributes it uniformly over the entities of the chunk, which is the same as
+    drawing an independent Poisson(1) weight per entity but needs no weight matrix.
+    Sums and weights of different chunks (or of different parts of a sample) are merged by adding them up.
+
+    :param x: sample (may contain NaNs, which get no weight)
+    :type  x: np.ndarray
+    :param nruns: number of bootstrap runs to perform
+    :type  nruns: int
+    :param memory_budget: approximate number of bytes the draws of a single chunk may occupy
+    :type  memory_budget: int
+    :param random_state: source of the random draws, either the np.random module or a np.random.RandomState
+    :type  random_state: module or np.random.RandomState
+
+    :return: weighted sums and total weights per run
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    x_filled, x_valid = _fill_nan_with_zero(x)
+
+    sums = np.zeros(nruns)
+    weights = np.zeros(nruns)
+    # every drawn entity costs an index, a run label and a value (8 bytes each), plus some headroom
+    chunk_size = int(max(1, memory_budget // (32 * nruns)))
+    for start in range(0, len(x), chunk_size):
+        chunk_values = x_filled[start:start + chunk_size]
+        counts = random_state.poisson(len(chunk_values), size=nruns)
+        indices = random_state.randint(0, len(chunk_values), size=counts.sum())
+        runs = np.repeat(np.arange(nruns), counts)
+        sums += np.bincount(runs, weights=chunk_values[indices], minlength=nruns)
+        if x_valid is None:
+            weights += counts
+        else:
+            weights += np.bincount(runs, weights=x_valid[start:start + chunk_size][indices], minlength=nruns)
+    return sums, weights
+
+
+def _fill_nan_with_zero(x):
+    """ Returns x with NaNs replaced by zeros and the boolean mask of valid values (None if there are no NaNs). """
+    valid = ~np.isnan(x)
+    if valid.all():
+        return x, None
+    return np.where(valid, x, 0.0), valid
+
+
+def _resampled_means(filled, valid, indices):
+    """ Means of the resamples given by the rows of indices, ignoring NaNs of the original sample. """
+    sums = np.take(filled, indices).sum(axis=1)
+    if valid is None:
+        return sums / indices.shape[1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / np.take(valid, indices).sum(axis=1)
+
+
 def pooled_std(std1, n1, std2, n2):
     """ Returns the pooled estimate of standard deviation. 
 
@@ -1,4 +1,4 @@
 """ExpAn data module.
 """
 
-__all__ = ["csv_fetcher"]
+__all__ = ["csv_fetcher", "parquet_fetcher", "npy_store", "schema"]
@@ -1,16 +1,60 @@
 import logging
+import sys
+import time
+from collections import OrderedDict
 from os import listdir
 from os.path import isfile, join
 
+import numpy as np
 import pandas as pd
 import simplejson as json
 
+try:
+    from pandas.api.types import union_categoricals
+except ImportError:  # pandas < 0.20
+    from pandas.types.concat import union_categoricals
+
+try:
+    import resource
+except ImportError:  # not available on Windows, where the peak memory of the process is not reported
+    resource = None
+
 from expan.core.experiment import Experiment
+from expan.core.util import JsonSerializable
 
 logger = logging.getLogger(__name__)
 
 
-def get_data(folder_path):
+class FetchReport(JsonSerializable):
+    """ This class holds how fast and with how much memory the data was read.
+
+    :param rows: number of rows read
+    :type  rows: int
+    :param seconds: time taken to read the data
+    :type  seconds: float
+    :param data_memory_mb: memory of the data read, in MB
+    :type  data_memory_mb: float
+    :param process_peak_memory_mb: peak memory of the whole process so far (maximum resident set size), in MB, 
+                                   or None if unknown
+    :type  process_peak_memory_mb: float
+    :param peak_memory_increase_mb: increase of the peak memory of the process while the data was read, in MB, 
+                                    or None if unknown. It is zero if reading stayed below an earlier peak.
+    :type  peak_memory_increase_mb: float
+    """
+    def __init__(self, rows, seconds, data_memory_mb, process_peak_memory_mb, peak_memory_increase_mb):
+        self.rows                    = rows
+        self.seconds                 = seconds
+        self.data_memory_mb          = data_memory_mb
+        self.process_peak_memory_mb  = process_peak_memory_mb
+        self.peak_memory_increase_mb = peak_memory_increase_mb
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else float('inf')
+
+
+def get_data(folder_path, columns=None, categorical_columns=None, downcast_kpis=False, chunksize=None,
+             return_report=False):
     """ Expects as input a folder containing the following files:
 
     - one .csv or .csv.gz with 'data' in the filename
@@ -18,10 +62,29 @@ def get_data(folder_path):
 
     Opens the files and uses them to create an Experiment object which it then returns.
 
+    Only the given columns are read, e.g. the ones returned by schema.required_columns.
+    Without columns, the 'schema' of the metadata is used if it has one,
+    i.e. a dict with the lists 'columns' and 'categorical_columns'.
+    The categorical columns (e.g. variant and feature columns) are read as pandas categoricals,
+    and with downcast_kpis the float columns other than entity and categorical columns are downcast to float32.
+    With a chunksize the data is read and converted chunk by chunk,
+    so that the whole file is never held in memory with inferred float64 and object types,
+    and the converted chunks are concatenated column by column, so that the data is held about once in memory.
+
     :param folder_path: path to the Experiment data
     :type  folder_path: str
-    :return: Experiment object with data
-    :rtype:  Experiment
+    :param columns: names of the columns to read, or None to read all columns
+    :type  columns: list[str]
+    :param categorical_columns: names of the columns to read as categoricals
+    :type  categorical_columns: list[str]
+    :param downcast_kpis: True to read float KPI columns as float32
+    :type  downcast_kpis: bool
+    :param chunksize: number of rows read at a time, or None to read the file at once
+    :type  chunksize: int
+    :param return_report: True to additionally return a FetchReport with the rows per second and peak memory
+    :type  return_report: bool
+    :return: data and metadata, and the FetchReport if return_report is True
+    :rtype:  tuple[pd.DataFrame, dict] or tuple[pd.DataFrame, dict, FetchReport]
     """
     files = [f for f in listdir(folder_path) if isfile(join(folder_path, f))]
 
@@ -33,10 +96,134 @@ def get_data(folder_path):
             if 'metadata' in f:
                 with open(join(folder_path, f), 'r') as input_json:
                     metadata = json.load(input_json)
-            elif 'data' in f:
-                data = pd.read_csv(join(folder_path, f))
+
+        schema = metadata.get('schema') or {}
+        if columns is None:
+            columns = schema.get('columns')
+            categorical_columns = categorical_columns or schema.get('categorical_columns')
+
+        start_time, start_peak_memory_mb = time.time(), _process_peak_memory_mb()
+        for f in files:
+            if 'data' in f and 'metadata' not in f:
+                data = _read_csv(join(folder_path, f), columns, categorical_columns, downcast_kpis, chunksize)
+        report = _fetch_report(data, time.time() - start_time, start_peak_memory_mb)
+        logger.info("Read {} rows in {:.1f} seconds ({:.0f} rows per second), data memory {:.1f} MB, "
+                    "process peak memory {} MB (increased by {} MB while reading)."
+                    .format(report.rows, report.seconds, report.rows_per_second, report.data_memory_mb,
+                            _format_memory(report.process_peak_memory_mb), _format_memory(report.peak_memory_increase_mb)))
+        if return_report:
+            return data, metadata, report
         return data, metadata
 
     except AssertionError as e:
         logger.error("An error occurred when fetching data from csv file.")
         raise e
+
+
+def get_data_chunks(folder_path, chunksize, columns=None, categorical_columns=None, downcast_kpis=False):
+    """ Expects the same folder as get_data, but reads the data lazily in chunks of chunksize rows,
+    e.g. for Experiment.analyze_chunks on data which does not fit into memory.
+    The columns are read and converted as by get_data; categories of categorical columns can differ between chunks.
+
+    :param folder_path: path to the Experiment data
+    :type  folder_path: str
+    :param chunksize: number of rows of a chunk
+    :type  chunksize: int
+    :param columns: names of the columns to read, or None to read all columns
+    :type  columns: list[str]
+    :param categorical_columns: names of the columns to read as categoricals
+    :type  categorical_columns: list[str]
+    :param downcast_kpis: True to read float KPI columns as float32
+    :type  downcast_kpis: bool
+    :return: iterator over the chunks of the data, and metadata
+    :rtype:  tuple[iterator, dict]
+    """
+    files = [f for f in listdir(folder_path) if isfile(join(folder_path, f))]
+
+    try:
+        assert ('data' in '-'.join(files))
+        assert ('metadata' in '-'.join(files))
+        metadata = data_file = None
+        for f in files:
+            if 'metadata' in f:
+                with open(join(folder_path, f), 'r') as input_json:
+                    metadata = json.load(input_json)
+            elif 'data' in f:
+                data_file = join(folder_path, f)
+        assert data_file is not None
+
+        schema = metadata.get('schema') or {}
+        if columns is None:
+            columns = schema.get('columns')
+            categorical_columns = categorical_columns or schema.get('categorical_columns')
+        categorical_columns = list(categorical_columns or [])
+        dtypes = dict((column, 'category') for column in categorical_columns)
+        chunks = (_convert_types(chunk, categorical_columns, downcast_kpis)
+                  for chunk in pd.read_csv(data_file, usecols=columns, dtype=dtypes, chunksize=chunksize))
+        return chunks, metadata
+
+    except AssertionError as e:
+        logger.error("An error occurred when fetching data from csv file.")
+        raise e
+
+
+def _read_csv(file_name, columns, categorical_columns, downcast_kpis, chunksize):
+    """ Reads a csv file, in chunks if a chunksize is given, converting the types of every chunk. """
+    categorical_columns = list(categorical_columns or [])
+    dtypes = dict((column, 'category') for column in categorical_columns)
+    if chunksize is None:
+        return _convert_types(pd.read_csv(file_name, usecols=columns, dtype=dtypes),
+                              categorical_columns, downcast_kpis)
+
+    # the columns of the chunks are copied out of their data frames, which are dropped after every chunk,
+    # and are then concatenated column by column, so that the data is held about once in memory
+    column_chunks = OrderedDict()
+    for chunk in pd.read_csv(file_name, usecols=columns, dtype=dtypes, chunksize=chunksize):
+        chunk = _convert_types(chunk, categorical_columns, downcast_kpis)
+        for column in chunk.columns:
+            column_chunks.setdefault(column, []).append(chunk[column].values.copy())
+        del chunk
+    if not column_chunks:
+        return pd.read_csv(file_name, usecols=columns, dtype=dtypes)
+
+    data = OrderedDict()
+    for column in list(column_chunks):
+        chunks = column_chunks.pop(column)
+        # categories differ between chunks, hence categorical columns are concatenated by their union
+        data[column] = union_categoricals(chunks) if column in categorical_columns else np.concatenate(chunks)
+        del chunks
+    return pd.DataFrame(data, columns=list(data), copy=False)
+
+
+def _convert_types(data, categorical_columns, downcast_kpis):
+    """ Downcasts the float KPI columns of the data to float32. """
+    if downcast_kpis:
+        for column in data.columns:
+            if column != 'entity' and column not in categorical_columns and data[column].dtype == np.float64:
+                data[column] = data[column].astype(np.float32)
+    return data
+
+
+def _process_peak_memory_mb():
+    """ Peak memory of the process so far (maximum resident set size) in MB, or None if unknown. """
+    if resource is None:
+        return None
+    # the maximum resident set size is in bytes on macOS and in kilobytes elsewhere
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_memory / 1024.0 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def _format_memory(memory_mb):
+    """ Memory in MB for the log. """
+    return 'unknown' if memory_mb is None else '{:.1f}'.format(memory_mb)
+
+
+def _fetch_report(data, seconds, start_peak_memory_mb):
+    """ Report of reading the data in the given time, starting at the given peak memory of the process. """
+    process_peak_memory_mb = _process_peak_memory_mb()
+    peak_memory_increase_mb = None
+    if process_peak_memory_mb is not None and start_peak_memory_mb is not None:
+        peak_memory_increase_mb = process_peak_memory_mb - start_peak_memory_mb
+    data_memory_mb = 0.0 if data is None else data.memory_usage(index=True, deep=True).sum() / 1024.0 ** 2
+    return FetchReport(rows=0 if data is None else len(data), seconds=seconds, data_memory_mb=data_memory_mb,
+                       process_peak_memory_mb=process_peak_memory_mb, peak_memory_increase_mb=peak_memory_increase_mb)
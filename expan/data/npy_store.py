@@ -0,0 +1,283 @@
+import logging
+import os
+import pickle
+import tempfile
+from os.path import exists, join
+
+import numpy as np
+import pandas as pd
+import simplejson as json
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+COLUMNS_FILE = 'columns.json'
+METADATA_FILE = 'metadata.json'
+# names of the files of a generation of the store; append_data writes the files of a new generation
+COLUMN_FILE = 'column_{}.{}.npy'
+CATEGORIES_FILE = 'column_{}.{}.categories.npy'
+MOMENTS_FILE = 'moments.{}.pkl'
+
+
+def write_data(folder_path, data, metadata, moments=None):
+    """ Writes the data of an experiment to a binary store: a folder with one .npy file per column,
+    the layout of the columns in columns.json and the metadata in metadata.json.
+    Numerical, boolean and datetime columns are stored as they are;
+    other columns, e.g. categorical and string columns, are stored as their category codes,
+    with the categories in a separate .npy file.
+    The store is meant to be written once, e.g. from the data read by csv_fetcher.get_data,
+    opened many times by get_data and extended by append_data.
+    The moments of the data (see ExperimentMoments) can be stored along with it and are then kept up to date
+    by append_data. Files of a store previously written to the folder are removed.
+
+    :param folder_path: path of the store, which is created if it does not exist
+    :type  folder_path: str
+    :param data: data of the experiment
+    :type  data: pd.DataFrame
+    :param metadata: metadata of the experiment
+    :type  metadata: dict
+    :param moments: moments of the data, or None
+    :type  moments: ExperimentMoments
+    """
+    if not exists(folder_path):
+        os.makedirs(folder_path)
+    previous_layout = _load_layout(folder_path) if exists(join(folder_path, COLUMNS_FILE)) else None
+
+    columns = []
+    for index, name in enumerate(data.columns):
+        column = data[name]
+        file_name = COLUMN_FILE.format(index, 0)
+        layout = {'name': name, 'file': file_name}
+        # numpy kinds of boolean, integer, unsigned, float, complex, timedelta and datetime arrays
+        if not (isinstance(column.dtype, np.dtype) and column.dtype.kind in 'biufcmM'):
+            categorical = pd.Categorical(column)
+            categories_file_name = CATEGORIES_FILE.format(index, 0)
+            _save(join(folder_path, categories_file_name), np.asarray(categorical.categories.astype(object)))
+            _save(join(folder_path, file_name), np.asarray(categorical.codes))
+            layout.update({'kind': 'categorical', 'categories': categories_file_name,
+                           'ordered': bool(categorical.ordered)})
+        else:
+            _save(join(folder_path, file_name), column.values)
+            layout['kind'] = 'array'
+        columns.append(layout)
+
+    layout = {'version': STORE_VERSION, 'generation': 0, 'rows': len(data), 'columns': columns, 'moments': None}
+    if moments is not None:
+        layout['moments'] = MOMENTS_FILE.format(0)
+        _pickle_dump(moments, join(folder_path, layout['moments']))
+    _write_atomic(join(folder_path, METADATA_FILE), lambda f: json.dump(metadata, f), mode='w')
+    _write_atomic(join(folder_path, COLUMNS_FILE), lambda f: json.dump(layout, f), mode='w')
+    if previous_layout is not None:
+        _remove_unused_files(folder_path, previous_layout, layout)
+    logger.info("Wrote {} rows and {} columns to the store {}.".format(len(data), len(columns), folder_path))
+
+
+def get_data(folder_path, columns=None, mmap_mode='c'):
+    """ Opens a store written by write_data.
+    The column files are memory mapped instead of read: opening the store takes milliseconds,
+    only the pages of the data used by an analysis are read,
+    and several processes analyzing the same store share the page cache.
+    With the default mmap_mode 'c' (copy-on-write) the data can be changed in memory without changing the store.
+    Columns stored as category codes are returned as categoricals.
+
+    :param folder_path: path of the store
+    :type  folder_path: str
+    :param columns: names of the columns to open, or None to open all columns
+    :type  columns: list[str]
+    :param mmap_mode: mode of numpy.load for the column files; 'r' for read-only data, None to read the files
+    :type  mmap_mode: str
+    :return: data and metadata
+    :rtype:  tuple[pd.DataFrame, dict]
+    """
+    layout = _load_layout(folder_path)
+    with open(join(folder_path, METADATA_FILE), 'r') as input_json:
+        metadata = json.load(input_json)
+
+    layout_of_column = dict((column['name'], column) for column in layout['columns'])
+    if columns is None:
+        columns = [column['name'] for column in layout['columns']]
+    missing = [name for name in columns if name not in layout_of_column]
+    if missing:
+        raise KeyError("Columns {} are not in the store.".format(missing))
+
+    arrays = {}
+    for name in columns:
+        column = layout_of_column[name]
+        values = np.load(join(folder_path, column['file']), mmap_mode=mmap_mode)
+        if len(values) != layout['rows']:
+            raise ValueError("Column '{}' has {} rows instead of {}.".format(name, len(values), layout['rows']))
+        if column['kind'] == 'categorical':
+            categories = np.load(join(folder_path, column['categories']), allow_pickle=True)
+            values = pd.Categorical.from_codes(values, categories, ordered=column['ordered'])
+        arrays[name] = values
+    # without copy, pandas (from 0.23) keeps every column in a block of its own backed by its memory map
+    data = pd.DataFrame(arrays, columns=columns, copy=False)
+    return data, metadata
+
+
+def append_data(folder_path, data, moments=None):
+    """ Appends the rows of new entities to a store written by write_data and replaces the rows of updated
+    entities, e.g. with the data of a new day of a running experiment.
+    Only the entity column of the stored rows is read, to find the updated entities, and the stored rows of
+    the updated entities. The columns with the new rows are written to the files of a new generation of the store,
+    which replaces the previous one by a single rename of columns.json; the files of the previous generation are
+    removed afterwards. An interrupted append hence leaves the previous store intact, and get_data opens either the
+    previous or the extended store. If the append fails, e.g. on a conflict of the types of a column, the files
+    of the new generation written so far are removed. Data already opened from the previous generation stays valid
+    on POSIX systems, whereas a get_data running concurrently with the removal can fail and has to be retried.
+
+    Every column is copied to the new generation, so an append reads and writes the whole store, not only the
+    new rows, and needs the disk space of the store twice. Appending daily to a store of many days hence costs
+    about the number of days times its size in total; collect the data of several days in one append where possible.
+
+    With moments, the moments are updated with the new and the changed rows and stored,
+    so that the experiment can be analyzed by Experiment.analyze_moments without reading the stored rows.
+    Without moments, the moments stored by write_data or a previous append_data are updated, if there are any.
+
+    :param folder_path: path of the store
+    :type  folder_path: str
+    :param data: current rows of the new and updated entities, with the columns of the store
+    :type  data: pd.DataFrame
+    :param moments: moments of the stored data, or None
+    :type  moments: ExperimentMoments
+    :return: the previous rows of the updated entities
+    :rtype:  pd.DataFrame
+    """
+    layout = _load_layout(folder_path)
+    names = [column['name'] for column in layout['columns']]
+    missing = [name for name in names if name not in data.columns]
+    if missing:
+        raise KeyError("Columns {} of the store are not in the data.".format(missing))
+    if data.entity.duplicated().any():
+        raise ValueError('Entities in data should be unique.')
+    if moments is None:
+        moments = get_moments(folder_path)
+
+    stored, _ = get_data(folder_path, mmap_mode='r')
+    positions = pd.Index(np.asarray(stored.entity)).get_indexer(np.asarray(data.entity))
+    updated = positions >= 0
+    previous_data = stored.iloc[positions[updated]].reset_index(drop=True)
+    # the previous rows are read before the files of the previous generation are removed
+    previous_data = pd.DataFrame(dict((name, np.array(previous_data[name])) for name in names), columns=names)
+    del stored
+
+    try:
+        new_layout = _write_generation(folder_path, layout, data, positions, updated, moments, previous_data)
+        # the new generation replaces the previous one in a single step
+        _write_atomic(join(folder_path, COLUMNS_FILE), lambda f: json.dump(new_layout, f), mode='w')
+    except Exception:
+        _remove_generation(folder_path, layout, layout['generation'] + 1)
+        raise
+    _remove_unused_files(folder_path, layout, new_layout)
+    logger.info("Appended {} new and updated {} entities of the store {}.".format(int((~updated).sum()),
+                                                                                  int(updated.sum()), folder_path))
+    return previous_data
+
+
+def get_moments(folder_path):
+    """ Moments stored by write_data or append_data.
+
+    :param folder_path: path of the store
+    :type  folder_path: str
+    :return: moments of the stored data, or None if no moments are stored
+    :rtype:  ExperimentMoments
+    """
+    file_name = _load_layout(folder_path).get('moments')
+    if file_name is None:
+        return None
+    with open(join(folder_path, file_name), 'rb') as f:
+        return pickle.load(f)
+
+
+def _write_generation(folder_path, layout, data, positions, updated, moments, previous_data):
+    """ Writes the files of the next generation of a store with the rows of data appended (at the positions
+    which are not updated) or updated (at the given positions of the stored rows), and returns its layout. """
+    generation = layout['generation'] + 1
+    columns = []
+    for index, column in enumerate(layout['columns']):
+        values = data[column['name']]
+        column = dict(column, file=COLUMN_FILE.format(index, generation))
+        if column['kind'] == 'categorical':
+            categories = pd.Index(np.load(join(folder_path, column['categories']), allow_pickle=True))
+            values = np.asarray(values, dtype=object)
+            # the codes of the stored rows are kept, new values are appended to the categories
+            new_categories = [value for value in pd.unique(values[pd.notnull(values)]) if value not in categories]
+            if new_categories:
+                categories = categories.append(pd.Index(new_categories, dtype=object))
+                column['categories'] = CATEGORIES_FILE.format(index, generation)
+                _save(join(folder_path, column['categories']), np.asarray(categories.astype(object)))
+            values = categories.get_indexer(values)
+        values = np.asarray(values)
+
+        stored_values = np.load(join(folder_path, layout['columns'][index]['file']), mmap_mode='r')
+        array = np.empty(len(stored_values) + int((~updated).sum()),
+                         dtype=np.result_type(stored_values.dtype, values.dtype))
+        array[:len(stored_values)] = stored_values
+        array[len(stored_values):] = values[~updated]
+        array[positions[updated]] = values[updated]
+        del stored_values
+        _save(join(folder_path, column['file']), array)
+        columns.append(column)
+
+    new_layout = dict(layout, generation=generation, rows=layout['rows'] + int((~updated).sum()), columns=columns)
+    if moments is not None:
+        moments.update(data, previous_data)
+        new_layout['moments'] = MOMENTS_FILE.format(generation)
+        _pickle_dump(moments, join(folder_path, new_layout['moments']))
+    return new_layout
+
+
+def _remove_generation(folder_path, layout, generation):
+    """ Removes the files of a generation of the store which were written by a failed append. """
+    file_names = [MOMENTS_FILE.format(generation)]
+    for index in range(len(layout['columns'])):
+        file_names += [COLUMN_FILE.format(index, generation), CATEGORIES_FILE.format(index, generation)]
+    for file_name in file_names:
+        if exists(join(folder_path, file_name)):
+            os.remove(join(folder_path, file_name))
+
+
+def _load_layout(folder_path):
+    """ Reads the layout of the columns of a store. """
+    with open(join(folder_path, COLUMNS_FILE), 'r') as input_json:
+        layout = json.load(input_json)
+    if layout['version'] != STORE_VERSION:
+        raise ValueError("Store version {} is not supported.".format(layout['version']))
+    return layout
+
+
+def _remove_unused_files(folder_path, previous_layout, layout):
+    """ Removes the files of the previous layout which are not used by the current layout. """
+    def files(layout):
+        names = set(column[key] for column in layout['columns'] for key in ['file', 'categories'] if key in column)
+        if layout.get('moments'):
+            names.add(layout['moments'])
+        return names
+    for file_name in files(previous_layout) - files(layout):
+        try:
+            os.remove(join(folder_path, file_name))
+        except OSError:  # e.g. removed by a concurrent append, or still mapped by a reader on Windows
+            logger.warning("Could not remove the unused file {} of the store {}.".format(file_name, folder_path))
+
+
+def _save(file_name, array):
+    """ Saves an array as .npy file; object arrays (categories of strings) are pickled. """
+    np.save(file_name, array, allow_pickle=array.dtype == object)
+
+
+def _write_atomic(file_name, write, mode='wb'):
+    """ Writes a file under a temporary name and renames it to file_name,
+    so that readers see either the previous or the complete new file. """
+    handle, temporary_file = tempfile.mkstemp(dir=os.path.dirname(file_name), suffix='.tmp')
+    try:
+        with os.fdopen(handle, mode) as f:
+            write(f)
+        getattr(os, 'replace', os.rename)(temporary_file, file_name)
+    except Exception:
+        os.remove(temporary_file)
+        raise
+
+
+def _pickle_dump(obj, file_name):
+    with open(file_name, 'wb') as f:
+        pickle.dump(obj, f)
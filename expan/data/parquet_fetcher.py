@@ -0,0 +1,137 @@
+import logging
+from os import listdir, walk
+from os.path import isdir, isfile, join
+
+import simplejson as json
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as fs
+except ImportError:  # pyarrow is an optional dependency, needed by this fetcher only
+    pa = ds = fs = None
+
+logger = logging.getLogger(__name__)
+
+PARQUET_EXTENSIONS = ('.parquet', '.parq')
+ARROW_EXTENSIONS = ('.arrow', '.feather')
+
+
+def get_data(folder_path, columns=None, categorical_columns=None):
+    """ Expects as input a folder containing the following files:
+
+    - one or more .parquet or Arrow IPC (.arrow, .feather) files with 'data' in the filename,
+      or a directory with 'data' in its name containing such files, e.g. a partitioned Parquet export
+      written by pyarrow.parquet.write_to_dataset or Spark. The hive partitions of the paths
+      (e.g. data/variant=A/part-0.parquet) are read as columns.
+    - one .json containing 'metadata' in the filename
+
+    Reads only the given columns, e.g. the ones returned by schema.required_columns,
+    and the categorical columns (e.g. variant and feature columns) as pandas categoricals.
+    Needs the package pyarrow.
+
+    :param folder_path: path to the Experiment data
+    :type  folder_path: str
+    :param columns: names of the columns to read, or None to read all columns
+    :type  columns: list[str]
+    :param categorical_columns: names of the columns to read as categoricals
+    :type  categorical_columns: list[str]
+    :return: data and metadata
+    :rtype:  tuple[pd.DataFrame, dict]
+    """
+    if pa is None:
+        raise ImportError("The parquet fetcher needs the package pyarrow.")
+
+    try:
+        data_files, metadata = _find_files(folder_path)
+        table = pa.concat_tables([_open_dataset(f, base_dir, columns).to_table(columns=columns)
+                                  for f, base_dir in data_files])
+        data = table.to_pandas(categories=list(categorical_columns or []))
+        logger.info("Read {} rows and {} columns from {} files.".format(len(data), len(data.columns), len(data_files)))
+        return data, metadata
+
+    except AssertionError as e:
+        logger.error("An error occurred when fetching data from parquet or arrow files.")
+        raise e
+
+
+def get_data_chunks(folder_path, chunksize, columns=None, categorical_columns=None):
+    """ Expects the same folder as get_data, but reads the data lazily in chunks of at most chunksize rows,
+    e.g. for Experiment.analyze_chunks on data which does not fit into memory.
+    The files are read in batches and Arrow IPC files are memory-mapped. Needs the package pyarrow.
+
+    :param folder_path: path to the Experiment data
+    :type  folder_path: str
+    :param chunksize: maximum number of rows of a chunk
+    :type  chunksize: int
+    :param columns: names of the columns to read, or None to read all columns
+    :type  columns: list[str]
+    :param categorical_columns: names of the columns to read as categoricals
+    :type  categorical_columns: list[str]
+    :return: iterator over the chunks of the data, and metadata
+    :rtype:  tuple[iterator, dict]
+    """
+    if pa is None:
+        raise ImportError("The parquet fetcher needs the package pyarrow.")
+
+    try:
+        data_files, metadata = _find_files(folder_path)
+        return _iterate_chunks(data_files, chunksize, columns, list(categorical_columns or [])), metadata
+
+    except AssertionError as e:
+        logger.error("An error occurred when fetching data from parquet or arrow files.")
+        raise e
+
+
+def _find_files(folder_path):
+    """ Data files and metadata of a folder of Parquet or Arrow IPC data.
+    The data files are pairs of the file and of the directory its hive partitions are relative to. """
+    entries = sorted(listdir(folder_path))
+    files = [f for f in entries if isfile(join(folder_path, f))]
+    data_files = [(join(folder_path, f), folder_path) for f in files if 'data' in f and _is_columnar(f)]
+    for directory in [join(folder_path, d) for d in entries if 'data' in d and isdir(join(folder_path, d))]:
+        data_files += [(f, directory) for f in _walk_columnar_files(directory)]
+
+    assert data_files
+    assert ('metadata' in '-'.join(files))
+    metadata = None
+    for f in files:
+        if 'metadata' in f:
+            with open(join(folder_path, f), 'r') as input_json:
+                metadata = json.load(input_json)
+    return data_files, metadata
+
+
+def _walk_columnar_files(directory):
+    """ Parquet and Arrow IPC files of a directory and of its partition directories, in sorted order.
+    Hidden files and files starting with an underscore (e.g. _SUCCESS or _metadata) are skipped. """
+    data_files = []
+    for root, directories, files in walk(directory):
+        directories[:] = sorted(d for d in directories if not d.startswith(('.', '_')))
+        data_files += [join(root, f) for f in sorted(files) if not f.startswith(('.', '_')) and _is_columnar(f)]
+    return data_files
+
+
+def _iterate_chunks(data_files, chunksize, columns, categorical_columns):
+    """ Yields the data of the files as data frames of at most chunksize rows.
+    The files are scanned record batch by record batch, so that only one chunk of the data is held in memory at a time. """
+    for file_name, base_dir in data_files:
+        for batch in _open_dataset(file_name, base_dir, columns).to_batches(columns=columns, batch_size=chunksize):
+            yield pa.Table.from_batches([batch]).to_pandas(categories=categorical_columns)
+
+
+def _is_columnar(file_name):
+    """ Whether the file is a Parquet or an Arrow IPC file. """
+    return file_name.endswith(PARQUET_EXTENSIONS + ARROW_EXTENSIONS)
+
+
+def _open_dataset(file_name, base_dir, columns):
+    """ Opens a Parquet or a memory-mapped Arrow IPC file as a dataset, with the hive partitions of its path
+    relative to base_dir as columns, and checks that it has the given columns. """
+    file_format = 'parquet' if file_name.endswith(PARQUET_EXTENSIONS) else 'ipc'
+    dataset = ds.dataset([file_name], format=file_format, partitioning='hive', partition_base_dir=base_dir,
+                         filesystem=fs.LocalFileSystem(use_mmap=True))
+    missing = [column for column in columns or [] if column not in dataset.schema.names]
+    if missing:
+        raise KeyError("Columns {} do not exist in {}.".format(missing, file_name))
+    return dataset
@@ -0,0 +1,27 @@
+from collections import OrderedDict
+
+from expan.core.statistical_test import DerivedKPI
+
+
+def required_columns(kpis, variants, features=None):
+    """ Columns of the data needed to analyze the given KPIs, variants and features,
+    so that fetchers can read only these columns.
+
+    :param kpis: KPIs to analyze
+    :type  kpis: list[KPI]
+    :param variants: variants to compare
+    :type  variants: Variants
+    :param features: features of subgroups
+    :type  features: list[FeatureFilter]
+
+    :return: names of all needed columns, and names of the columns holding categories (variant and features)
+    :rtype: tuple[list[str], list[str]]
+    """
+    categorical_columns = [variants.variant_column_name] + [feature.column_name for feature in features or []]
+    columns = ['entity'] + categorical_columns
+    for kpi in kpis:
+        if type(kpi) is DerivedKPI:
+            columns += [kpi.numerator, kpi.denominator]
+        else:
+            columns.append(kpi.name)
+    return list(OrderedDict.fromkeys(columns)), list(OrderedDict.fromkeys(categorical_columns))
@@ -45,6 +45,10 @@ setup(
 	package_dir={'expan': 'expan'},
 	include_package_data=True,
 	install_requires=requirements,
+	extras_require={
+		# columnar (Parquet, Arrow IPC) data fetcher
+		'parquet': ['pyarrow >= 3.0.0']
+	},
 	license="MIT",
 	zip_safe=False,
 	keywords='expan',
@@ -175,6 +175,32 @@ class CreateNumericalBinsTestCase(BinningTestCase):
         ]
         self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
 
+    def test_creation_many_bins(self):
+        data = np.random.randn(100000)
+        nbins = 5000
+        bins = create_bins(data, nbins)
+        self.assertEqual(len(bins), nbins)
+
+        bins_repr_source = toBinRepresentation(bins)
+        self.assertEqual(bins_repr_source[0].lower, data.min())
+        self.assertEqual(bins_repr_source[-1].upper, data.max())
+        for previous, current in zip(bins_repr_source[:-1], bins_repr_source[1:]):
+            self.assertEqual(previous.upper, current.lower)
+
+        codes = assign_bins(pd.DataFrame({'A': data}), 'A', bins)
+        self.assertTrue((codes >= 0).all())
+        self.assertEqual(np.bincount(codes).max(), 20)
+
+    def test_creation_single_bin_with_nan(self):
+        data = [1.0, 1.0, np.nan]
+        bins = create_bins(data, 1)
+        bins_repr_source = toBinRepresentation(bins)
+        bins_repr_expected = [
+            NumericalRepresentation(np.nan, np.nan, True, True),
+            NumericalRepresentation(1.0, 1.0, True, True)
+        ]
+        self.assertEqual(str(bins_repr_source), str(bins_repr_expected))
+
 
 class ApplyNumericalBinsTestCase(BinningTestCase):
     """
@@ -248,6 +274,26 @@ class CreateCategoricalBinsTestCase(BinningTestCase):
         ]
         self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
 
+    def test_categorical_binning_ties(self):
+        data = ['a'] * 3 + ['b'] * 3 + ['c'] * 2 + ['d'] * 2 + ['e']
+        bins = create_bins(data, 2)
+        bins_repr_source = toBinRepresentation(bins)
+        bins_repr_expected = [
+            CategoricalRepresentation(["a", "d", "e"]),
+            CategoricalRepresentation(["b", "c"])
+        ]
+        self.assertCollectionEqual(bins_repr_source, bins_repr_expected)
+
+    def test_categorical_binning_many_categories(self):
+        data = pd.Series(np.random.randint(0, 100000, 500000)).astype(str).values
+        bins = create_bins(data, 10)
+        self.assertEqual(len(bins), 10)
+
+        codes = assign_bins(pd.DataFrame({'a': data}), 'a', bins)
+        self.assertTrue((codes >= 0).all())
+        bin_sizes = np.bincount(codes)
+        self.assertLess(bin_sizes.max() - bin_sizes.min(), 0.01 * len(data))
+
     def test_categorical_binning_too_little_data(self):
         data = ['a'] * 10 + ['b'] * 5 + ['c'] * 5
         bins = create_bins(data, 4)
@@ -301,3 +347,55 @@ class ApplyCategoricalBinsTestCase(BinningTestCase):
 
         bin = Bin("categorical", ["a", "b"])
         np.testing.assert_array_equal(np.array([["a", "b", "a", "b"]]).T, bin(data, "a"))
+
+
+#---------- Bin assignment tests ------------#
+class AssignBinsTestCase(BinningTestCase):
+    """
+    Test cases for assigning data to bin codes in one pass.
+    """
+    def assertCodesMatchBins(self, data, feature, bins):
+        expected = np.full(len(data), -1)
+        for code, bin in enumerate(bins):
+            expected[data.index.get_indexer(bin(data, feature).index)] = code
+        np.testing.assert_array_equal(assign_bins(data, feature, bins), expected)
+
+    def test_assign_numerical(self):
+        data = pd.DataFrame({'A': np.random.randint(0, 20, 1000).astype(float)})
+        bins = [Bin("numerical", 0, 5, True, False),
+                Bin("numerical", 15, 19, True, True),
+                Bin("numerical", 5, 5, True, True),
+                Bin("numerical", 5, 10, False, True),
+                Bin("numerical", 10, 15, False, False)]
+        self.assertCodesMatchBins(data, 'A', bins)
+        self.assertTrue((assign_bins(data, 'A', bins)[data.A == 15] == 1).all())
+        self.assertTrue((assign_bins(data, 'A', bins)[data.A == 10] == 3).all())
+
+    def test_assign_numerical_with_nan_bin(self):
+        data = pd.DataFrame({'A': np.random.exponential(size=1000)})
+        data.loc[:19, 'A'] = np.nan
+        bins = [Bin("numerical", np.nan, np.nan, True, True),
+                Bin("numerical", 0.0, 0.5, True, False),
+                Bin("numerical", 0.5, 1.0, True, False),
+                Bin("numerical", 1.0, data.A.max(), True, True)]
+        self.assertCodesMatchBins(data, 'A', bins)
+
+    def test_assign_unseen_and_nan_data(self):
+        data = pd.DataFrame({'A': [-1.0, 0.0, 5.0, 10.0, np.nan]})
+        codes = assign_bins(data, 'A', [Bin("numerical", 0, 10, True, False)])
+        np.testing.assert_array_equal(codes, [-1, 0, 0, -1, -1])
+
+        codes = assign_bins(data, 'A', [Bin("numerical", 0, 10, True, False),
+                                        Bin("numerical", np.nan, np.nan, True, True)])
+        np.testing.assert_array_equal(codes, [-1, 0, 0, -1, 1])
+
+    def test_assign_categorical(self):
+        data = pd.DataFrame({'a': ["a", "b", "c", "a", "d"]})
+        bins = [Bin("categorical", ["a", "b"]), Bin("categorical", ["c"])]
+        np.testing.assert_array_equal(assign_bins(data, 'a', bins), [0, 0, 1, 0, -1])
+        np.testing.assert_array_equal(assign_bins(data.astype('category'), 'a', bins), [0, 0, 1, 0, -1])
+
+    def test_assign_mixed_bins(self):
+        data = pd.DataFrame({'a': ["a", "b"]})
+        with self.assertRaises(ValueError):
+            assign_bins(data, 'a', [Bin("categorical", ["a"]), Bin("numerical", 0, 1, True, True)])
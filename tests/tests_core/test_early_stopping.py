@@ -1,8 +1,14 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
+from scipy.integrate import quad
+from scipy.stats import gaussian_kde, gamma
 
 import expan.core.early_stopping as es
+import expan.core.statistics as statx
 from expan.core.util import find_value_by_key_with_condition
 
 
@@ -80,6 +86,67 @@ class GroupSequentialTestCases(EarlyStoppingTestCase):
         np.testing.assert_almost_equal (value025, -0.24461812530841959, decimal=5)
         np.testing.assert_almost_equal (value975, -0.07312917030429833, decimal=5)
 
+    def test_group_sequential_from_sufficient_statistics(self):
+        """ Check that the group sequential function gives the same result on the moments of the samples."""
+        for estimated_sample_size in [None, 3000]:
+            expected = es.group_sequential(self.rand_s5, self.rand_s6, estimated_sample_size=estimated_sample_size)
+            res = es.group_sequential_from_sufficient_statistics(statx.compute_sufficient_statistics(self.rand_s5),
+                                                                 statx.compute_sufficient_statistics(self.rand_s6),
+                                                                 estimated_sample_size=estimated_sample_size)
+
+            self.assertEqual(res.treatment_statistics.sample_size, expected.treatment_statistics.sample_size)
+            self.assertEqual(res.control_statistics.sample_size,   expected.control_statistics.sample_size)
+            self.assertAlmostEqual(res.treatment_statistics.variance, expected.treatment_statistics.variance)
+            self.assertAlmostEqual(res.delta,             expected.delta)
+            self.assertAlmostEqual(res.p,                 expected.p)
+            self.assertAlmostEqual(res.statistical_power, expected.statistical_power)
+            self.assertEqual(res.stop,                    expected.stop)
+            for expected_bound, bound in zip(expected.confidence_interval, res.confidence_interval):
+                self.assertAlmostEqual(bound['value'], expected_bound['value'])
+
+        with self.assertRaises(TypeError):
+            es.group_sequential_from_sufficient_statistics(self.rand_s5, self.rand_s6)
+
+
+class HDITestCases(EarlyStoppingTestCase):
+    """ Test cases for the highest density interval in core.early_stopping."""
+
+    def test_HDI_from_MCMC(self):
+        """ Check the shortest interval containing the credible mass."""
+        samples = [5.0, 0.0, 1.0, 2.0, 3.0, 10.0, 4.0, 2.5, 1.5, -7.0]
+        self.assertEqual(es.HDI_from_MCMC(samples, 0.5), (0.0, 3.0))
+        self.assertEqual(es.HDI_from_MCMC(samples, 0.8), (0.0, 10.0))
+
+    def test_HDI_from_MCMC_several_credible_masses(self):
+        intervals = es.HDI_from_MCMC(self.rand_s1, [0.8, 0.95])
+        self.assertEqual(intervals, [es.HDI_from_MCMC(self.rand_s1, 0.8), es.HDI_from_MCMC(self.rand_s1, 0.95)])
+
+    def test_HDI_from_MCMC_batch(self):
+        batch = np.array([self.rand_s1, self.rand_s2, self.rand_s3])
+        lower, upper = es.HDI_from_MCMC(batch)
+        for i, samples in enumerate(batch):
+            self.assertEqual((lower[i], upper[i]), es.HDI_from_MCMC(samples))
+
+    def test_HDI_from_MCMC_too_few_samples(self):
+        with self.assertRaises(ValueError):
+            es.HDI_from_MCMC([1.0, 2.0], 0.95)
+
+
+class KernelDensityTestCases(EarlyStoppingTestCase):
+    """ Test cases for the kernel density estimate in core.early_stopping."""
+
+    def test_kernel_density_matches_gaussian_kde(self):
+        """ Check the density against scipy's gaussian_kde within the documented tolerance."""
+        points = [0.0, -0.3, 1.5]
+        for samples in [self.rand_s1, self.rand_s4, np.random.standard_cauchy(5000)]:
+            expected = gaussian_kde(samples).evaluate(points)
+            np.testing.assert_allclose(es.kernel_density(samples, points), expected, rtol=1e-10)
+            self.assertAlmostEqual(es.kernel_density(samples, 0), expected[0], delta=1e-10 * expected[0])
+
+    def test_kernel_density_too_few_samples(self):
+        with self.assertRaises(ValueError):
+            es.kernel_density([1.0])
+
 
 class BayesFactorTestCases(EarlyStoppingTestCase):
     """ Test cases for the bayes_factor function in core.early_stopping."""
@@ -132,6 +199,88 @@ class BayesFactorTestCases(EarlyStoppingTestCase):
         res = es.bayes_factor(self.rand_s5, self.rand_s6, num_iters=2000)
         self.assertEqual(res.stop, True)
 
+    def test_bayes_factor_conjugate(self):
+        """ Check the Bayes factor function with the closed form posterior of the normal model."""
+        res = es.bayes_factor(self.rand_s1, self.rand_s2, inference='conjugate')
+
+        self.assertEqual(res.treatment_statistics.sample_size,     1000)
+        self.assertAlmostEqual(res.treatment_statistics.variance,  0.9742344563121542)
+        self.assertAlmostEqual(res.delta, -0.15887364780635896)
+        value025 = find_value_by_key_with_condition(res.confidence_interval, 'percentile', 2.5, 'value')
+        value975 = find_value_by_key_with_condition(res.confidence_interval, 'percentile', 97.5, 'value')
+        np.testing.assert_almost_equal(value025, -0.24293384641452503, decimal=2)
+        np.testing.assert_almost_equal(value975, -0.075064346336461404, decimal=2)
+        self.assertEqual(res.p,                 None)
+        self.assertEqual(res.statistical_power, None)
+        self.assertEqual(res.stop,              True)
+
+    def test_bayes_factor_conjugate_poisson(self):
+        """ Check the Bayes factor function with the closed form posterior of the Poisson model."""
+        res = es.bayes_factor(self.rand_s3, self.rand_s4, distribution='poisson', inference='conjugate')
+
+        self.assertAlmostEqual(res.delta, -1.9589999999999999)
+        value025 = find_value_by_key_with_condition(res.confidence_interval, 'percentile', 2.5, 'value')
+        value975 = find_value_by_key_with_condition(res.confidence_interval, 'percentile', 97.5, 'value')
+        np.testing.assert_almost_equal(value025, -2.0713281392132465, decimal=1)
+        np.testing.assert_almost_equal(value975, -1.8279692168150592, decimal=1)
+        self.assertEqual(res.stop,              True)
+
+    def test_bayes_factor_several_credible_intervals(self):
+        """ Check the Bayes factor function with several credible masses."""
+        res = es.bayes_factor(self.rand_s1, self.rand_s2, inference='conjugate', credible_mass=[0.95, 0.8])
+        expected = es.bayes_factor(self.rand_s1, self.rand_s2, inference='conjugate')
+
+        self.assertEqual(sorted(item['percentile'] for item in res.confidence_interval), [2.5, 10.0, 90.0, 97.5])
+        for percentile in [2.5, 97.5]:
+            self.assertEqual(find_value_by_key_with_condition(res.confidence_interval, 'percentile', percentile, 'value'),
+                             find_value_by_key_with_condition(expected.confidence_interval, 'percentile', percentile,
+                                                              'value'))
+
+    def test_conjugate_inference(self):
+        """ Check the posterior samples of the closed form inference."""
+        traces, n_x, n_y, mu_x, mu_y = es._bayes_sampling(self.rand_s5, self.rand_s6, inference='conjugate')
+        self.assertEqual(sorted(traces.keys()), ['alpha', 'delta', 'mu', 'sigma'])
+        self.assertEqual(len(traces['delta']), es.CONJUGATE_NUM_SAMPLES)
+        self.assertEqual(n_x, 999)
+        self.assertEqual(n_y, 998)
+        np.testing.assert_almost_equal(np.mean(traces['delta']), mu_x - mu_y, decimal=2)
+
+        with self.assertRaises(ValueError):
+            es._bayes_sampling(self.rand_s1, self.rand_s2, inference='unknown')
+
+    def test_conjugate_bayes_factor_matches_its_prior(self):
+        """ The Savage-Dickey ratio of the conjugate normal model equals its Bayes factor in closed form."""
+        x, y = self.rand_s1, self.rand_s2 - 0.15
+        traces = es._bayes_sampling(x, y, inference='conjugate')[0]
+        bf = es.kernel_density(traces['alpha'], 0) / es._conjugate_prior_density_at_zero('normal', traces)
+
+        n, scale, difference = len(x) + len(y), 1.0 / len(x) + 1.0 / len(y), np.mean(x) - np.mean(y)
+        squared_deviations = np.sum((x - np.mean(x)) ** 2) + np.sum((y - np.mean(y)) ** 2)
+        expected = np.sqrt((1 + scale) / scale) * ((squared_deviations + difference ** 2 / scale) /
+                                                   (squared_deviations + difference ** 2 / (1 + scale))) ** (-(n - 1) / 2.0)
+        np.testing.assert_allclose(bf, expected, rtol=0.15)
+
+    def test_conjugate_poisson_prior_density(self):
+        """ The prior density of the conjugate poisson model at zero is the density of the difference of its rates."""
+        shape, rate = es.CONJUGATE_POISSON_PRIOR
+        density_of_delta = quad(lambda rate_value: gamma.pdf(rate_value, shape, scale=1.0 / rate) ** 2, 0, np.inf)[0]
+        traces = {'delta': np.array([4.0, 4.0])}
+        self.assertAlmostEqual(es._conjugate_prior_density_at_zero('poisson', traces), 2.0 * density_of_delta)
+
+    def test_poisson_with_negative_data(self):
+        """ Negative data of the poisson model is rejected."""
+        with self.assertRaises(ValueError):
+            es.bayes_factor(self.rand_s1, self.rand_s2, distribution='poisson', inference='conjugate')
+
+    def test_conjugate_poisson_derived_kpi(self):
+        """ The counts of a derived KPI divided by the mean denominator are used as they are."""
+        np.random.seed(0)
+        num_x, num_y = np.random.poisson(3, 1000), np.random.poisson(2, 1000)
+        den_x, den_y = np.random.poisson(2, 1000) + 1, np.random.poisson(2, 1000) + 1
+        for make_worker in [es.make_bayes_factor, es.make_bayes_precision]:
+            res = make_worker('poisson', inference='conjugate')(num_x, num_y, den_x, den_y)
+            np.testing.assert_almost_equal(res.delta, np.mean(num_x) / np.mean(den_x) - np.mean(num_y) / np.mean(den_y))
+
     def test_variational_inference(self):
         """ Check bayesian sampling using variational bayes."""
         traces, n_x, n_y, mu_x, mu_y = es._bayes_sampling(self.rand_s1, self.rand_s2,
@@ -166,5 +315,220 @@ class BayesPrecisionTestCases(EarlyStoppingTestCase):
         self.assertEqual(res.statistical_power, None)
         self.assertEqual(res.stop,              False)
 
+    def test_bayes_precision_conjugate(self):
+        """ Check the bayes_precision function with the closed form posterior."""
+        res = es.bayes_precision(self.rand_s1, self.rand_s2, inference='conjugate')
+
+        self.assertEqual(res.treatment_statistics.sample_size, 1000)
+        self.assertAlmostEqual(res.delta, -0.15887364780635896)
+        value025 = find_value_by_key_with_condition(res.confidence_interval, 'percentile', 2.5, 'value')
+        value975 = find_value_by_key_with_condition(res.confidence_interval, 'percentile', 97.5, 'value')
+        np.testing.assert_almost_equal(value025, -0.24293384641452503, decimal=2)
+        np.testing.assert_almost_equal(value975, -0.07506434633646140, decimal=2)
+        self.assertEqual(res.stop,              False)
+
+class FakeStanModel(object):
+    """ Stands in for a compiled pystan.StanModel and counts the compilations. """
+    compilations = 0
+
+    def __init__(self, model_code, model_name):
+        FakeStanModel.compilations += 1
+        self.model_code = model_code
+        self.model_name = model_name
+
+
+class FakeStanFit(object):
+    """ Stands in for the fit of a pystan.StanModel with normally distributed traces. """
+    def extract(self):
+        return {'alpha': np.random.normal(size=1000), 'delta': np.random.normal(size=1000)}
+
+
+class FakeSamplingStanModel(object):
+    """ Stands in for a compiled pystan.StanModel and records the arguments of sampling. """
+    def __init__(self):
+        self.sampling_args = None
+
+    def sampling(self, **sampling_args):
+        self.sampling_args = sampling_args
+        return FakeStanFit()
+
+    def vb(self, **vb_args):
+        self.sampling_args = vb_args
+        return {'sampler_param_names': ['alpha', 'delta'],
+                'sampler_params': [np.random.normal(size=1000), np.random.normal(size=1000)]}
+
+
+class SamplerSettingsTestCases(EarlyStoppingTestCase):
+    """ Test cases for the settings of the MCMC sampler in core.early_stopping."""
+
+    def setUp(self):
+        super(SamplerSettingsTestCases, self).setUp()
+        self.model = FakeSamplingStanModel()
+        es.sampling_results.clear()
+        self.get_or_compile_stan_model = es.get_or_compile_stan_model
+        es.get_or_compile_stan_model = lambda model_file, distribution: self.model
+
+    def tearDown(self):
+        es.get_or_compile_stan_model = self.get_or_compile_stan_model
+
+    def test_default_sampler_settings(self):
+        es.bayes_factor(self.rand_s1, self.rand_s2, num_iters=2000)
+        self.assertEqual(self.model.sampling_args['iter'], 2000)
+        self.assertEqual(self.model.sampling_args['chains'], 4)
+        self.assertEqual(self.model.sampling_args['n_jobs'], 1)
+        self.assertEqual(self.model.sampling_args['control'], es.DEFAULT_SAMPLING_CONTROL)
+        self.assertFalse('warmup' in self.model.sampling_args)
+
+    def test_sampler_settings_of_closures(self):
+        control = {'adapt_delta': 0.9}
+        for make_worker in [es.make_bayes_factor, es.make_bayes_precision]:
+            worker = make_worker(num_iters=1000, chains=2, n_jobs=-1, warmup=200, control=control)
+            worker(self.rand_s1, self.rand_s2)
+            self.assertEqual(self.model.sampling_args['iter'], 1000)
+            self.assertEqual(self.model.sampling_args['chains'], 2)
+            self.assertEqual(self.model.sampling_args['n_jobs'], -1)
+            self.assertEqual(self.model.sampling_args['warmup'], 200)
+            self.assertEqual(self.model.sampling_args['control'], control)
+
+    def test_poisson_derived_kpi(self):
+        """ The Stan model of a derived poisson KPI gets the scaled counts truncated to integers."""
+        num_x, num_y = np.array([3, 4, 5, 6]), np.array([1, 2, 3, 4])
+        den_x, den_y = np.array([1, 2, 2, 3]), np.array([2, 2, 2, 2])
+        for make_worker in [es.make_bayes_factor, es.make_bayes_precision]:
+            make_worker('poisson')(num_x, num_y, den_x, den_y)
+            np.testing.assert_array_equal(self.model.sampling_args['data']['x'], [1, 2, 2, 3])
+            np.testing.assert_array_equal(self.model.sampling_args['data']['y'], [0, 1, 1, 2])
+
+    def test_variational_inference_is_seeded(self):
+        es._bayes_sampling(self.rand_s1, self.rand_s2, inference='variational')
+        self.assertEqual(self.model.sampling_args['seed'], 1)
+
+
+class PosteriorCacheTestCases(EarlyStoppingTestCase):
+    """ Test cases for the cache of posterior samples in core.early_stopping."""
+
+    def setUp(self):
+        super(PosteriorCacheTestCases, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_posterior_cache_key(self):
+        """ Check that the key depends on every value of the samples and on the settings. """
+        x = np.arange(2000, dtype=float)
+        changed_x = x.copy()
+        changed_x[1000] = -1.0
+        self.assertEqual(str(x), str(changed_x))
+
+        key = es._posterior_cache_key(x, self.rand_s2, 'normal', num_iters=2000)
+        self.assertEqual(key, es._posterior_cache_key(x.copy(), self.rand_s2.copy(), 'normal', num_iters=2000))
+        self.assertNotEqual(key, es._posterior_cache_key(changed_x, self.rand_s2, 'normal', num_iters=2000))
+        self.assertNotEqual(key, es._posterior_cache_key(x, self.rand_s2, 'poisson', num_iters=2000))
+        self.assertNotEqual(key, es._posterior_cache_key(x, self.rand_s2, 'normal', num_iters=1000))
+        self.assertNotEqual(es._posterior_cache_key(x[:1], x[1:3], 'normal'),
+                            es._posterior_cache_key(x[:2], x[2:3], 'normal'))
+
+    def test_least_recently_used_results_are_evicted(self):
+        cache = es.PosteriorCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_results_on_disk(self):
+        cache = es.PosteriorCache(max_entries=1, cache_dir=self.cache_dir)
+        cache.put('a', {'delta': self.rand_s1})
+        cache.put('b', {'delta': self.rand_s2})
+
+        other_cache = es.PosteriorCache(cache_dir=self.cache_dir)
+        self.assertTrue('a' in other_cache)
+        np.testing.assert_array_equal(other_cache.get('a')['delta'], self.rand_s1)
+        np.testing.assert_array_equal(other_cache.get('b')['delta'], self.rand_s2)
+        self.assertEqual(other_cache.get('c'), None)
+
+    def test_bayes_sampling_is_cached(self):
+        es.sampling_results.clear()
+        traces = es._bayes_sampling(self.rand_s1, self.rand_s2, inference='conjugate')[0]
+        cached_traces = es._bayes_sampling(self.rand_s1, self.rand_s2, inference='conjugate')[0]
+        other_traces = es._bayes_sampling(self.rand_s3, self.rand_s4, distribution='poisson', inference='conjugate')[0]
+
+        np.testing.assert_array_equal(cached_traces['delta'], traces['delta'])
+        self.assertFalse(np.array_equal(other_traces['delta'], traces['delta']))
+
+        # changing the returned traces does not change the cached ones
+        expected = traces['delta'].copy()
+        traces['delta'][:] = 0.0
+        cached_traces.pop('delta')
+        traces = es._bayes_sampling(self.rand_s1, self.rand_s2, inference='conjugate')[0]
+        np.testing.assert_array_equal(traces['delta'], expected)
+
+
+class StanModelCacheTestCases(unittest.TestCase):
+    """ Test cases for the cache of compiled Stan models in core.early_stopping."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.model_file = os.path.join(self.cache_dir, 'normal_kpi.stan')
+        with open(self.model_file, 'w') as f:
+            f.write('model { }')
+        self.stan_model = es.StanModel
+        es.StanModel = FakeStanModel
+        FakeStanModel.compilations = 0
+
+    def tearDown(self):
+        es.StanModel = self.stan_model
+        shutil.rmtree(self.cache_dir)
+
+    def test_compiled_model_is_cached(self):
+        """ Check that a model is compiled only once. """
+        model = es.get_or_compile_stan_model(self.model_file, 'normal', self.cache_dir)
+        cached_model = es.get_or_compile_stan_model(self.model_file, 'normal', self.cache_dir)
+
+        self.assertEqual(FakeStanModel.compilations, 1)
+        self.assertEqual(cached_model.model_code, model.model_code)
+        self.assertEqual(cached_model.model_name, 'normal_kpi')
+        compiled_model_files = [name for name in os.listdir(self.cache_dir) if name.endswith('.pkl')]
+        self.assertEqual(len(compiled_model_files), 1)
+
+    def test_changed_model_is_compiled_again(self):
+        """ Check that a changed model source does not load the stale model. """
+        es.get_or_compile_stan_model(self.model_file, 'normal', self.cache_dir)
+        with open(self.model_file, 'w') as f:
+            f.write('model { } // changed')
+        model = es.get_or_compile_stan_model(self.model_file, 'normal', self.cache_dir)
+
+        self.assertEqual(FakeStanModel.compilations, 2)
+        self.assertEqual(model.model_code, 'model { } // changed')
+
+    def test_corrupted_model_is_compiled_again(self):
+        """ Check that an unreadable cache file is replaced. """
+        es.get_or_compile_stan_model(self.model_file, 'normal', self.cache_dir)
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                with open(os.path.join(self.cache_dir, name), 'wb') as f:
+                    f.write(b'corrupted')
+        model = es.get_or_compile_stan_model(self.model_file, 'normal', self.cache_dir)
+
+        self.assertEqual(FakeStanModel.compilations, 2)
+        self.assertEqual(model.model_code, 'model { }')
+
+    def test_compile_stan_models(self):
+        """ Check that the warm-up compiles every model once. """
+        es.compile_stan_models(cache_dir=self.cache_dir)
+        es.compile_stan_models(cache_dir=self.cache_dir)
+        self.assertEqual(FakeStanModel.compilations, 2)
+
+    def test_unknown_distribution(self):
+        with self.assertRaises(ValueError):
+            es.get_or_compile_stan_model(self.model_file, 'unknown', self.cache_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,13 +1,19 @@
 from __future__ import division # so that, under Python 2.*, integer division results in real numbers
 
+import threading
 import unittest
 import warnings
+from multiprocessing import Pool
 
 import numpy as np
 
-from expan.core.results import CombinedTestStatistics
+import expan.core.binning as binning
+import expan.core.correction as correction
+import expan.core.statistics as statx
+from expan.core.results import CombinedTestStatistics, OutlierFilterReport
 from expan.core.statistical_test import *
 from expan.core.experiment import Experiment
+from expan.core.quantile_sketch import sketch_kpis
 from expan.core.util import generate_random_data, find_value_by_key_with_condition
 
 
@@ -284,6 +290,220 @@ class StatisticalTestSuiteTestCases(ExperimentTestCase):
         self.assertEqual(res.correction_method, CorrectionMethod.NONE)
         self.assertEqual(len(res.results), 0)
 
+    def assertParallelSuiteMatchesSerial(self, experiment, suite, test_method='fixed_horizon', **worker_args):
+        """ Analyzes copies of the suite with one and with two workers and compares the results. """
+        def copy_of_suite():
+            tests = [StatisticalTest(test.data, test.kpi, test.features, test.variants) for test in suite.tests]
+            return StatisticalTestSuite(tests, suite.correction_method)
+
+        serial = self.getExperiment().analyze_statistical_test_suite(copy_of_suite(), test_method, **worker_args)
+        parallel = experiment.analyze_statistical_test_suite(copy_of_suite(), test_method, n_workers=2, **worker_args)
+
+        self.assertEqual(parallel.correction_method, serial.correction_method)
+        self.assertEqual(len(parallel.results), len(serial.results))
+        for expected, actual in zip(serial.results, parallel.results):
+            self.assertEqual(actual.test.features, expected.test.features)
+            self.assertEqual(actual.result.toJson(), expected.result.toJson())
+
+    def test_parallel_suite_in_threads(self):
+        self.assertParallelSuiteMatchesSerial(self.getExperiment(), self.suite_with_three_subgroups)
+        self.assertParallelSuiteMatchesSerial(self.getExperiment(), self.suite_with_two_tests, 'group_sequential')
+
+    def test_parallel_suite_in_threads_with_seeded_bootstrap(self):
+        self.assertParallelSuiteMatchesSerial(self.getExperiment(), self.suite_with_three_subgroups,
+                                              assume_normal=False, nruns=2000, seed=42)
+
+    def test_parallel_suite_in_threads_with_jobs(self):
+        # worker threads do not fork the processes of the bootstrap, hence they run with n_jobs=1
+        pool, threads = statx.Pool, []
+        def recording_pool(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return pool(*args, **kwargs)
+        try:
+            statx.Pool = recording_pool
+            self.assertParallelSuiteMatchesSerial(self.getExperiment(), self.suite_with_three_subgroups,
+                                                  assume_normal=False, nruns=2000, seed=42, n_jobs=2)
+        finally:
+            statx.Pool = pool
+        self.assertTrue(threads)
+        self.assertEqual(set(threads), {threading.current_thread().name})
+
+    def test_parallel_suite_in_processes(self):
+        experiment = self.getExperiment()
+        experiment.pool_table['fixed_horizon'] = Pool
+        self.assertParallelSuiteMatchesSerial(experiment, self.suite_with_two_tests)
+
+    def test_parallel_suite_in_processes_with_jobs(self):
+        # worker processes cannot start processes themselves, hence they run with n_jobs=1
+        experiment = self.getExperiment()
+        experiment.pool_table['fixed_horizon'] = Pool
+        self.assertParallelSuiteMatchesSerial(experiment, self.suite_with_two_tests,
+                                              assume_normal=False, nruns=2000, seed=42, n_jobs=2)
+
+    def test_corrected_bootstrap_suite(self):
+        # the corrected statistics of the bootstrap are computed from its distribution, without resampling
+        worker_args = {'assume_normal': False, 'nruns': 2000, 'seed': 42}
+        def analyze(test, **args):
+            test = StatisticalTest(test.data, test.kpi, test.features, test.variants)
+            return self.getExperiment().analyze_statistical_test(test, **dict(worker_args, **args)).result
+
+        tests = self.suite_with_three_subgroups.tests
+        # tests without enough entities have no result
+        expected = [(test, result) for test, result in [(test, analyze(test)) for test in tests] if result is not None]
+        corrected_alpha = correction.benjamini_hochberg(0.05, [result.p for _, result in expected])
+
+        suite = StatisticalTestSuite([StatisticalTest(test.data, test.kpi, test.features, test.variants)
+                                      for test in tests], CorrectionMethod.BH)
+        calls = []
+        bootstrap = statx.bootstrap
+        def counting_bootstrap(*args, **kwargs):
+            calls.append(kwargs['nruns'])
+            return bootstrap(*args, **kwargs)
+        statx.bootstrap = counting_bootstrap
+        try:
+            res = self.getExperiment().analyze_statistical_test_suite(suite, **worker_args)
+        finally:
+            statx.bootstrap = bootstrap
+
+        self.assertEqual(calls, [2000] * len(expected))
+        self.assertEqual(len(res.results), len(expected))
+        for item, (test, result) in zip(res.results, expected):
+            self.assertEqual(item.result.original_test_statistics.toJson(), result.toJson())
+            self.assertEqual(item.result.corrected_test_statistics.toJson(),
+                             analyze(test, alpha=corrected_alpha).toJson())
+
+    def test_parallel_suite_with_invalid_number_of_workers(self):
+        with self.assertRaises(ValueError):
+            self.getExperiment().analyze_statistical_test_suite(self.suite_with_one_test, n_workers=0)
+
+    def assertGroupbyEngineMatchesPerTest(self, suite):
+        """ Analyzes copies of the suite with both engines and compares the results. """
+        def copy_of_suite():
+            tests = [StatisticalTest(test.data, test.kpi, test.features, test.variants) for test in suite.tests]
+            return StatisticalTestSuite(tests, suite.correction_method)
+
+        per_test = self.getExperiment().analyze_statistical_test_suite(copy_of_suite())
+        groupby = self.getExperiment().analyze_statistical_test_suite(copy_of_suite(), engine='groupby')
+
+        self.assertEqual(groupby.correction_method, per_test.correction_method)
+        self.assertEqual(len(groupby.results), len(per_test.results))
+        for expected, actual in zip(per_test.results, groupby.results):
+            self.assertEqual(actual.test.kpi.name, expected.test.kpi.name)
+            self.assertEqual(actual.test.features, expected.test.features)
+            for statistics in ['original_test_statistics', 'corrected_test_statistics']:
+                expected_statistics = getattr(expected.result, statistics)
+                actual_statistics = getattr(actual.result, statistics)
+                self.assertAlmostEqual(actual_statistics.delta, expected_statistics.delta)
+                self.assertAlmostEqual(actual_statistics.p, expected_statistics.p)
+                self.assertAlmostEqual(actual_statistics.statistical_power, expected_statistics.statistical_power)
+                self.assertEqual(actual_statistics.treatment_statistics.sample_size,
+                                 expected_statistics.treatment_statistics.sample_size)
+                self.assertEqual(actual_statistics.control_statistics.sample_size,
+                                 expected_statistics.control_statistics.sample_size)
+                for expected_bound, actual_bound in zip(expected_statistics.confidence_interval,
+                                                        actual_statistics.confidence_interval):
+                    self.assertAlmostEqual(actual_bound['value'], expected_bound['value'])
+
+    def test_correction_without_second_analysis(self):
+        """ The corrected statistics are computed from the first analysis of each test. """
+        experiment = self.getExperiment()
+        analyzed_tests = []
+        analyze_statistical_test = experiment._analyze_statistical_test
+
+        def counting_analyze_statistical_test(test, test_method, **worker_args):
+            analyzed_tests.append(test)
+            return analyze_statistical_test(test, test_method, **worker_args)
+        experiment._analyze_statistical_test = counting_analyze_statistical_test
+
+        res = experiment.analyze_statistical_test_suite(self.suite_with_two_tests, 'group_sequential')
+        self.assertEqual(len(analyzed_tests), 2)
+        self.assertEqual(res.correction_method, CorrectionMethod.BONFERRONI)
+        for item in res.results:
+            original = item.result.original_test_statistics
+            corrected = item.result.corrected_test_statistics
+            self.assertAlmostEqual(corrected.delta, original.delta)
+            self.assertAlmostEqual(corrected.p, original.p)
+            self.assertLess(corrected.statistical_power, original.statistical_power)
+
+        test_derived_kpi = StatisticalTest(self.data, self.derived_kpi, [], self.variants)
+        expected = self.getExperiment().analyze_statistical_test(test_derived_kpi, 'group_sequential', alpha=0.025)
+        corrected = res.results[1].result.corrected_test_statistics
+        self.assertAlmostEqual(corrected.statistical_power, expected.result.statistical_power)
+        self.assertEqual(corrected.stop, expected.result.stop)
+        for expected_bound, bound in zip(expected.result.confidence_interval, corrected.confidence_interval):
+            self.assertAlmostEqual(bound['value'], expected_bound['value'])
+
+    def test_groupby_engine_two_tests_in_suite(self):
+        self.assertGroupbyEngineMatchesPerTest(self.suite_with_two_tests)
+
+    def test_groupby_engine_three_subgroups_in_suite(self):
+        self.assertGroupbyEngineMatchesPerTest(self.suite_with_three_subgroups)
+
+    def test_groupby_engine_with_zero_std_and_nan_data(self):
+        self.assertGroupbyEngineMatchesPerTest(self.suite_with_one_test_zero_std)
+        self.assertGroupbyEngineMatchesPerTest(self.suite_with_one_test_with_nan_data)
+
+    def test_groupby_engine_with_categorical_columns(self):
+        # categorical columns with an empty cell of segment and variant, as read by the data fetchers
+        data = self.data[~((self.data.feature == 'non') & (self.data.variant == 'A'))].copy()
+        data['variant'] = data.variant.astype('category')
+        data['feature'] = data.feature.astype('category')
+        tests = [StatisticalTest(data, self.kpi, [FeatureFilter('feature', value)], self.variants)
+                 for value in ['has', 'non']]
+        self.assertGroupbyEngineMatchesPerTest(StatisticalTestSuite(tests))
+
+    def test_groupby_engine_with_duplicated_entities(self):
+        data = self.data.copy()
+        data.loc[1, 'entity'] = data.loc[0, 'entity']
+        test = StatisticalTest(data, self.kpi, [], self.variants)
+        with self.assertRaises(ValueError):
+            self.getExperiment().analyze_statistical_test_suite(StatisticalTestSuite([test]), engine='groupby')
+
+    def test_groupby_engine_with_unsupported_arguments(self):
+        with self.assertRaises(ValueError):
+            self.getExperiment().analyze_statistical_test_suite(self.suite_with_one_test, engine='unknown')
+        with self.assertRaises(NotImplementedError):
+            self.getExperiment().analyze_statistical_test_suite(self.suite_with_one_test, 'group_sequential',
+                                                                engine='groupby')
+
+    def test_analyze_feature_bins(self):
+        kpis = [self.kpi, self.derived_kpi]
+        columns = list(self.data.columns)
+        res = self.getExperiment().analyze_feature_bins(self.data, kpis, self.variants, 'normal_unequal_variance', 4)
+
+        self.assertEqual(res.correction_method, CorrectionMethod.BH)
+        self.assertEqual(len(res.results), 8)
+        # the bins are not written to the data of the caller
+        self.assertEqual(list(self.data.columns), columns)
+
+        # the same tests, filtering the data of each bin by hand
+        bins = binning.create_bins(self.data.normal_unequal_variance.values, 4)
+        labels = np.array([str(bin.representation) for bin in bins] + [None], dtype=object)
+        data = self.data.assign(normal_unequal_variance_bin=labels[binning.assign_bins(self.data,
+                                                                                       'normal_unequal_variance', bins)])
+        self.assertEqual(data.normal_unequal_variance_bin.nunique(), 4)
+        for item in res.results:
+            bin_data = item.test.features[0].apply_to_data(data)
+            test = StatisticalTest(bin_data, item.test.kpi, [], self.variants)
+            expected = self.getExperiment().analyze_statistical_test(test).result
+            self.assertAlmostEqual(item.result.original_test_statistics.delta, expected.delta)
+            self.assertAlmostEqual(item.result.original_test_statistics.p, expected.p)
+            self.assertEqual(item.result.original_test_statistics.treatment_statistics.sample_size,
+                             expected.treatment_statistics.sample_size)
+            self.assertLess(item.result.corrected_test_statistics.statistical_power, expected.statistical_power)
+
+    def test_analyze_feature_bins_categorical(self):
+        res = self.getExperiment().analyze_feature_bins(self.data, [self.kpi], self.variants, 'feature', 2,
+                                                        test_method='group_sequential')
+        self.assertEqual(len(res.results), 2)
+        sample_sizes = [item.result.original_test_statistics.treatment_statistics.sample_size +
+                        item.result.original_test_statistics.control_statistics.sample_size for item in res.results]
+        self.assertEqual(sum(sample_sizes), len(self.data))
+
+    def test_analyze_feature_bins_unknown_feature(self):
+        with self.assertRaises(KeyError):
+            self.getExperiment().analyze_feature_bins(self.data, [self.kpi], self.variants, 'unknown', 2)
+
 
 class OutlierFilteringTestCases(ExperimentTestCase):
     """ Test outlier filtering and quantile filtering. """
@@ -328,6 +548,68 @@ class OutlierFilteringTestCases(ExperimentTestCase):
         self.assertEqual(exp.metadata['filtered_entities_per_variant']['A'], 22)
         self.assertEqual(exp.metadata['filtered_entities_per_variant']['B'], 18)
 
+    def test_outlier_filtering_return_mask(self):
+        exp = self.getExperiment()
+        thresholds = { kpi: ('lower', 0.1) for kpi in self.kpi_names }
+        mask = exp.outlier_filter(self.data, kpis=[KPI(kpi) for kpi in self.kpi_names],
+                                  thresholds=thresholds, return_mask=True)
+        data = exp.outlier_filter(self.data, kpis=[KPI(kpi) for kpi in self.kpi_names], thresholds=thresholds)
+
+        self.assertEqual(mask.dtype, bool)
+        self.assertEqual(len(mask), len(self.data))
+        self.assertEqual(len(self.data) - mask.sum(), exp.metadata['filtered_entities_number'])
+        self.assertTrue(self.data[mask].equals(data))
+
+    def test_outlier_filtering_with_sketches(self):
+        exp = self.getExperiment()
+        kpis = [KPI(kpi) for kpi in self.kpi_names]
+        thresholds = {'normal_same': ('two-sided-asym', 99.0), 'normal_shifted': ('upper', 99.0)}
+        chunks = [self.data.iloc[i:i + 2500] for i in range(0, len(self.data), 2500)]
+        # a sketch as large as the data is exact, so the chunks are filtered as the whole data
+        sketches = sketch_kpis(chunks, kpis, k=len(self.data))
+
+        mask = exp.outlier_filter(self.data, kpis=kpis, thresholds=thresholds, return_mask=True)
+        sketched_masks = [exp.outlier_filter(chunk, kpis=kpis, thresholds=thresholds,
+                                             return_mask=True, sketches=sketches) for chunk in chunks]
+        self.assertTrue(mask.equals(pd.concat(sketched_masks)))
+
+    def test_outlier_filter_report(self):
+        exp = self.getExperiment()
+        thresholds = {'normal_same': ('lower', 0.1), 'normal_shifted': ('two-sided', 99.0)}
+        data = exp.outlier_filter(self.data, kpis=[KPI('normal_same'), KPI('normal_shifted')], thresholds=thresholds)
+        report = exp.outlier_filter_report
+
+        self.assertTrue(isinstance(report, OutlierFilterReport))
+        self.assertEqual(report.filtered_columns, ['normal_same', 'normal_shifted'])
+        self.assertEqual(report.entities_number, len(self.data))
+        self.assertEqual(report.filtered_entities_number, len(self.data) - len(data))
+        self.assertEqual(sum(report.filtered_entities_per_variant.values()), report.filtered_entities_number)
+        self.assertEqual(report.filtered_entities_per_variant, exp.metadata['filtered_entities_per_variant'])
+
+        self.assertEqual(report.thresholds['normal_same']['kind'], 'lower')
+        self.assertIsNone(report.thresholds['normal_same']['upper'])
+        self.assertAlmostEqual(report.thresholds['normal_same']['lower'], self.data.normal_same.quantile(0.001))
+        self.assertAlmostEqual(report.thresholds['normal_shifted']['lower'], self.data.normal_shifted.quantile(0.005))
+        self.assertAlmostEqual(report.thresholds['normal_shifted']['upper'], self.data.normal_shifted.quantile(0.995))
+        self.assertTrue(report.toJson())
+
+    def test_outlier_filter_report_merge(self):
+        exp = self.getExperiment()
+        kpis = [KPI('normal_same')]
+        thresholds = {'normal_same': ('upper', 99.0)}
+        sketches = sketch_kpis([self.data], kpis, k=len(self.data))
+
+        exp.outlier_filter(self.data, kpis=kpis, thresholds=thresholds)
+        report = exp.outlier_filter_report
+        merged = None
+        for chunk in [self.data.iloc[:4000], self.data.iloc[4000:]]:
+            exp.outlier_filter(chunk, kpis=kpis, thresholds=thresholds, sketches=sketches)
+            merged = exp.outlier_filter_report.merge_with(merged)
+
+        self.assertEqual(merged.entities_number, report.entities_number)
+        self.assertEqual(merged.filtered_entities_number, report.filtered_entities_number)
+        self.assertEqual(merged.filtered_entities_per_variant, report.filtered_entities_per_variant)
+
     def test_outlier_filtering_unsupported_kpi(self):
         exp = self.getExperiment()
         with self.assertRaises(KeyError):
@@ -0,0 +1,121 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from expan.core.experiment import Experiment
+from expan.core.moments import ExperimentMoments, GroupMoments
+from expan.core.statistical_test import KPI, DerivedKPI, Variants, FeatureFilter, StatisticalTest, \
+    StatisticalTestSuite, CorrectionMethod
+from expan.core.util import generate_random_data
+
+
+class ExperimentMomentsTestCases(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(41)
+        self.data, self.metadata = generate_random_data()
+        self.data.loc[:20, 'normal_same'] = np.nan
+        self.data.loc[30:40, 'normal_shifted'] = np.nan
+        self.data.loc[50:60, 'feature'] = np.nan
+        self.kpis = [KPI('normal_same'), DerivedKPI('derived', 'normal_same', 'normal_shifted')]
+        self.variants = Variants('variant', 'B', 'A')
+
+    def make_suite(self, data):
+        features = [[], [FeatureFilter('feature', 'has')], [FeatureFilter('feature', 'non')]]
+        tests = [StatisticalTest(data, kpi, feature, self.variants) for kpi in self.kpis for feature in features]
+        return StatisticalTestSuite(tests, CorrectionMethod.BH)
+
+    def assert_same_results(self, result, expected):
+        self.assertEqual(len(result.results), len(expected.results))
+        for test_result, expected_test_result in zip(result.results, expected.results):
+            for statistics in ['original_test_statistics', 'corrected_test_statistics']:
+                statistics_of_moments = getattr(test_result.result, statistics)
+                expected_statistics   = getattr(expected_test_result.result, statistics)
+                self.assertAlmostEqual(statistics_of_moments.delta, expected_statistics.delta, places=8)
+                self.assertAlmostEqual(statistics_of_moments.p, expected_statistics.p)
+                self.assertEqual(getattr(statistics_of_moments, 'stop', None),
+                                 getattr(expected_statistics, 'stop', None))
+
+    def test_analyze_moments(self):
+        moments = ExperimentMoments(self.kpis, 'variant', ['feature'])
+        moments.add(self.data)
+        self.assertEqual(moments.rows, len(self.data))
+        for test_method in ['fixed_horizon', 'group_sequential']:
+            experiment = Experiment(self.metadata)
+            result   = experiment.analyze_moments(moments, self.make_suite(pd.DataFrame()), test_method)
+            expected = experiment.analyze_statistical_test_suite(self.make_suite(self.data.copy()), test_method)
+            self.assert_same_results(result, expected)
+
+    def test_incremental_update(self):
+        # the moments of the first days are updated with new entities and changed rows of known entities
+        moments = ExperimentMoments(self.kpis, 'variant', ['feature'])
+        moments.add(self.data.iloc[:6000])
+        new_data = self.data.iloc[5000:].copy()
+        new_data.loc[new_data.index[:1000], 'normal_same'] += 1.0
+        moments.update(new_data, self.data.iloc[5000:6000])
+
+        current_data = pd.concat([self.data.iloc[:5000], new_data])
+        experiment = Experiment(self.metadata)
+        result   = experiment.analyze_moments(moments, self.make_suite(pd.DataFrame()), 'group_sequential')
+        expected = experiment.analyze_statistical_test_suite(self.make_suite(current_data), 'group_sequential')
+        self.assert_same_results(result, expected)
+        self.assertEqual(moments.rows, len(current_data))
+
+    def test_merge(self):
+        moments = ExperimentMoments(self.kpis, 'variant', ['feature'])
+        moments.add(self.data.iloc[:3000])
+        other = ExperimentMoments(self.kpis, 'variant', ['feature'])
+        other.add(self.data.iloc[3000:])
+        moments.merge(other)
+
+        expected = ExperimentMoments(self.kpis, 'variant', ['feature'])
+        expected.add(self.data)
+        for kpi in self.kpis:
+            merged_moments   = moments.get_group_moments(kpi.name, 'A', [FeatureFilter('feature', 'has')])
+            expected_moments = expected.get_group_moments(kpi.name, 'A', [FeatureFilter('feature', 'has')])
+            self.assertEqual(merged_moments.finite, expected_moments.finite)
+            for key, value in expected_moments.ratios.__dict__.items():
+                self.assertAlmostEqual(getattr(merged_moments.ratios, key), value)
+
+        with self.assertRaises(ValueError):
+            moments.merge(ExperimentMoments(self.kpis, 'variant'))
+        with self.assertRaises(TypeError):
+            moments.merge(GroupMoments(0, None, None, None))
+
+    def test_missing_segments(self):
+        moments = ExperimentMoments(self.kpis, 'variant', ['feature'])
+        moments.add(self.data)
+        self.assertIsNone(moments.get_group_moments('normal_same', 'A', [FeatureFilter('feature', 'unknown')]))
+        self.assertIsNone(moments.get_group_moments('normal_same', 'A', [FeatureFilter('feature', 'has'),
+                                                                         FeatureFilter('feature', 'non')]))
+        test = StatisticalTest(pd.DataFrame(), KPI('normal_same'), [FeatureFilter('feature', 'unknown')], self.variants)
+        self.assertIsNone(moments.get_sufficient_statistics(test, 'fixed_horizon'))
+        with self.assertRaises(KeyError):
+            moments.get_group_moments('normal_same', 'A', [FeatureFilter('date', '2020-01-01')])
+        with self.assertRaises(KeyError):
+            moments.get_group_moments('revenue', 'A')
+        with self.assertRaises(KeyError):
+            moments.add(self.data.drop('normal_shifted', axis=1))
+
+    def test_unsupported_test_method(self):
+        moments = ExperimentMoments(self.kpis)
+        moments.add(self.data)
+        with self.assertRaises(NotImplementedError):
+            Experiment(self.metadata).analyze_moments(moments, self.make_suite(pd.DataFrame()), 'bayes_factor')
+
+    def test_analyze_chunks(self):
+        for test_method in ['fixed_horizon', 'group_sequential']:
+            chunks = (self.data.iloc[start:start + 3000] for start in range(0, len(self.data), 3000))
+            experiment = Experiment(self.metadata)
+            result   = experiment.analyze_chunks(chunks, self.make_suite(pd.DataFrame()), test_method)
+            expected = experiment.analyze_statistical_test_suite(self.make_suite(self.data.copy()), test_method)
+            self.assert_same_results(result, expected)
+
+    def test_analyze_chunks_with_duplicated_entities(self):
+        chunks = [self.data.iloc[:3000], pd.concat([self.data.iloc[3000:3010], self.data.iloc[3000:3010]])]
+        with self.assertRaises(ValueError):
+            Experiment(self.metadata).analyze_chunks(chunks, self.make_suite(pd.DataFrame()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -83,3 +83,24 @@ def test_quantile_filtering_two_sided_asym():
                                     {'earnings': ('two-sided-asym', 50.0)})
     results = flags.tolist()
     assert results == [True]*2 + [False]*18 + [True]*4
+
+
+def test_quantile_filtering_multiple_threshold_types():
+    exp = Experiment({})
+    df = pd.DataFrame.from_dict({'earnings': list(range(-8, 0)) + list(range(16)),
+                                 'visits': list(range(24)),
+                                 'returns': list(range(24))})
+
+    flags = exp._quantile_filtering(df, ['earnings', 'visits', 'returns'],
+                                    {'earnings': ('two-sided-asym', 50.0),
+                                     'visits': ('upper', 50.0),
+                                     'returns': ('lower', 10.0)})
+    assert flags.tolist() == [True]*3 + [False]*9 + [True]*12
+
+
+def test_quantile_filtering_keeps_infinite_values():
+    exp = Experiment({})
+    df = pd.DataFrame.from_dict({'earnings': [1.0, 2.0, 3.0, np.inf]})
+
+    flags = exp._quantile_filtering(df, ['earnings'], {'earnings': ('upper', 50.0)})
+    assert flags.tolist() == [False, False, True, True]
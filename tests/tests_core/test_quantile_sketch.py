@@ -0,0 +1,102 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from expan.core.quantile_sketch import QuantileSketch, KPIQuantileSketch, sketch_kpis
+from expan.core.statistical_test import KPI, DerivedKPI
+
+
+class QuantileSketchTestCases(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(42)
+        self.levels = [0.0, 0.005, 0.01, 0.25, 0.5, 0.75, 0.99, 0.995, 1.0]
+
+    def test_exact_for_small_samples(self):
+        x = np.random.randn(1000)
+        sketch = QuantileSketch(seed=0)
+        sketch.update(x)
+        np.testing.assert_allclose(sketch.quantile(self.levels), pd.Series(x).quantile(self.levels).values)
+        self.assertEqual(sketch.count, 1000)
+        self.assertEqual(sketch.min, x.min())
+        self.assertEqual(sketch.max, x.max())
+
+    def test_scalar_quantile(self):
+        sketch = QuantileSketch()
+        sketch.update([1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(sketch.quantile(0.5), 2.5)
+
+    def test_ignores_nan(self):
+        sketch = QuantileSketch()
+        sketch.update([1.0, np.nan, 3.0])
+        self.assertEqual(sketch.count, 2)
+        self.assertEqual(sketch.quantile(0.5), 2.0)
+
+    def test_empty(self):
+        self.assertTrue(np.isnan(QuantileSketch().quantile(0.5)))
+
+    def test_rank_error_of_large_samples(self):
+        x = np.random.standard_t(3, size=200000)
+        sketch = QuantileSketch(k=1000, seed=0)
+        for chunk in np.array_split(x, 20):
+            sketch.update(chunk)
+        self.assertLess(sum(len(compactor) for compactor in sketch._compactors), 4000)
+        for level in self.levels:
+            self.assertAlmostEqual(np.mean(x <= sketch.quantile(level)), level, delta=0.003)
+
+    def test_merge(self):
+        x = np.random.randn(100000)
+        sketches = [QuantileSketch(k=1000, seed=i) for i in range(4)]
+        for sketch, part in zip(sketches, np.array_split(x, 4)):
+            sketch.update(part)
+        for sketch in sketches[1:]:
+            sketches[0].merge(sketch)
+        merged = sketches[0]
+
+        self.assertEqual(merged.count, len(x))
+        self.assertEqual(merged.min, x.min())
+        self.assertEqual(merged.max, x.max())
+        for level in self.levels:
+            self.assertAlmostEqual(np.mean(x <= merged.quantile(level)), level, delta=0.003)
+
+    def test_merge_small_sketches_is_exact(self):
+        x = np.random.randn(500)
+        first, second = QuantileSketch(), QuantileSketch()
+        first.update(x[:200])
+        second.update(x[200:])
+        first.merge(second)
+        np.testing.assert_allclose(first.quantile(self.levels), pd.Series(x).quantile(self.levels).values)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            QuantileSketch(k=1)
+        with self.assertRaises(TypeError):
+            QuantileSketch().merge([1.0])
+
+
+class KPIQuantileSketchTestCases(unittest.TestCase):
+    def test_split_by_sign(self):
+        sketch = KPIQuantileSketch()
+        sketch.update([-2.0, -1.0, 0.0, 1.0, np.nan])
+        self.assertEqual(sketch.all.count, 4)
+        self.assertEqual(sketch.negative.count, 2)
+        self.assertEqual(sketch.non_negative.count, 2)
+        self.assertEqual(sketch.min, -2.0)
+        self.assertEqual(sketch.max, 1.0)
+
+    def test_sketch_kpis_from_chunks(self):
+        np.random.seed(0)
+        data = pd.DataFrame({'normal': np.random.randn(1000),
+                             'orders': np.random.poisson(2, 1000).astype(float),
+                             'sessions': np.random.poisson(5, 1000) + 1.0})
+        kpis = [KPI('normal'), DerivedKPI('conversion', 'orders', 'sessions')]
+        sketches = sketch_kpis((data.iloc[i:i + 300].copy() for i in range(0, 1000, 300)), kpis)
+
+        kpis[1].make_derived_kpi(data)
+        for name in ['normal', 'conversion']:
+            self.assertEqual(sketches[name].all.count, 1000)
+            self.assertAlmostEqual(sketches[name].all.quantile(0.99), data[name].quantile(0.99))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 import numpy as np
 
+import expan.core.statistics as statx
 from expan.core.results import *
 from expan.core.statistical_test import *
 from expan.core.util import generate_random_data
@@ -106,3 +107,28 @@ class StatisticalTestCase(unittest.TestCase):
     def test_multi_test_suite_results(self):
         self.assertEqual(len(self.statistical_test_results.results), 2)
         self.assertEqual(self.statistical_test_results.correction_method, self.correction_method)
+
+    def test_sufficient_statistics_merge_with(self):
+        first  = statx.compute_sufficient_statistics([1.0, 2.0], [1.0, 1.0])
+        second = statx.compute_sufficient_statistics([4.0], [2.0])
+        merged = first.merge_with(second)
+        expected = statx.compute_sufficient_statistics([1.0, 2.0, 4.0], [1.0, 1.0, 2.0])
+        self.assertEqual(merged.sample_size, 3)
+        for key, value in expected.__dict__.items():
+            self.assertAlmostEqual(getattr(merged, key), value)
+        self.assertAlmostEqual(merged.mean_numerators, 7.0 / 3)
+        self.assertAlmostEqual(merged.squared_deviations_numerators, 14.0 / 3)
+        self.assertAlmostEqual(merged.co_deviations, 5.0 / 3)
+        self.assertEqual(first.merge_with(None).__dict__, first.__dict__)
+        self.assertEqual(SufficientStatistics(0, 0.0, 0.0, 0.0, 0.0, 0.0).merge_with(second).__dict__, second.__dict__)
+
+    def test_sufficient_statistics_subtract(self):
+        first  = statx.compute_sufficient_statistics([1.0, 2.0], [1.0, 1.0])
+        second = statx.compute_sufficient_statistics([4.0], [2.0])
+        rest = first.merge_with(second).subtract(second)
+        for key, value in first.__dict__.items():
+            self.assertAlmostEqual(getattr(rest, key), value)
+        self.assertEqual(second.subtract(second).sample_size, 0)
+        with self.assertRaises(ValueError):
+            second.subtract(first)
+        self.assertEqual(first.subtract(None).__dict__, first.__dict__)
@@ -22,6 +22,19 @@ class StatisticsTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def assertTestStatisticsAlmostEqual(self, first, second):
+        self.assertAlmostEqual(first.delta, second.delta)
+        self.assertAlmostEqual(first.p, second.p)
+        self.assertAlmostEqual(first.statistical_power, second.statistical_power)
+        for percentile in [item['percentile'] for item in second.confidence_interval]:
+            self.assertAlmostEqual(
+                find_value_by_key_with_condition(first.confidence_interval, 'percentile', percentile, 'value'),
+                find_value_by_key_with_condition(second.confidence_interval, 'percentile', percentile, 'value'))
+        for attribute in ['treatment_statistics', 'control_statistics']:
+            self.assertEqual(getattr(first, attribute).sample_size, getattr(second, attribute).sample_size)
+            self.assertAlmostEqual(getattr(first, attribute).mean, getattr(second, attribute).mean)
+            self.assertAlmostEqual(getattr(first, attribute).variance, getattr(second, attribute).variance)
+
 
 class DeltaTestCases(StatisticsTestCase):
     def test__delta__not_providing_data_fails(self):
@@ -104,6 +117,117 @@ class DeltaTestCases(StatisticsTestCase):
         self.assertEqual(res.control_statistics.sample_size, 65)
 
 
+    def test__delta__computation_poisson_bootstrap(self):
+        """ Result of delta() with the Poisson bootstrap is close to the one assuming normality. """
+        res = statx.delta(self.rand_s1, self.rand_s2, assume_normal=False, nruns=2000, method='poisson')
+        res_normal = statx.delta(self.rand_s1, self.rand_s2, assume_normal=True)
+        self.assertAlmostEqual(res.delta, res_normal.delta)
+
+        value025 = find_value_by_key_with_condition(res.confidence_interval, 'percentile', 2.5, 'value')
+        value975 = find_value_by_key_with_condition(res.confidence_interval, 'percentile', 97.5, 'value')
+        normal025 = find_value_by_key_with_condition(res_normal.confidence_interval, 'percentile', 2.5, 'value')
+        normal975 = find_value_by_key_with_condition(res_normal.confidence_interval, 'percentile', 97.5, 'value')
+        self.assertAlmostEqual(value025, normal025, 1)
+        self.assertAlmostEqual(value975, normal975, 1)
+
+
+class SufficientStatisticsTestCases(StatisticsTestCase):
+    def test__delta_from_sufficient_statistics__equals_delta(self):
+        """ Result of delta_from_sufficient_statistics() equals the one of delta() assuming normality. """
+        x = self.rand_s1.copy()
+        x[:5] = np.nan
+        x_denominators = np.random.poisson(3, size=len(x)).astype(float)
+        y_denominators = np.random.poisson(3, size=len(self.rand_s2)).astype(float)
+
+        expected = statx.delta(x, self.rand_s2, x_denominators, y_denominators)
+        res = statx.delta_from_sufficient_statistics(statx.compute_sufficient_statistics(x, x_denominators),
+                                                     statx.compute_sufficient_statistics(self.rand_s2, y_denominators))
+        self.assertTestStatisticsAlmostEqual(res, expected)
+
+    def test__delta_from_sufficient_statistics__large_offset(self):
+        """ Moments of samples with a large mean give the same result as delta(), also when merged and subtracted. """
+        offset = 1e7
+        x = self.rand_s1 + offset
+        y = self.rand_s2 + offset
+        expected = statx.delta(x, y)
+        x_moments = statx.compute_sufficient_statistics(x[:500]).merge_with(statx.compute_sufficient_statistics(x[500:]))
+        y_moments = statx.compute_sufficient_statistics(np.concatenate([y, x[:300]])).subtract(
+            statx.compute_sufficient_statistics(x[:300]))
+        res = statx.delta_from_sufficient_statistics(x_moments, y_moments)
+        self.assertAlmostEqual(res.delta, expected.delta, places=6)
+        self.assertAlmostEqual(res.p, expected.p, places=6)
+        self.assertAlmostEqual(res.treatment_statistics.variance / expected.treatment_statistics.variance, 1.0)
+        self.assertAlmostEqual(res.control_statistics.variance / expected.control_statistics.variance, 1.0)
+
+    def test__delta_from_sufficient_statistics__too_few_observations(self):
+        """ Result of delta_from_sufficient_statistics() equals the one of delta() with too few observations. """
+        expected = statx.delta(self.rand_s1[:10], self.rand_s2[:10])
+        res = statx.delta_from_sufficient_statistics(statx.compute_sufficient_statistics(self.rand_s1[:10]),
+                                                     statx.compute_sufficient_statistics(self.rand_s2[:10]))
+        self.assertTrue(np.isnan(res.delta))
+        self.assertAlmostEqual(res.p, expected.p)
+        self.assertAlmostEqual(res.treatment_statistics.variance, expected.treatment_statistics.variance)
+
+    def test__delta_from_sufficient_statistics__type_error(self):
+        """ Type error raised when not providing sufficient statistics. """
+        with self.assertRaises(TypeError):
+            statx.delta_from_sufficient_statistics(self.rand_s1, self.rand_s2)
+
+    def test__compute_sufficient_statistics_by_group(self):
+        """ Moments computed per group equal the moments of the group's samples. """
+        data = pd.DataFrame({'variant': ['A', 'B', 'A', 'B', 'A', None],
+                             'revenue': [1.0, 2.0, np.nan, 4.0, 5.0, 6.0],
+                             'orders':  [1.0, 0.0, 1.0, 2.0, 2.0, 1.0]})
+        res = statx.compute_sufficient_statistics_by_group(data, 'variant', ['revenue'], {'revenue': 'orders'})
+        self.assertEqual(sorted(res.keys()), ['A', 'B'])
+
+        # the NaN numerator in A and the zero denominator in B are excluded
+        self.assertEqual(res['A']['revenue'].__dict__,
+                         statx.compute_sufficient_statistics([1.0, 5.0], [1.0, 2.0]).__dict__)
+        self.assertEqual(res['B']['revenue'].__dict__,
+                         statx.compute_sufficient_statistics([4.0], [2.0]).__dict__)
+        self.assertEqual(res['B']['revenue'].sample_size, 1)
+
+    def test__group_codes__categorical(self):
+        """ Only observed groups of categorical columns are numbered, consistently with their keys. """
+        data = pd.DataFrame({'variant': pd.Categorical(['A', 'B', 'B', None], categories=['A', 'B', 'C']),
+                             'feature': pd.Categorical(['x', 'y', 'x', 'x'], categories=['x', 'y'])})
+        keys, codes = statx.group_codes(data, ['feature', 'variant'])
+        self.assertEqual(keys, [('x', 'A'), ('x', 'B'), ('y', 'B')])
+        self.assertEqual(list(codes), [0, 2, 1, -1])
+
+        keys, codes = statx.group_codes(data, ['feature', 'variant'], keep_missing=True)
+        self.assertEqual(keys, [('x', 'A'), ('x', 'B'), ('x', None), ('y', 'B')])
+        self.assertEqual(list(codes), [0, 3, 1, 2])
+
+        keys, codes = statx.group_codes(data, 'variant')
+        self.assertEqual(keys, ['A', 'B'])
+        self.assertEqual(list(codes), [0, 1, 1, -1])
+
+
+
+class BootstrapStatisticsTestCases(StatisticsTestCase):
+    def test__delta_from_bootstrap_statistics__equals_delta(self):
+        """ Result of delta_from_bootstrap_statistics() equals the one of delta() with the bootstrap, for any alpha. """
+        x_denominators = np.random.poisson(3, size=len(self.rand_s1)).astype(float)
+        statistics = statx.compute_bootstrap_statistics(self.rand_s1, self.rand_s2, x_denominators,
+                                                        nruns=1000, seed=42)
+        self.assertEqual(len(statistics.bootstraps), 1000)
+        for alpha, relative in [(0.05, False), (0.01, False), (0.05, True)]:
+            expected = statx.delta(self.rand_s1, self.rand_s2, x_denominators, assume_normal=False, alpha=alpha,
+                                   nruns=1000, relative=relative, seed=42)
+            res = statx.delta_from_bootstrap_statistics(statistics, alpha, relative)
+            self.assertTestStatisticsAlmostEqual(res, expected)
+
+    def test__delta_from_bootstrap_statistics__too_few_observations(self):
+        """ Too few observations give NaN delta and confidence interval. """
+        statistics = statx.compute_bootstrap_statistics(self.rand_s1[:10], self.rand_s2[:10])
+        self.assertIsNone(statistics.bootstraps)
+        res = statx.delta_from_bootstrap_statistics(statistics)
+        self.assertTrue(np.isnan(res.delta))
+        with self.assertRaises(TypeError):
+            statx.delta_from_bootstrap_statistics(statx.compute_sufficient_statistics(self.rand_s1))
+
 class SampleSizeTestCases(StatisticsTestCase):
     def test__sample_size__empty_list_numeric(self):
         """ Empty list returns 0. """
@@ -192,12 +316,88 @@ class BootstrapTestCases(StatisticsTestCase):
         sample2 = self.samples.temperature[self.samples.gender == 2]
         result3 = statx.bootstrap(sample1, sample2)
         # Checking if lower percentile of result3 is correct
-        self.assertAlmostEqual(result3[0][2.5], -0.53384615384615619)
+        self.assertAlmostEqual(result3[0][2.5], -0.53076923076923777)
         # Checking if upper percentile of result3 is correct
-        self.assertAlmostEqual(result3[0][97.5], -0.049192307692299965)
+        self.assertAlmostEqual(result3[0][97.5], -0.036923076923088160)
         # Checking if no bootstrap data was passed
         self.assertIsNone(result3[1])
 
+    def test__bootstrap__blocks_match_single_runs(self):
+        """ Block-wise bootstrap of the mean difference equals applying _delta_mean run by run. """
+        sample1 = self.samples.temperature[self.samples.gender == 1].copy()
+        sample2 = self.samples.temperature[self.samples.gender == 2]
+        sample1.iloc[3] = np.nan
+
+        # a memory budget of one byte results in blocks of a single run, i.e. the same random draws
+        np.random.seed(1)
+        _, blocks = statx.bootstrap(sample1, sample2, nruns=100, return_bootstraps=True, memory_budget=1)
+        np.random.seed(1)
+        _, single_runs = statx.bootstrap(sample1, sample2, func=lambda x, y: statx._delta_mean(x, y),
+                                         nruns=100, return_bootstraps=True)
+        np.testing.assert_almost_equal(blocks, single_runs)
+
+    def test__bootstrap__poisson(self):
+        """ Poisson bootstrap of the mean difference is close to the normal confidence interval. """
+        rand_s1 = self.rand_s1.copy()
+        rand_s1[0] = np.nan
+        result = statx.bootstrap(rand_s1, self.rand_s2, nruns=2000, method='poisson', memory_budget=2**16)
+        expected = statx.normal_sample_difference(rand_s1[1:], self.rand_s2)
+        self.assertAlmostEqual(result[0][2.5], expected[2.5], 1)
+        self.assertAlmostEqual(result[0][97.5], expected[97.5], 1)
+
+    @unittest.skipIf(not hasattr(np.random, 'SeedSequence'), "requires numpy >= 1.17")
+    def test__bootstrap__merged_poisson_bootstrap_sums(self):
+        """ Poisson bootstrap from the merged sums of chunks is close to the normal confidence interval. """
+        rand_s1 = self.rand_s1.copy()
+        rand_s1[0] = np.nan
+        seeds = np.random.SeedSequence(42).spawn(3)
+        x = statx.compute_poisson_bootstrap_sums(rand_s1[:400], nruns=2000, seed=seeds[0]).merge_with(
+            statx.compute_poisson_bootstrap_sums(rand_s1[400:], nruns=2000, seed=seeds[1]))
+        y = statx.compute_poisson_bootstrap_sums(self.rand_s2, nruns=2000, seed=seeds[2])
+        result, bootstraps = statx.bootstrap_from_poisson_bootstrap_sums(x, y, return_bootstraps=True)
+        expected = statx.normal_sample_difference(rand_s1[1:], self.rand_s2)
+        self.assertEqual(len(bootstraps), 2000)
+        self.assertAlmostEqual(result[2.5], expected[2.5], 1)
+        self.assertAlmostEqual(result[97.5], expected[97.5], 1)
+        np.testing.assert_array_equal(statx.compute_poisson_bootstrap_sums(self.rand_s2, nruns=2000, seed=seeds[2]).sums,
+                                      y.sums)
+
+        with self.assertRaises(ValueError):
+            x.merge_with(statx.compute_poisson_bootstrap_sums(rand_s1, nruns=100))
+        with self.assertRaises(ValueError):
+            statx.bootstrap_from_poisson_bootstrap_sums(x, statx.compute_poisson_bootstrap_sums(self.rand_s2, nruns=100))
+
+    def test__bootstrap__unsupported_method(self):
+        """ Value error raised for unknown methods and for Poisson weights with a custom function. """
+        with self.assertRaises(ValueError):
+            statx.bootstrap(self.rand_s1, self.rand_s2, method='jackknife')
+        with self.assertRaises(ValueError):
+            statx.bootstrap(self.rand_s1, self.rand_s2, func=lambda x, y: np.nanmedian(x), method='poisson')
+
+    @unittest.skipIf(not hasattr(np.random, 'SeedSequence'), "requires numpy >= 1.17")
+    def test__bootstrap__seeded_independent_of_n_jobs(self):
+        """ Seeded bootstrap results are identical for any number of processes. """
+        for method in ['multinomial', 'poisson']:
+            _, serial = statx.bootstrap(self.rand_s1, self.rand_s2, nruns=600, return_bootstraps=True,
+                                        method=method, seed=42)
+            _, parallel = statx.bootstrap(self.rand_s1, self.rand_s2, nruns=600, return_bootstraps=True,
+                                          method=method, seed=42, n_jobs=2)
+            _, other_seed = statx.bootstrap(self.rand_s1, self.rand_s2, nruns=600, return_bootstraps=True,
+                                            method=method, seed=43)
+            np.testing.assert_array_equal(serial, parallel)
+            self.assertFalse(np.array_equal(serial, other_seed))
+
+    def test__bootstrap__invalid_n_jobs(self):
+        """ Value error raised for less than one job. """
+        with self.assertRaises(ValueError):
+            statx.bootstrap(self.rand_s1, self.rand_s2, n_jobs=0)
+
+    def test__bootstrap__block_size(self):
+        """ Number of runs per block is bounded by the memory budget, the number of runs and one. """
+        self.assertEqual(statx._bootstrap_block_size(50, 50, 10000, 16 * 100 * 10), 10)
+        self.assertEqual(statx._bootstrap_block_size(50, 50, 5, 16 * 100 * 10), 5)
+        self.assertEqual(statx._bootstrap_block_size(50, 50, 10000, 1), 1)
+
 
 class PooledStdTestCases(StatisticsTestCase):
     def test__pooled_std__variances_differ_too_much_error(self):
@@ -2,10 +2,14 @@ import unittest
 from os import rmdir, makedirs, getcwd, remove, walk
 from os.path import dirname, join, realpath, exists
 
+import numpy as np
+import pandas as pd
 import simplejson as json
 
 import expan.core.util
 import expan.data.csv_fetcher as csv_fetcher
+from expan.core.experiment import Experiment
+from expan.core.statistical_test import StatisticalTest, StatisticalTestSuite, KPI, Variants, FeatureFilter
 
 __location__ = realpath(join(getcwd(), dirname(__file__)))
 
@@ -38,3 +42,60 @@ class CsvFetcherTestCase(unittest.TestCase):
         csv_fetcher.get_data(TEST_FOLDER)
         with self.assertRaises(AssertionError):
             csv_fetcher.get_data(join(__location__, '..'))
+
+    def test_csv_fetcher_with_schema(self):
+        columns = ['entity', 'variant', 'feature', 'normal_same']
+        data, _, report = csv_fetcher.get_data(TEST_FOLDER, columns=columns, categorical_columns=['variant', 'feature'],
+                                               downcast_kpis=True, chunksize=3000, return_report=True)
+        expected, _ = csv_fetcher.get_data(TEST_FOLDER)
+
+        self.assertEqual(list(data.columns), [column for column in expected.columns if column in columns])
+        self.assertEqual(str(data.variant.dtype), 'category')
+        self.assertEqual(str(data.feature.dtype), 'category')
+        self.assertEqual(data.normal_same.dtype, np.float32)
+        self.assertEqual(data.entity.dtype, expected.entity.dtype)
+        self.assertTrue((data.variant.astype(str) == expected.variant).all())
+        np.testing.assert_allclose(data.normal_same, expected.normal_same, rtol=1e-6)
+
+        self.assertEqual(report.rows, len(expected))
+        self.assertGreater(report.rows_per_second, 0)
+        self.assertLess(report.data_memory_mb, expected.memory_usage(deep=True).sum() / 1024.0 ** 2)
+        if report.process_peak_memory_mb is not None:
+            self.assertGreaterEqual(report.peak_memory_increase_mb, 0.0)
+            self.assertLessEqual(report.peak_memory_increase_mb, report.process_peak_memory_mb)
+
+    def test_csv_fetcher_with_schema_in_metadata(self):
+        with open(join(TEST_FOLDER, 'metadata.json'), 'r') as f:
+            metadata = json.load(f)
+        metadata['schema'] = {'columns': ['entity', 'variant', 'normal_same'], 'categorical_columns': ['variant']}
+        with open(join(TEST_FOLDER, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        data, _ = csv_fetcher.get_data(TEST_FOLDER)
+        self.assertEqual(sorted(data.columns), ['entity', 'normal_same', 'variant'])
+        self.assertEqual(str(data.variant.dtype), 'category')
+
+    def test_csv_fetcher_chunks(self):
+        chunks, metadata = csv_fetcher.get_data_chunks(TEST_FOLDER, 3000, columns=['entity', 'variant', 'normal_same'],
+                                                       categorical_columns=['variant'])
+        chunks = list(chunks)
+        expected, _ = csv_fetcher.get_data(TEST_FOLDER)
+        self.assertEqual(metadata['experiment'], 'random_data_generation')
+        self.assertEqual([len(chunk) for chunk in chunks], [3000, 3000, 3000, 1000])
+        self.assertEqual(str(chunks[0].variant.dtype), 'category')
+        np.testing.assert_array_equal(np.concatenate([chunk.normal_same for chunk in chunks]), expected.normal_same)
+
+    def test_analyze_chunks(self):
+        tests = [StatisticalTest(pd.DataFrame(), KPI('normal_same'), [FeatureFilter('feature', 'has')],
+                                 Variants('variant', 'B', 'A'))]
+        chunks, metadata = csv_fetcher.get_data_chunks(TEST_FOLDER, 3000)
+        result = Experiment(metadata).analyze_chunks(chunks, StatisticalTestSuite(tests))
+
+        data, _ = csv_fetcher.get_data(TEST_FOLDER)
+        tests = [StatisticalTest(data, KPI('normal_same'), [FeatureFilter('feature', 'has')],
+                                 Variants('variant', 'B', 'A'))]
+        expected = Experiment(metadata).analyze_statistical_test_suite(StatisticalTestSuite(tests))
+        self.assertAlmostEqual(result.results[0].result.original_test_statistics.delta,
+                               expected.results[0].result.original_test_statistics.delta)
+        self.assertAlmostEqual(result.results[0].result.original_test_statistics.p,
+                               expected.results[0].result.original_test_statistics.p)
@@ -0,0 +1,155 @@
+import unittest
+from os import rmdir, getcwd, remove, walk
+from os.path import dirname, join, realpath
+
+import numpy as np
+import pandas as pd
+
+import expan.core.util
+import expan.data.npy_store as npy_store
+from expan.core.experiment import Experiment
+from expan.core.moments import ExperimentMoments
+from expan.core.statistical_test import StatisticalTest, StatisticalTestSuite, KPI, DerivedKPI, Variants
+
+__location__ = realpath(join(getcwd(), dirname(__file__)))
+
+TEST_FOLDER = join(__location__, 'test_folder_npy_store')
+
+
+class NpyStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        # generate data and metadata and write them to the store
+        (self.data, self.metadata) = expan.core.util.generate_random_data()
+        npy_store.write_data(TEST_FOLDER, self.data, self.metadata)
+
+    def tearDown(self):
+        # remove all test files and test folder
+        for root, dirs, files in walk(TEST_FOLDER, topdown=False):
+            for name in files:
+                remove(join(root, name))
+            for name in dirs:
+                rmdir(join(root, name))
+        rmdir(TEST_FOLDER)
+
+    def test_npy_store(self):
+        data, metadata = npy_store.get_data(TEST_FOLDER)
+        self.assertEqual(metadata, self.metadata)
+        self.assertEqual(list(data.columns), list(self.data.columns))
+        self.assertTrue(isinstance(data.normal_same.values, np.memmap))
+        self.assertEqual(str(data.variant.dtype), 'category')
+        for column in self.data.columns:
+            np.testing.assert_array_equal(np.asarray(data[column]).astype(str),
+                                          np.asarray(self.data[column]).astype(str))
+
+    def test_npy_store_columns(self):
+        data, _ = npy_store.get_data(TEST_FOLDER, columns=['entity', 'variant', 'normal_same'], mmap_mode=None)
+        self.assertEqual(list(data.columns), ['entity', 'variant', 'normal_same'])
+        self.assertFalse(isinstance(data.normal_same.values, np.memmap))
+        with self.assertRaises(KeyError):
+            npy_store.get_data(TEST_FOLDER, columns=['revenue'])
+
+    def test_npy_store_analysis(self):
+        data, metadata = npy_store.get_data(TEST_FOLDER)
+        kpi = DerivedKPI('derived', 'normal_same', 'normal_shifted')
+        variants = Variants('variant', 'B', 'A')
+        result = Experiment(metadata).analyze_statistical_test(StatisticalTest(data, kpi, [], variants)).result
+        expected = Experiment(self.metadata).analyze_statistical_test(StatisticalTest(self.data, kpi, [], variants)).result
+        self.assertAlmostEqual(result.delta, expected.delta)
+        self.assertAlmostEqual(result.p, expected.p)
+
+    def test_append_data(self):
+        new_data = self.data.iloc[5000:].copy()
+        new_data['entity'] += 5000
+        new_data.loc[new_data.index[:1000], 'entity'] -= 5000
+        new_data.loc[new_data.index[:1000], 'normal_same'] += 1.0
+        new_data.loc[new_data.index[-1], 'variant'] = 'C'
+
+        previous_data = npy_store.append_data(TEST_FOLDER, new_data)
+        self.assertEqual(len(previous_data), 1000)
+        np.testing.assert_array_equal(previous_data.entity, new_data.entity[:1000])
+        np.testing.assert_array_equal(previous_data.normal_same, self.data.normal_same.values[5000:6000])
+
+        data, _ = npy_store.get_data(TEST_FOLDER)
+        expected = pd.concat([self.data.set_index('entity'), new_data.set_index('entity')])
+        expected = expected[~expected.index.duplicated(keep='last')]
+        self.assertEqual(len(data), len(expected))
+        data = data.set_index('entity').loc[expected.index]
+        np.testing.assert_array_equal(data.normal_same.values, expected.normal_same.values)
+        np.testing.assert_array_equal(np.asarray(data.variant).astype(str), expected.variant.values.astype(str))
+
+    def test_append_data_with_moments(self):
+        kpis = [KPI('normal_same'), DerivedKPI('derived', 'normal_same', 'normal_shifted')]
+        moments = ExperimentMoments(kpis, 'variant', ['feature'])
+        moments.add(self.data)
+        npy_store.write_data(TEST_FOLDER, self.data, self.metadata, moments)
+
+        new_data = self.data.iloc[:2000].copy()
+        new_data.loc[new_data.index[:1000], 'entity'] += len(self.data)
+        new_data['normal_same'] += 1.0
+        npy_store.append_data(TEST_FOLDER, new_data)
+
+        data, metadata = npy_store.get_data(TEST_FOLDER)
+        tests = [StatisticalTest(data, kpi, [], Variants('variant', 'B', 'A')) for kpi in kpis]
+        expected = Experiment(metadata).analyze_statistical_test_suite(StatisticalTestSuite(tests))
+        tests = [StatisticalTest(pd.DataFrame(), kpi, [], Variants('variant', 'B', 'A')) for kpi in kpis]
+        result = Experiment(metadata).analyze_moments(npy_store.get_moments(TEST_FOLDER), StatisticalTestSuite(tests))
+        for test_result, expected_test_result in zip(result.results, expected.results):
+            self.assertAlmostEqual(test_result.result.original_test_statistics.delta,
+                                   expected_test_result.result.original_test_statistics.delta)
+            self.assertAlmostEqual(test_result.result.original_test_statistics.p,
+                                   expected_test_result.result.original_test_statistics.p)
+
+    def test_append_data_checks_columns(self):
+        with self.assertRaises(KeyError):
+            npy_store.append_data(TEST_FOLDER, self.data.drop('normal_same', axis=1))
+        with self.assertRaises(ValueError):
+            npy_store.append_data(TEST_FOLDER, pd.concat([self.data.iloc[:2], self.data.iloc[:2]]))
+        self.assertIsNone(npy_store.get_moments(TEST_FOLDER))
+
+    def test_interrupted_append_data(self):
+        new_data = self.data.iloc[:2000].copy()
+        new_data['entity'] += len(self.data)
+        files = sorted(next(walk(TEST_FOLDER))[2])
+
+        # the append fails after writing some of the files of the new generation
+        calls = []
+        def failing_save(file_name, array):
+            calls.append(file_name)
+            if len(calls) == 3:
+                raise IOError("No space left on device")
+            save(file_name, array)
+        save, npy_store._save = npy_store._save, failing_save
+        try:
+            with self.assertRaises(IOError):
+                npy_store.append_data(TEST_FOLDER, new_data)
+        finally:
+            npy_store._save = save
+
+        data, _ = npy_store.get_data(TEST_FOLDER)
+        self.assertEqual(len(data), len(self.data))
+        np.testing.assert_array_equal(data.normal_same.values, self.data.normal_same.values)
+        # the files of the new generation written before the failure are removed
+        self.assertEqual(sorted(next(walk(TEST_FOLDER))[2]), files)
+
+        # the next append succeeds, and the files of the previous generation are removed
+        npy_store.append_data(TEST_FOLDER, new_data)
+        data, _ = npy_store.get_data(TEST_FOLDER)
+        self.assertEqual(len(data), len(self.data) + len(new_data))
+        self.assertEqual(len(next(walk(TEST_FOLDER))[2]), len(files))
+
+    def test_append_data_with_conflicting_types(self):
+        data = self.data.assign(time=pd.date_range('2018-01-01', periods=len(self.data), freq='min'))
+        npy_store.write_data(TEST_FOLDER, data, self.metadata)
+        files = sorted(next(walk(TEST_FOLDER))[2])
+
+        new_data = data.iloc[:10].assign(time=np.arange(10.0))
+        new_data['entity'] += len(data)
+        with self.assertRaises(TypeError):
+            npy_store.append_data(TEST_FOLDER, new_data)
+        self.assertEqual(sorted(next(walk(TEST_FOLDER))[2]), files)
+        self.assertEqual(len(npy_store.get_data(TEST_FOLDER)[0]), len(data))
+
+    def test_npy_store_checks_rows(self):
+        npy_store._save(join(TEST_FOLDER, npy_store.COLUMN_FILE.format(1, 0)), np.zeros(10))
+        with self.assertRaises(ValueError):
+            npy_store.get_data(TEST_FOLDER)
@@ -0,0 +1,115 @@
+import unittest
+from os import rmdir, makedirs, getcwd, remove, walk
+from os.path import dirname, join, realpath, exists
+
+import numpy as np
+import simplejson as json
+
+import expan.core.util
+import expan.data.parquet_fetcher as parquet_fetcher
+from expan.core.statistical_test import KPI, DerivedKPI, Variants, FeatureFilter
+from expan.data.schema import required_columns
+
+__location__ = realpath(join(getcwd(), dirname(__file__)))
+
+TEST_FOLDER = join(__location__, 'test_folder_parquet')
+
+
+class SchemaTestCase(unittest.TestCase):
+    def test_required_columns(self):
+        kpis = [KPI('normal_same'), DerivedKPI('derived', 'normal_same', 'normal_shifted')]
+        columns, categorical_columns = required_columns(kpis, Variants('variant', 'B', 'A'),
+                                                        [FeatureFilter('feature', 'has')])
+        self.assertEqual(columns, ['entity', 'variant', 'feature', 'normal_same', 'normal_shifted'])
+        self.assertEqual(categorical_columns, ['variant', 'feature'])
+
+
+@unittest.skipIf(parquet_fetcher.pa is None, "pyarrow is not installed")
+class ParquetFetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        # create test folder
+        if not exists(join(TEST_FOLDER, 'data')):
+            makedirs(join(TEST_FOLDER, 'data'))
+        # generate data and metadata
+        (data, metadata) = expan.core.util.generate_random_data()
+        self.data = data
+        # save data as a partitioned parquet export and as an arrow file
+        data.iloc[:5000].to_parquet(join(TEST_FOLDER, 'data', 'part-0.parquet'), index=False)
+        data.iloc[5000:].to_parquet(join(TEST_FOLDER, 'data', 'part-1.parquet'), index=False)
+        # save metadata to .json file in test folder
+        with open(join(TEST_FOLDER, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+    def tearDown(self):
+        # remove all test files and test folder
+        for root, dirs, files in walk(TEST_FOLDER, topdown=False):
+            for name in files:
+                remove(join(root, name))
+            for name in dirs:
+                rmdir(join(root, name))
+        rmdir(TEST_FOLDER)
+
+    def test_parquet_fetcher(self):
+        data, metadata = parquet_fetcher.get_data(TEST_FOLDER)
+        self.assertEqual(len(data), len(self.data))
+        self.assertEqual(metadata['experiment'], 'random_data_generation')
+        with self.assertRaises(AssertionError):
+            parquet_fetcher.get_data(join(__location__, '..'))
+
+    def test_parquet_fetcher_columns(self):
+        columns, categorical_columns = required_columns([KPI('normal_same')], Variants('variant', 'B', 'A'),
+                                                        [FeatureFilter('feature', 'has')])
+        data, _ = parquet_fetcher.get_data(TEST_FOLDER, columns, categorical_columns)
+        self.assertEqual(sorted(data.columns), sorted(columns))
+        self.assertEqual(str(data.variant.dtype), 'category')
+        self.assertEqual(str(data.feature.dtype), 'category')
+        self.assertTrue((data.normal_same.values == self.data.normal_same.values).all())
+
+    def test_partitioned_parquet_fetcher(self):
+        remove(join(TEST_FOLDER, 'data', 'part-0.parquet'))
+        remove(join(TEST_FOLDER, 'data', 'part-1.parquet'))
+        self.data.to_parquet(join(TEST_FOLDER, 'data'), partition_cols=['variant'], index=False)
+        with open(join(TEST_FOLDER, 'data', '_SUCCESS'), 'w'):
+            pass
+        columns, categorical_columns = ['entity', 'variant', 'normal_same'], ['variant']
+
+        data, _ = parquet_fetcher.get_data(TEST_FOLDER, columns, categorical_columns)
+        self.assertEqual(list(data.columns), columns)
+        self.assertEqual(str(data.variant.dtype), 'category')
+        expected = self.data.sort_values(['variant', 'entity'], kind='mergesort')
+        self.assertEqual(list(data.variant), list(expected.variant))
+        self.assertTrue((data.normal_same.values == expected.normal_same.values).all())
+
+        chunks, _ = parquet_fetcher.get_data_chunks(TEST_FOLDER, 3000, columns, categorical_columns)
+        chunks = list(chunks)
+        self.assertEqual(sum(len(chunk) for chunk in chunks), len(self.data))
+        self.assertEqual(sorted(set(np.concatenate([chunk.variant for chunk in chunks]))), ['A', 'B'])
+
+    def test_arrow_fetcher(self):
+        remove(join(TEST_FOLDER, 'data', 'part-1.parquet'))
+        self.data.iloc[5000:].reset_index(drop=True).to_feather(join(TEST_FOLDER, 'data', 'part-1.arrow'))
+        data, _ = parquet_fetcher.get_data(TEST_FOLDER, ['entity', 'normal_same'])
+        self.assertEqual(list(data.columns), ['entity', 'normal_same'])
+        self.assertEqual(len(data), len(self.data))
+
+    def test_parquet_fetcher_chunks(self):
+        chunks, metadata = parquet_fetcher.get_data_chunks(TEST_FOLDER, 2000, ['entity', 'variant', 'normal_same'],
+                                                           ['variant'])
+        chunks = list(chunks)
+        self.assertEqual(metadata['experiment'], 'random_data_generation')
+        self.assertEqual([len(chunk) for chunk in chunks], [2000, 2000, 1000, 2000, 2000, 1000])
+        self.assertEqual(str(chunks[0].variant.dtype), 'category')
+        self.assertTrue((np.concatenate([chunk.normal_same for chunk in chunks]) == self.data.normal_same.values).all())
+
+    def test_arrow_fetcher_chunks(self):
+        remove(join(TEST_FOLDER, 'data', 'part-1.parquet'))
+        self.data.iloc[5000:].reset_index(drop=True).to_feather(join(TEST_FOLDER, 'data', 'part-1.arrow'),
+                                                                chunksize=1500)
+        chunks, _ = parquet_fetcher.get_data_chunks(TEST_FOLDER, 1000, ['normal_same', 'variant'], ['variant'])
+        chunks = list(chunks)
+        self.assertEqual([len(chunk) for chunk in chunks], [1000] * 5 + [1000, 500] * 3 + [500])
+        self.assertEqual(list(chunks[-1].columns), ['normal_same', 'variant'])
+        self.assertEqual(str(chunks[-1].variant.dtype), 'category')
+        with self.assertRaises(KeyError):
+            list(parquet_fetcher.get_data_chunks(TEST_FOLDER, 1000, ['revenue'])[0])
+        self.assertTrue((np.concatenate([chunk.normal_same for chunk in chunks]) == self.data.normal_same.values).all())